@@ -1,12 +1,18 @@
 import codecs
-from hashlib import sha1
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha1, sha256
 from importlib import import_module
+import json
 import pickle
+from threading import Condition, Event, Lock
+from time import time
 from uuid import uuid4
 
-import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 
-from bosscat import settings
+from bosscat import db, processpool, retry, settings, trace
+from bosscat.utils import get_client
 
 
 class SignatureMismatch(Exception):
@@ -17,9 +23,42 @@ class NotAsyncReceiver(Exception):
     pass
 
 
+class NoMemoBucket(Exception):
+    pass
+
+
+class NotFifoQueue(Exception):
+    pass
+
+
+class BatchSendFailed(Exception):
+    pass
+
+
+class NoCronBucket(Exception):
+    pass
+
+
+# memoized results kept in process, in front of the memo bucket
+MEMO_CACHE_SIZE = 256
+# how long the first message of a batch waits for the others
+DEFAULT_BATCH_WAIT_MS = 50
+# sqs takes up to 10 messages and 256 KiB in one send_message_batch
+SQS_BATCH_SIZE = 10
+SQS_BATCH_BYTES = 262144
+SQS_BATCH_ATTEMPTS = 3
+SNS_BATCH_SIZE = 10
+
+
 SECRET_BYTES = settings.BOSSCAT_SECRET.encode('utf-8')
 
 
+# 'file:<path>' or 'udp:<host>:<port>'; spans of enqueued and received
+#   messages are exported there as they finish
+if getattr(settings, 'ASYNC_TRACE_EXPORTER', ''):
+    trace.enable(trace.get_exporter(settings.ASYNC_TRACE_EXPORTER))
+
+
 encode64 = codecs.getencoder('base64')
 decode64 = codecs.getdecoder('base64')
 
@@ -36,7 +75,158 @@ def get_worker(worker_key):
 def dispatch_message(msg_dict):
     """load a worker function and call it"""
     worker_function = get_worker(msg_dict['worker_key'])
-    worker_function(*msg_dict['args'], **msg_dict['kwargs'])
+    if getattr(worker_function, 'batch_size', None):
+        return worker_function.batcher.submit(msg_dict)
+    return run_worker(worker_function, msg_dict)
+
+
+def run_worker(worker_function, msg_dict):
+    if getattr(worker_function, 'executor', None) == 'process':
+        # cpu bound workers run in a pool process so that they do not hold
+        #   the gil of the wsgi process and its other request threads
+        return get_process_pool().run(
+            dict(msg_dict, trace_parent=trace.get_context()),
+            worker_function.timeout
+            )
+    return call_worker(worker_function, msg_dict)
+
+
+def call_worker(worker_function, msg_dict):
+    if getattr(worker_function, 'db', False):
+        # hand the worker a pooled connection instead of letting it
+        #   resolve the endpoint and connect for every task
+        with db.connection() as connection:
+            return worker_function(
+                *msg_dict['args'],
+                db = connection,
+                **msg_dict['kwargs']
+                )
+    return worker_function(*msg_dict['args'], **msg_dict['kwargs'])
+
+
+class _Batch(object):
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.msg_dicts = []
+        self.results = None
+        self.error = None
+        self.done = Event()
+
+    def get_result(self, index):
+        if self.error is not None:
+            raise self.error
+        result = self.results[index]
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+class MessageBatcher(object):
+    """gather the messages that arrive together for a batch worker
+
+    sqsd posts each message in its own request, so the batch is made of
+    the requests that wait in this process's threads: the first one waits
+    up to max_wait_ms for batch_size - 1 others, calls the worker once
+    with the list of their items and hands each thread its own result.
+    Every message is still acknowledged or failed by its own request.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.condition = Condition()
+        self.pending = None
+
+    def submit(self, msg_dict):
+        with self.condition:
+            batch = self.pending
+            leader = batch is None
+            if leader:
+                batch = self.pending = _Batch(
+                    time() + self.worker.max_wait_ms / 1000.0
+                    )
+            index = len(batch.msg_dicts)
+            batch.msg_dicts.append(msg_dict)
+            if len(batch.msg_dicts) >= self.worker.batch_size:
+                self.pending = None
+                self.condition.notify_all()
+            if leader:
+                while self.pending is batch and time() < batch.deadline:
+                    self.condition.wait(batch.deadline - time())
+                if self.pending is batch:
+                    self.pending = None
+        if leader:
+            self.run(batch)
+        else:
+            batch.done.wait()
+        return batch.get_result(index)
+
+    def run_local(self, msg_dicts):
+        """call the worker on batch_size messages at a time, without waiting"""
+        size = self.worker.batch_size
+        for offset in range(0, len(msg_dicts), size):
+            batch = _Batch(time())
+            batch.msg_dicts = msg_dicts[offset:offset + size]
+            self.run(batch)
+            for index in range(len(batch.msg_dicts)):
+                batch.get_result(index)
+
+    def run(self, batch):
+        items = [msg_dict['args'][0] for msg_dict in batch.msg_dicts]
+        try:
+            results = run_worker(self.worker, {
+                'worker_key': self.worker.worker_key,
+                'args': (items,),
+                'kwargs': {}
+                })
+            if results is None:
+                results = [None] * len(items)
+            results = list(results)
+            if len(results) != len(items):
+                raise ValueError('{} returned {} results for {} items'.format(
+                    self.worker.worker_key,
+                    len(results),
+                    len(items)
+                    ))
+            batch.results = results
+        except Exception as ex:
+            batch.error = ex
+        finally:
+            batch.done.set()
+
+
+def _call_in_process(msg_dict):
+    with trace.attach(msg_dict.get('trace_parent')):
+        return call_worker(get_worker(msg_dict['worker_key']), msg_dict)
+
+
+_process_pool = None
+_process_pool_lock = Lock()
+
+
+def get_process_pool():
+    """the pool of this process, started on first use from settings
+
+    ASYNC_PROCESSES (default: one per cpu), ASYNC_MAX_TASKS_PER_CHILD and
+    ASYNC_PRELOAD_MODULES (comma separated module names) configure it.
+    Call it from the wsgi script to start the pool before the first request.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            preload = getattr(settings, 'ASYNC_PRELOAD_MODULES', '')
+            _process_pool = processpool.ProcessPool(
+                _call_in_process,
+                processes = int(getattr(settings, 'ASYNC_PROCESSES', 0)) or None,
+                max_tasks_per_child = int(getattr(
+                    settings,
+                    'ASYNC_MAX_TASKS_PER_CHILD',
+                    processpool.DEFAULT_MAX_TASKS_PER_CHILD
+                    )),
+                preload = [name for name in preload.split(',') if name]
+                )
+            _process_pool.start()
+        return _process_pool
 
 
 def _get_signature(message_pickle, message_secret_bytes):
@@ -44,18 +234,82 @@ def _get_signature(message_pickle, message_secret_bytes):
 
 
 def _sns_publish(msg_dict):
-    sns = boto3.client('sns', settings.DEPLOYMENT_REGION)
+    # a message sent to another region reports to that region's topic
+    region = msg_dict.get('region', settings.DEPLOYMENT_REGION)
+    sns = get_client('sns', region)
     sns.publish(
-        TopicArn = settings.ASYNC_TOPIC_ARN,
+        TopicArn = _get_topic_arn(region),
         Subject = msg_dict['status'],
         Message = str(msg_dict)
         )
 
 
+def _get_topic_arn(region):
+    arn_parts = settings.ASYNC_TOPIC_ARN.split(':')
+    arn_parts[3] = region
+    return ':'.join(arn_parts)
+
+
+def _get_queue_urls():
+    """the local queue url, followed by the others when failing over"""
+    queue_urls = getattr(settings, 'ASYNC_MQ_URLS', [settings.ASYNC_MQ_URL])
+    if getattr(settings, 'ASYNC_FAILOVER', False):
+        return queue_urls
+    return queue_urls[:1]
+
+
+def _get_queue_region(queue_url):
+    # https://sqs.<region>.amazonaws.com/<account>/<name>
+    return queue_url.split('/')[2].split('.')[1]
+
+
+def _is_regional_failure(ex):
+    """errors that another region's queue may not have"""
+    if isinstance(ex, ClientError):
+        return retry.classify(ex) == retry.THROTTLE
+    return isinstance(ex, BotoCoreError)
+
+
+def _send(send_function):
+    """call send_function(sqs, queue_url) on each queue until one works
+
+    return the region of the queue that took the messages
+    """
+    queue_urls = _get_queue_urls()
+    for index, queue_url in enumerate(queue_urls):
+        region = _get_queue_region(queue_url)
+        try:
+            send_function(get_client('sqs', region), queue_url)
+            return region
+        except (ClientError, BotoCoreError) as ex:
+            if index == len(queue_urls) - 1 or not _is_regional_failure(ex):
+                raise
+
+
+def _sns_publish_batch(msg_dicts, region=None):
+    region = region or settings.DEPLOYMENT_REGION
+    sns = get_client('sns', region)
+    for offset in range(0, len(msg_dicts), SNS_BATCH_SIZE):
+        sns.publish_batch(
+            TopicArn = _get_topic_arn(region),
+            PublishBatchRequestEntries = [
+                {
+                    'Id': str(index),
+                    'Subject': msg_dict['status'],
+                    'Message': str(msg_dict)
+                    }
+                for index, msg_dict in enumerate(
+                    msg_dicts[offset:offset + SNS_BATCH_SIZE]
+                    )
+                ]
+            )
+
+
 def receive_message(raw_http_content):
     """receive message handler"""
     if not settings.ASYNC_RECEIVER:
         raise NotAsyncReceiver()
+    received = time()
     # open the message
     msg_envelope = pickle.loads(decode64(raw_http_content)[0])
     msg_pickle = msg_envelope['msg_pickle']
@@ -67,93 +321,498 @@ def receive_message(raw_http_content):
         msg_dict['status'] = 'Signature Mismatch'
         _sns_publish(msg_dict)
         raise SignatureMismatch()
+    decoded = time()
     # log the message to sns
     msg_dict['status'] = 'Received'
     _sns_publish(msg_dict)
-    # call the worker
-    dispatch_message(msg_dict)
+    # call the worker; log failures to sns before sqsd retries them
+    trace_context = msg_dict.get('trace')
+    try:
+        with trace.attach(trace_context):
+            if trace_context:
+                # the enqueue time is from the sender's clock
+                trace.record_span(
+                    'async.queue_wait',
+                    'async',
+                    trace_context['enqueued'],
+                    received,
+                    msg_id = msg_dict.get('msg_id')
+                    )
+            trace.record_span('async.decode', 'async', received, decoded)
+            with trace.span(
+                        'async.execute',
+                        'async',
+                        worker_key = msg_dict['worker_key'],
+                        msg_id = msg_dict.get('msg_id')
+                        ):
+                dispatch_message(msg_dict)
+    except Exception as ex:
+        msg_dict['status'] = 'Failed'
+        msg_dict['error'] = repr(ex)
+        _sns_publish(msg_dict)
+        raise
     msg_dict['status'] = 'Complete'
     _sns_publish(msg_dict)
+    if 'cron_shard' in msg_dict:
+        _finish_cron_shard(msg_dict)
+
+
+def _get_memo_key(worker_key, args, kwargs):
+    # canonical json when the arguments allow it, so that equal dicts hash
+    #   equally whatever their key order; pickle otherwise
+    try:
+        canonical = json.dumps(
+            [args, kwargs],
+            sort_keys = True,
+            separators = (',', ':')
+            ).encode('utf-8')
+    except TypeError:
+        canonical = pickle.dumps([args, sorted(kwargs.items())])
+    return 'bosscat-memo/{}/{}'.format(
+        worker_key,
+        sha256(canonical).hexdigest()
+        )
 
 
-class bosscat_worker(object):
-    """decorator class for bosscat worker functions"""
+class MemoStore(object):
+    """worker results in an s3 bucket behind an in-process lru cache
+
+    Results are pickled and signed with SECRET_BYTES like messages are, so
+    a result that was not written by this deployment is never unpickled.
+    """
+
+    def __init__(self, max_size=MEMO_CACHE_SIZE):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        # memo_key: [lock, number of threads holding or waiting for it]
+        self.key_locks = {}
+        self.lock = Lock()
+
+    def get_bucket_name(self):
+        bucket_name = getattr(settings, 'ASYNC_MEMO_BUCKET', None)
+        if not bucket_name:
+            raise NoMemoBucket(
+                'memoized workers need a bucket with setting_name '
+                'ASYNC_MEMO_BUCKET'
+                )
+        return bucket_name
+
+    @contextmanager
+    def get_key_lock(self, memo_key):
+        """hold the lock of memo_key, which only calls with that key share"""
+        # a key's lock is dropped when its last waiter leaves, so that the
+        #   locks stay bounded in long lived workers
+        with self.lock:
+            key_lock = self.key_locks.setdefault(memo_key, [Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                yield
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self.key_locks[memo_key]
+
+    def get(self, memo_key):
+        """return (True, result) for a fresh memo, else (False, None)"""
+        with self.lock:
+            if memo_key in self.cache:
+                expires, result = self.cache[memo_key]
+                if expires is None or expires > time():
+                    self.cache.move_to_end(memo_key)
+                    return True, result
+                del self.cache[memo_key]
+        s3 = get_client('s3', settings.DEPLOYMENT_REGION)
+        try:
+            obj = s3.get_object(Bucket=self.get_bucket_name(), Key=memo_key)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return False, None
+        expires = obj['Metadata'].get('expires')
+        expires = float(expires) if expires else None
+        if expires is not None and expires <= time():
+            return False, None
+        memo_envelope = pickle.loads(obj['Body'].read())
+        result_pickle = memo_envelope['result_pickle']
+        if _get_signature(result_pickle, SECRET_BYTES) != \
+                memo_envelope['result_signature']:
+            raise SignatureMismatch()
+        result = pickle.loads(result_pickle)
+        self._cache(memo_key, expires, result)
+        return True, result
+
+    def put(self, memo_key, result, ttl=None):
+        expires = time() + ttl if ttl else None
+        result_pickle = pickle.dumps(result)
+        memo_envelope = {
+            'result_pickle': result_pickle,
+            'result_signature': _get_signature(result_pickle, SECRET_BYTES)
+            }
+        s3 = get_client('s3', settings.DEPLOYMENT_REGION)
+        s3.put_object(
+            Bucket = self.get_bucket_name(),
+            Key = memo_key,
+            Body = pickle.dumps(memo_envelope),
+            Metadata = {'expires': repr(expires)} if expires else {}
+            )
+        self._cache(memo_key, expires, result)
+
+    def _cache(self, memo_key, expires, result):
+        with self.lock:
+            self.cache[memo_key] = (expires, result)
+            self.cache.move_to_end(memo_key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
 
-    def __init__(self, worker_function):
+
+memo_store = MemoStore()
+
+
+class bosscat_worker(object):
+    """decorator class for bosscat worker functions
+
+    Use @bosscat_worker, or @bosscat_worker(memoize=True, ttl=seconds) for
+    deterministic workers whose results should be reused for identical
+    arguments.  Workers declared with db=True are called with a pooled
+    connection from bosscat.db as their db keyword argument.  Workers
+    declared with executor='process' run in a pool process; one that runs
+    past timeout seconds is killed and the task fails.
+
+    Workers declared with batch_size take a list: each message carries one
+    item, and the items that arrive within max_wait_ms are passed in one
+    call.  They return None or a list with a result per item, where an
+    exception instance fails that item's message alone.
+    """
+
+    def __init__(
+                self,
+                worker_function = None,
+                memoize = False,
+                ttl = None,
+                db = False,
+                executor = None,
+                timeout = None,
+                batch_size = None,
+                max_wait_ms = DEFAULT_BATCH_WAIT_MS
+                ):
+        if executor not in (None, 'process'):
+            raise ValueError('unknown executor {!r}'.format(executor))
+        if batch_size and memoize:
+            raise ValueError('batch workers can not be memoized')
+        self.memoize = memoize
+        self.ttl = ttl
+        self.db = db
+        self.executor = executor
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batcher = MessageBatcher(self) if batch_size else None
+        self.worker_function = None
+        if worker_function is not None:
+            self._wrap(worker_function)
+
+    def _wrap(self, worker_function):
         worker_key = '{}.{}'.format(
             worker_function.__module__,
             worker_function.__name__
             )
         self.worker_key = worker_key
         self.worker_function = worker_function
+        return self
 
     def __call__(self, *args, **kwargs):
-        self.worker_function(*args, **kwargs)
+        if self.worker_function is None:
+            # called with options; this call decorates the function
+            return self._wrap(*args)
+        if not self.memoize:
+            return self.worker_function(*args, **kwargs)
+        memo_kwargs = dict(kwargs)
+        if self.db:
+            memo_kwargs.pop('db', None)
+        memo_key = _get_memo_key(self.worker_key, args, memo_kwargs)
+        found, result = memo_store.get(memo_key)
+        if found:
+            return result
+        # single flight: identical concurrent tasks in this process wait
+        #   for the first one and reuse its result
+        with memo_store.get_key_lock(memo_key):
+            found, result = memo_store.get(memo_key)
+            if not found:
+                result = self.worker_function(*args, **kwargs)
+                memo_store.put(memo_key, result, self.ttl)
+        return result
 
     def async(self, *args, **kwargs):
         self.delay(0, *args, **kwargs)
 
     def delay(self, delay_seconds, *args, **kwargs):
+        """send the call to the worker tier after delay_seconds"""
+        self._delay(delay_seconds, args, kwargs, None)
+
+    def delay_grouped(self, group_key, *args, **kwargs):
+        """send the call to the fifo queue in the group of group_key
+
+        Messages with the same group_key are processed in order, one at a
+        time, while different groups run in parallel.
+        """
+        self._delay(0, args, kwargs, group_key)
+
+    def _delay(self, delay_seconds, args, kwargs, group_key):
+        if self.batch_size and (len(args) != 1 or kwargs):
+            raise TypeError('batch workers take a single item per message')
         if settings.ASYNC_RUN_LOCAL:
-            self.__call__(*args, **kwargs)
+            self._run_local([(args, kwargs)])
         else:
-            msg_dict = {
-                'msg_id': str(uuid4()),
-                'worker_key': self.worker_key,
-                'args': args,
-                'kwargs': kwargs
-                }
-            if delay_seconds:
-                msg_dict['delay_seconds'] = delay_seconds
-            # pickle the message and put it in the envelope
-            # sign the envelope with SECRET_BYTES as a salt
-            msg_pickle = pickle.dumps(msg_dict)
-            msg_envelope = {
-                'msg_pickle': msg_pickle,
-                'msg_signature': _get_signature(msg_pickle, SECRET_BYTES)
-                }
-            # pickle the envelope and encode it to base64 because SQS
-            #   rejects the control characters used by pickle; decode
-            #   the bytes returned by encode64 to str to satisfy
-            #   sqs.send_message
-            message_body_64 = encode64(pickle.dumps(msg_envelope))[0].decode()
-            sqs = boto3.client('sqs', settings.DEPLOYMENT_REGION)
-            response = sqs.send_message(
-                QueueUrl = settings.ASYNC_MQ_URL,
-                MessageBody = message_body_64,
-                DelaySeconds = delay_seconds
-                )
+            with trace.span(
+                        'async.enqueue',
+                        'async',
+                        worker_key = self.worker_key
+                        ):
+                msg_dict, send_kwargs = self._get_message(
+                    delay_seconds,
+                    args,
+                    kwargs,
+                    group_key
+                    )
+                message_body_64 = _encode_message(msg_dict)
+                region = _send(
+                    lambda sqs, queue_url: sqs.send_message(
+                        QueueUrl = queue_url,
+                        MessageBody = message_body_64,
+                        **send_kwargs
+                        )
+                    )
             # log the message to sns
             msg_dict['status'] = 'Sent'
+            if region != settings.DEPLOYMENT_REGION:
+                msg_dict['region'] = region
             _sns_publish(msg_dict)
 
+    def delay_batch(self, calls, delay_seconds=0, group_key=None, extra=None):
+        """send many (args, kwargs) calls with batched sqs and sns requests
+
+        extra is merged into every msg_dict; returns the msg_ids.
+        """
+        if not calls:
+            return []
+        if settings.ASYNC_RUN_LOCAL:
+            self._run_local(calls, extra)
+            return []
+        with trace.span(
+                    'async.enqueue',
+                    'async',
+                    worker_key = self.worker_key,
+                    messages = len(calls)
+                    ):
+            messages = []
+            for args, kwargs in calls:
+                msg_dict, send_kwargs = self._get_message(
+                    delay_seconds,
+                    args,
+                    kwargs,
+                    group_key
+                    )
+                msg_dict.update(extra or {})
+                messages.append((msg_dict, send_kwargs))
+            regions = set()
+            for batch in _get_send_batches(messages):
+                regions.add(_send(
+                    lambda sqs, queue_url: _send_message_batch(sqs, queue_url, batch)
+                    ))
+        # statuses go to the region that took every batch; the local one
+        #   when a failover split them
+        _sns_publish_batch(
+            [dict(msg_dict, status='Sent') for msg_dict, send_kwargs in messages],
+            settings.DEPLOYMENT_REGION if len(regions) > 1 else regions.pop()
+            )
+        return [msg_dict['msg_id'] for msg_dict, send_kwargs in messages]
+
+    def _run_local(self, calls, extra=None):
+        msg_dicts = [
+            dict(
+                extra or {},
+                worker_key = self.worker_key,
+                args = args,
+                kwargs = kwargs
+                )
+            for args, kwargs in calls
+            ]
+        if self.batcher:
+            # there are no other requests to wait for, so batch workers run
+            #   at once on the calls they are given
+            self.batcher.run_local(msg_dicts)
+        else:
+            for msg_dict in msg_dicts:
+                dispatch_message(msg_dict)
+        for msg_dict in msg_dicts:
+            if 'cron_shard' in msg_dict:
+                _finish_cron_shard(msg_dict)
+
+    def _get_message(self, delay_seconds, args, kwargs, group_key):
+        """return the msg_dict of a call and its sqs send arguments"""
+        msg_dict = {
+            'msg_id': str(uuid4()),
+            'worker_key': self.worker_key,
+            'args': args,
+            'kwargs': kwargs
+            }
+        # the receiver continues the sender's trace, or starts one of its
+        #   own when the sender is not tracing
+        msg_dict['trace'] = dict(
+            trace.get_context() or {'trace_id': trace.new_id(), 'span_id': None},
+            enqueued = time()
+            )
+        if delay_seconds:
+            msg_dict['delay_seconds'] = delay_seconds
+        fifo = settings.ASYNC_MQ_NAME.endswith('.fifo')
+        if group_key is not None and not fifo:
+            raise NotFifoQueue(settings.ASYNC_MQ_NAME)
+        send_kwargs = {}
+        if fifo:
+            # fifo queues only take delays for the whole queue
+            if delay_seconds:
+                raise ValueError('fifo queues do not delay messages')
+            # the message id doubles as the deduplication id, so a send
+            #   retried by botocore is delivered only once; a message
+            #   without a group_key is its own group and is not ordered
+            msg_dict['group_key'] = str(
+                group_key if group_key is not None else msg_dict['msg_id']
+                )
+            msg_dict['deduplication_id'] = msg_dict['msg_id']
+            send_kwargs = {
+                'MessageGroupId': msg_dict['group_key'],
+                'MessageDeduplicationId': msg_dict['deduplication_id']
+                }
+        else:
+            send_kwargs['DelaySeconds'] = delay_seconds
+        return msg_dict, send_kwargs
+
+
+def _encode_message(msg_dict):
+    # pickle the message and put it in the envelope
+    # sign the envelope with SECRET_BYTES as a salt
+    msg_pickle = pickle.dumps(msg_dict)
+    msg_envelope = {
+        'msg_pickle': msg_pickle,
+        'msg_signature': _get_signature(msg_pickle, SECRET_BYTES)
+        }
+    # pickle the envelope and encode it to base64 because SQS
+    #   rejects the control characters used by pickle; decode
+    #   the bytes returned by encode64 to str to satisfy
+    #   sqs.send_message
+    return encode64(pickle.dumps(msg_envelope))[0].decode()
+
+
+def _get_send_batches(messages):
+    """group (msg_dict, send_kwargs) pairs into send_message_batch entries"""
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for msg_dict, send_kwargs in messages:
+        body = _encode_message(msg_dict)
+        if batch and (
+                    len(batch) == SQS_BATCH_SIZE or
+                    batch_bytes + len(body) > SQS_BATCH_BYTES
+                    ):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        entry = dict(send_kwargs, Id=str(len(batch)), MessageBody=body)
+        batch.append(entry)
+        batch_bytes += len(body)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _send_message_batch(sqs, queue_url, entries):
+    """send entries, removing each one that is sent from the list, so that a
+    failover only sends the rest"""
+    for attempt in range(SQS_BATCH_ATTEMPTS):
+        response = sqs.send_message_batch(
+            QueueUrl = queue_url,
+            Entries = entries
+            )
+        failed_ids = set(result['Id'] for result in response.get('Failed', []))
+        entries[:] = [entry for entry in entries if entry['Id'] in failed_ids]
+        if not entries:
+            return
+    raise BatchSendFailed('{} messages were not sent: {}'.format(
+        len(entries),
+        response['Failed']
+        ))
 
-class bosscat_cron(object):
-    """decorator class for bosscat cron functions"""
 
-    def __init__(self, cron_function, **kwargs):
+class bosscat_cron(object):
+    """decorator class for bosscat cron functions
+
+    With @bosscat_cron(shards=N, shard_worker=worker), the cron function
+    runs first and then N shard tasks are sent to worker, which is called
+    with shard_index and shard_count keyword arguments on the worker tier.
+    The last shard to finish publishes Complete Cron with the duration of
+    the whole run; shards record their completion in ASYNC_CRON_BUCKET,
+    under bosscat-cron/, which a lifecycle rule can expire.
+    """
+
+    def __init__(self, cron_function=None, shards=None, shard_worker=None, **kwargs):
+        if shards and shard_worker is None:
+            raise ValueError('sharded crons need a shard_worker')
         self.__dict__.update(kwargs)
+        self.shards = shards
+        self.shard_worker = shard_worker
+        self.cron_function = None
+        if cron_function is not None:
+            self._wrap(cron_function)
+
+    def _wrap(self, cron_function):
         self.cron_function = cron_function
         self.cron_name = '{}.{}'.format(
             cron_function.__module__,
             cron_function.__name__
             )
+        return self
 
     def __call__(self, request):
+        if self.cron_function is None:
+            # called with options; this call decorates the function
+            return self._wrap(request)
         if not settings.ASYNC_RECEIVER:
             if hasattr(self, 'http404_exception_class'):
                 raise self.http404_exception_class()
             if hasattr(self, 'http404_response'):
                 return self.http404_response
             raise NotAsyncReceiver()
+        if self.shards:
+            # fail before any shard runs, not after each one has
+            _get_cron_bucket_name()
         sns_dict = {
             'status': 'Launch Cron',
             'cron': self.cron_name,
             'uuid': str(uuid4())
             }
+        launched = time()
         _sns_publish(sns_dict)
         self.cron_function(request)
-        sns_dict['status'] = 'Complete Cron'
+        if self.shards:
+            self.shard_worker.delay_batch(
+                [
+                    ((), {'shard_index': shard_index, 'shard_count': self.shards})
+                    for shard_index in range(self.shards)
+                    ],
+                extra = {'cron_shard': {
+                    'cron': self.cron_name,
+                    'uuid': sns_dict['uuid'],
+                    'launched': launched,
+                    'shard_count': self.shards
+                    }}
+                )
+            sns_dict['status'] = 'Sent Cron Shards'
+            sns_dict['shards'] = self.shards
+        else:
+            sns_dict['status'] = 'Complete Cron'
+            sns_dict['duration'] = time() - launched
         _sns_publish(sns_dict)
         return self.get_response()
 
@@ -161,3 +820,77 @@ class bosscat_cron(object):
         return getattr(self, 'http_response', True)
 
 
+def _get_cron_bucket_name():
+    bucket_name = getattr(settings, 'ASYNC_CRON_BUCKET', None)
+    if not bucket_name:
+        raise NoCronBucket(
+            'sharded crons need a bucket with setting_name ASYNC_CRON_BUCKET'
+            )
+    return bucket_name
+
+
+def _finish_cron_shard(msg_dict):
+    # the shard's work is done, so an error recording it is logged to sns
+    #   rather than failing the message, which sqsd would run again
+    try:
+        _complete_cron_shard(msg_dict)
+    except Exception as ex:
+        _sns_publish({
+            'status': 'Cron Shard Error',
+            'cron': msg_dict['cron_shard']['cron'],
+            'uuid': msg_dict['cron_shard']['uuid'],
+            'shard_index': msg_dict['kwargs'].get('shard_index'),
+            'error': repr(ex)
+            })
+
+
+def _complete_cron_shard(msg_dict):
+    """record a finished shard; the shard that completes the run reports it"""
+    cron_shard = msg_dict['cron_shard']
+    s3 = get_client('s3', settings.DEPLOYMENT_REGION)
+    bucket_name = _get_cron_bucket_name()
+    prefix = 'bosscat-cron/{}/{}/'.format(cron_shard['cron'], cron_shard['uuid'])
+    # a redelivered shard writes the same key again, so it counts once
+    s3.put_object(
+        Bucket = bucket_name,
+        Key = '{}shards/{:06d}'.format(prefix, msg_dict['kwargs']['shard_index']),
+        Body = b''
+        )
+    finished = 0
+    marker = ''
+    while True:
+        response = s3.list_objects(
+            Bucket = bucket_name,
+            Prefix = prefix + 'shards/',
+            Marker = marker
+            )
+        contents = response.get('Contents', [])
+        finished += len(contents)
+        if not response.get('IsTruncated') or not contents:
+            break
+        marker = contents[-1]['Key']
+    if finished < cron_shard['shard_count']:
+        return
+    # shards that finish together may all count every shard; only the
+    #   one that creates the complete marker reports the run
+    try:
+        s3.put_object(
+            Bucket = bucket_name,
+            Key = prefix + 'complete',
+            Body = b'',
+            IfNoneMatch = '*'
+            )
+    except ClientError as ex:
+        if ex.response['Error']['Code'] in (
+                    'PreconditionFailed',
+                    'ConditionalRequestConflict'
+                    ):
+            return
+        raise
+    _sns_publish({
+        'status': 'Complete Cron',
+        'cron': cron_shard['cron'],
+        'uuid': cron_shard['uuid'],
+        'shards': cron_shard['shard_count'],
+        'duration': time() - cron_shard['launched']
+        })
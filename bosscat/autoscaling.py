@@ -0,0 +1,314 @@
+import csv
+
+from botocore.exceptions import ClientError
+
+from bosscat import trace
+from bosscat.utils import client_error_code, get_client, try_client
+
+
+RESOURCE_NOT_FOUND = 'ResourceNotFound'
+
+
+DEFAULT_QUEUE_SCALING = {
+    # messages waiting per in-service instance that the worker tier aims for
+    'backlog_per_instance': 100,
+    # scale out when the oldest message has waited this long, in seconds
+    'max_message_age': 300,
+    # seconds between scale-out steps and between scale-in steps
+    'scale_out_cooldown': 60,
+    'scale_in_cooldown': 300,
+    # scale in once the backlog stays below this fraction of the target
+    'scale_in_ratio': 0.5,
+    'period': 60,
+    'scale_out_evaluation_periods': 1,
+    'scale_in_evaluation_periods': 5,
+    # (backlog / target - 1 lower bound, instances to add) steps
+    'scale_out_steps': [(0, 1), (1, 2), (3, 4)],
+    }
+
+
+def get_queue_scaling(eb):
+    """the tier's queue_scaling settings merged over the defaults, or None"""
+    if not eb.get('queue_scaling'):
+        return None
+    scaling = dict(DEFAULT_QUEUE_SCALING)
+    if isinstance(eb['queue_scaling'], dict):
+        scaling.update(eb['queue_scaling'])
+    return scaling
+
+
+def get_alarm_names(environment_name):
+    return dict(
+        (alarm, '{}-{}'.format(environment_name, alarm))
+        for alarm in ('backlog-high', 'age-high', 'backlog-low')
+        )
+
+
+def _backlog_metrics(queue_name, asg_name, period):
+    # backlog per instance = visible messages / in-service instances; an
+    #   empty group counts as one instance so the alarm can still fire
+    return [
+        {
+            'Id': 'visible',
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/SQS',
+                    'MetricName': 'ApproximateNumberOfMessagesVisible',
+                    'Dimensions': [{'Name': 'QueueName', 'Value': queue_name}]
+                    },
+                'Period': period,
+                'Stat': 'Maximum'
+                },
+            'ReturnData': False
+            },
+        {
+            'Id': 'instances',
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/AutoScaling',
+                    'MetricName': 'GroupInServiceInstances',
+                    'Dimensions': [
+                        {'Name': 'AutoScalingGroupName', 'Value': asg_name}
+                        ]
+                    },
+                'Period': period,
+                'Stat': 'Minimum'
+                },
+            'ReturnData': False
+            },
+        {
+            'Id': 'backlog',
+            'Expression': 'visible / IF(instances >= 1, instances, 1)',
+            'Label': 'Backlog per instance',
+            'ReturnData': True
+            },
+        ]
+
+
+def get_scaling_policies(asg_name, scaling):
+    """the put_scaling_policy arguments for scale out and scale in"""
+    target = scaling['backlog_per_instance']
+    steps = sorted(scaling['scale_out_steps'])
+    step_adjustments = []
+    for index, (lower, adjustment) in enumerate(steps):
+        step = {
+            'MetricIntervalLowerBound': lower * target,
+            'ScalingAdjustment': adjustment
+            }
+        if index + 1 < len(steps):
+            step['MetricIntervalUpperBound'] = steps[index + 1][0] * target
+        step_adjustments.append(step)
+    return {
+        'scale-out': {
+            'AutoScalingGroupName': asg_name,
+            'PolicyName': '{}-queue-scale-out'.format(asg_name),
+            'PolicyType': 'StepScaling',
+            'AdjustmentType': 'ChangeInCapacity',
+            'MetricAggregationType': 'Maximum',
+            'EstimatedInstanceWarmup': scaling['scale_out_cooldown'],
+            'StepAdjustments': step_adjustments
+            },
+        'age-scale-out': {
+            'AutoScalingGroupName': asg_name,
+            'PolicyName': '{}-queue-age-scale-out'.format(asg_name),
+            'PolicyType': 'SimpleScaling',
+            'AdjustmentType': 'ChangeInCapacity',
+            'ScalingAdjustment': 1,
+            'Cooldown': scaling['scale_out_cooldown']
+            },
+        'scale-in': {
+            'AutoScalingGroupName': asg_name,
+            'PolicyName': '{}-queue-scale-in'.format(asg_name),
+            'PolicyType': 'SimpleScaling',
+            'AdjustmentType': 'ChangeInCapacity',
+            'ScalingAdjustment': -1,
+            'Cooldown': scaling['scale_in_cooldown']
+            },
+        }
+
+
+def get_alarms(environment_name, queue_name, asg_name, scaling, policy_arns):
+    """the put_metric_alarm arguments that drive the scaling policies"""
+    alarm_names = get_alarm_names(environment_name)
+    period = scaling['period']
+    target = scaling['backlog_per_instance']
+    return [
+        {
+            'AlarmName': alarm_names['backlog-high'],
+            'AlarmDescription': 'Backlog per instance above target',
+            'Metrics': _backlog_metrics(queue_name, asg_name, period),
+            'ComparisonOperator': 'GreaterThanThreshold',
+            'Threshold': target,
+            'EvaluationPeriods': scaling['scale_out_evaluation_periods'],
+            'TreatMissingData': 'notBreaching',
+            'AlarmActions': [policy_arns['scale-out']]
+            },
+        {
+            'AlarmName': alarm_names['age-high'],
+            'AlarmDescription': 'Oldest message older than max_message_age',
+            'Namespace': 'AWS/SQS',
+            'MetricName': 'ApproximateAgeOfOldestMessage',
+            'Dimensions': [{'Name': 'QueueName', 'Value': queue_name}],
+            'Statistic': 'Maximum',
+            'Period': period,
+            'ComparisonOperator': 'GreaterThanThreshold',
+            'Threshold': scaling['max_message_age'],
+            'EvaluationPeriods': scaling['scale_out_evaluation_periods'],
+            'TreatMissingData': 'notBreaching',
+            'AlarmActions': [policy_arns['age-scale-out']]
+            },
+        {
+            'AlarmName': alarm_names['backlog-low'],
+            'AlarmDescription': 'Backlog per instance well below target',
+            'Metrics': _backlog_metrics(queue_name, asg_name, period),
+            'ComparisonOperator': 'LessThanThreshold',
+            'Threshold': target * scaling['scale_in_ratio'],
+            'EvaluationPeriods': scaling['scale_in_evaluation_periods'],
+            'TreatMissingData': 'breaching',
+            'AlarmActions': [policy_arns['scale-in']]
+            },
+        ]
+
+
+def get_environment_asg_name(region, environment_name):
+    eb = get_client('elasticbeanstalk', region)
+    response = eb.describe_environment_resources(EnvironmentName=environment_name)
+    return response['EnvironmentResources']['AutoScalingGroups'][0]['Name']
+
+
+@trace.traced
+def ensure_queue_scaling(region, environment_name, queue_name, scaling):
+    """attach backlog driven scaling policies to an environment's group"""
+    asg_name = get_environment_asg_name(region, environment_name)
+    autoscaling = get_client('autoscaling', region)
+    cloudwatch = get_client('cloudwatch', region)
+    # GroupInServiceInstances is only published once collection is enabled
+    try_client(
+        lambda: autoscaling.enable_metrics_collection(
+            AutoScalingGroupName = asg_name,
+            Metrics = ['GroupInServiceInstances'],
+            Granularity = '1Minute'
+            )
+        )
+    policy_arns = {}
+    for name, policy in get_scaling_policies(asg_name, scaling).items():
+        response = {}
+        try_client(
+            lambda: response.update(autoscaling.put_scaling_policy(**policy))
+            )
+        policy_arns[name] = response['PolicyARN']
+    for alarm in get_alarms(
+                environment_name,
+                queue_name,
+                asg_name,
+                scaling,
+                policy_arns
+                ):
+        try_client(lambda: cloudwatch.put_metric_alarm(**alarm))
+    return asg_name
+
+
+@trace.traced
+def destroy_queue_scaling(region, environment_name):
+    # the scaling policies go away with the group; the alarms do not
+    cloudwatch = get_client('cloudwatch', region)
+    response = cloudwatch.describe_alarms(
+        AlarmNames = list(get_alarm_names(environment_name).values())
+        )
+    alarm_names = [alarm['AlarmName'] for alarm in response['MetricAlarms']]
+    if alarm_names:
+        try:
+            cloudwatch.delete_alarms(AlarmNames=alarm_names)
+        except ClientError as ex:
+            if client_error_code(ex) != RESOURCE_NOT_FOUND:
+                raise(ex)
+
+
+def load_queue_trace(filename):
+    """read (seconds, visible messages, oldest message age) rows from a csv"""
+    samples = []
+    with open(filename) as trace_file:
+        for row in csv.reader(trace_file):
+            if not row or not row[0].replace('.', '', 1).isdigit():
+                continue
+            age = float(row[2]) if len(row) > 2 and row[2] else 0.0
+            samples.append((float(row[0]), float(row[1]), age))
+    return samples
+
+
+def simulate(scaling, samples, min_size, max_size, initial_size=None):
+    """replay a recorded queue trace against the scaling policy
+
+    samples are (seconds, visible messages, oldest message age) tuples, as
+    returned by load_queue_trace, one per alarm period.  The queue depth is
+    replayed as recorded, so the result shows when the policy would have
+    added and removed instances, not how that would have changed the queue.
+    """
+    target = scaling['backlog_per_instance']
+    steps = sorted(scaling['scale_out_steps'])
+    capacity = initial_size or min_size
+    last_scale_out = last_scale_in = None
+    high_periods = low_periods = 0
+    timeline = []
+    for seconds, visible, age in samples:
+        backlog = visible / max(capacity, 1)
+        high = backlog > target or age > scaling['max_message_age']
+        low = backlog < target * scaling['scale_in_ratio']
+        high_periods = high_periods + 1 if high else 0
+        low_periods = low_periods + 1 if low else 0
+        action = None
+        if high_periods >= scaling['scale_out_evaluation_periods'] and (
+                    last_scale_out is None or
+                    seconds - last_scale_out >= scaling['scale_out_cooldown']
+                    ):
+            # an old message alone adds one instance
+            adjustment = 1
+            for lower, step_adjustment in steps:
+                if backlog - target >= lower * target:
+                    adjustment = max(adjustment, step_adjustment)
+            new_capacity = min(capacity + adjustment, max_size)
+            if new_capacity != capacity:
+                action = '+{}'.format(new_capacity - capacity)
+                capacity = new_capacity
+                last_scale_out = seconds
+        elif low_periods >= scaling['scale_in_evaluation_periods'] and (
+                    last_scale_in is None or
+                    seconds - last_scale_in >= scaling['scale_in_cooldown']
+                    ) and capacity > min_size:
+            capacity -= 1
+            action = '-1'
+            last_scale_in = seconds
+        timeline.append({
+            'seconds': seconds,
+            'visible': visible,
+            'age': age,
+            'backlog_per_instance': backlog,
+            'capacity': capacity,
+            'action': action
+            })
+    return timeline
+
+
+def format_simulation(timeline):
+    lines = ['{:>8} {:>9} {:>7} {:>9} {:>8} {:>6}'.format(
+        'seconds', 'visible', 'age', 'backlog', 'capacity', 'action'
+        )]
+    for row in timeline:
+        lines.append('{:>8.0f} {:>9.0f} {:>7.0f} {:>9.1f} {:>8} {:>6}'.format(
+            row['seconds'],
+            row['visible'],
+            row['age'],
+            row['backlog_per_instance'],
+            row['capacity'],
+            row['action'] or ''
+            ))
+    if len(timeline) > 1:
+        instance_seconds = sum(
+            row['capacity'] * (next_row['seconds'] - row['seconds'])
+            for row, next_row in zip(timeline, timeline[1:])
+            )
+        lines.append('peak capacity {}, {:.1f} instance hours'.format(
+            max(row['capacity'] for row in timeline),
+            instance_seconds / 3600
+            ))
+    return '\n'.join(lines)
@@ -0,0 +1,227 @@
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from hashlib import sha1
+import json
+import logging
+import os
+from threading import BoundedSemaphore, Lock
+from time import time
+
+from bosscat import settings
+from bosscat.utils import get_client
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_SIZE = 4
+DEFAULT_ACQUIRE_TIMEOUT = 30
+DEFAULT_MAX_LIFETIME = 1800
+# connections idle for longer than this are pinged before they are used
+DEFAULT_PING_IDLE_SECONDS = 30
+DEFAULT_SECRETS_CHECK_SECONDS = 300
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class PoolNotConfigured(Exception):
+    pass
+
+
+@lru_cache()
+def get_endpoint():
+    """(address, port) of the deployment's rds instance, once per process"""
+    # the instance lives in the primary region of a multi-region deployment
+    rds = get_client(
+        'rds',
+        getattr(settings, 'BOSSCAT_RDS_REGION', settings.DEPLOYMENT_REGION)
+        )
+    response = rds.describe_db_instances(
+        DBInstanceIdentifier = settings.BOSSCAT_RDS_INSTANCE_IDENTIFIER
+        )
+    endpoint = response['DBInstances'][0]['Endpoint']
+    return endpoint['Address'], endpoint['Port']
+
+
+def _secrets_digest(secrets):
+    return sha1(json.dumps(secrets, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ConnectionPool(object):
+    """a bounded pool of db-api connections for one process
+
+    connect(host, port) opens a connection with any db-api driver and should
+    read its credentials from settings, so that connections opened after a
+    secrets rotation use the new ones.  Connections are closed when they
+    outlive max_lifetime, pinged when they have been idle, and dropped
+    without being closed in a forked child, whose parent still uses them.
+    """
+
+    def __init__(
+                self,
+                connect,
+                max_size = DEFAULT_MAX_SIZE,
+                acquire_timeout = DEFAULT_ACQUIRE_TIMEOUT,
+                max_lifetime = DEFAULT_MAX_LIFETIME,
+                ping_idle_seconds = DEFAULT_PING_IDLE_SECONDS,
+                ping_sql = 'SELECT 1',
+                secrets_check_seconds = DEFAULT_SECRETS_CHECK_SECONDS
+                ):
+        self.connect = connect
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_idle_seconds = ping_idle_seconds
+        self.ping_sql = ping_sql
+        self.secrets_check_seconds = secrets_check_seconds
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = Lock()
+        self.slots = BoundedSemaphore(self.max_size)
+        # idle entries are (connection, opened time, last used time, generation)
+        self.idle = deque()
+        self.generation = 0
+        self.secrets_lock = Lock()
+        self.secrets_digest = None
+        self.secrets_checked = None
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # the inherited sockets belong to the parent; closing them
+            #   here would end the parent's sessions
+            self._reset()
+
+    def _secrets_check_due(self):
+        # one acquire per secrets_check_seconds claims the check, whether
+        #   or not it succeeds; the others go on without waiting for it
+        if not self.secrets_check_seconds:
+            return False
+        with self.lock:
+            now = time()
+            if self.secrets_checked is not None and \
+                    now - self.secrets_checked <= self.secrets_check_seconds:
+                return False
+            self.secrets_checked = now
+            return True
+
+    def check_secrets(self):
+        """reload the deployment secrets; retire connections if they changed"""
+        retired = []
+        with self.secrets_lock:
+            digest = _secrets_digest(settings.reload_secrets())
+            with self.lock:
+                self.secrets_checked = time()
+                if self.secrets_digest is not None and \
+                        digest != self.secrets_digest:
+                    self.generation += 1
+                    retired, self.idle = list(self.idle), deque()
+                self.secrets_digest = digest
+        for connection, opened, used, generation in retired:
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _usable(self, entry, now):
+        connection, opened, used, generation = entry
+        if generation != self.generation or now - opened > self.max_lifetime:
+            return False
+        if now - used > self.ping_idle_seconds:
+            try:
+                cursor = connection.cursor()
+                cursor.execute(self.ping_sql)
+                cursor.fetchall()
+                cursor.close()
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        """return (connection, opened time, generation) for release"""
+        self._check_fork()
+        # the first check records the secrets the process started with
+        if self._secrets_check_due():
+            try:
+                self.check_secrets()
+            except Exception:
+                # a failed reload must not fail the request; the current
+                #   connections stay in use until the next check
+                logger.exception('reloading the deployment secrets failed')
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise PoolExhausted('no connection free after {}s'.format(
+                self.acquire_timeout
+                ))
+        try:
+            while True:
+                with self.lock:
+                    entry = self.idle.pop() if self.idle else None
+                if entry is None:
+                    host, port = get_endpoint()
+                    return self.connect(host, port), time(), self.generation
+                if self._usable(entry, time()):
+                    return entry[0], entry[1], entry[3]
+                self._close(entry[0])
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection, opened, generation, broken=False):
+        now = time()
+        if self.pid != os.getpid():
+            return
+        try:
+            if broken or generation != self.generation or \
+                    now - opened > self.max_lifetime:
+                self._close(connection)
+            else:
+                with self.lock:
+                    self.idle.append((connection, opened, now, generation))
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        """a pooled connection; commit on success, roll back on error"""
+        connection, opened, generation = self.acquire()
+        try:
+            yield connection
+            connection.commit()
+        except BaseException:
+            broken = False
+            try:
+                connection.rollback()
+            except Exception:
+                broken = True
+            self.release(connection, opened, generation, broken)
+            raise
+        self.release(connection, opened, generation)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for connection, opened, used, generation in idle:
+            self._close(connection)
+
+
+pool = None
+
+
+def configure(connect, **options):
+    """set up the process pool; options are those of ConnectionPool"""
+    global pool
+    pool = ConnectionPool(connect, **options)
+    return pool
+
+
+def connection():
+    if pool is None:
+        raise PoolNotConfigured('call bosscat.db.configure(connect) first')
+    return pool.connection()
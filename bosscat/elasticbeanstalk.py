@@ -1,16 +1,32 @@
 import os
+import shutil
 import subprocess
+import tempfile
+from time import sleep, time
 
-import boto3
 from botocore.exceptions import ClientError
 
-from bosscat.s3 import upload_local_file_to_bucket
-from bosscat.utils import client_error_code, getenv, try_client
+from bosscat import trace, tuning, wheelhouse as wheelhouses
+from bosscat.s3 import object_exists, upload_stream
+from bosscat.utils import client_error_code, get_client, getenv, try_client
 
 
 INVALID_PARAMETER_VALUE = 'InvalidParameterValue'
 
 
+ENVIRONMENT_NAMESPACE = 'aws:elasticbeanstalk:application:environment'
+DEFAULT_DEPLOYMENT_POLICY = 'Rolling'
+DEFAULT_POLL_SECONDS = 20
+DEFAULT_WAIT_TIMEOUT = 3600
+# blue/green keeps the old environment this long after the cname swap, so
+#   that clients holding the old address (eb cnames have a 60s ttl) drain
+DEFAULT_DRAIN_SECONDS = 120
+
+
+class EnvironmentNotHealthy(Exception):
+    pass
+
+
 webhead_tier_dict = {
     'Name': 'WebServer',
     'Type': 'Standard'
@@ -23,6 +39,50 @@ worker_tier_dict = {
     }
 
 
+class GitArchiveStream(object):
+    """read the zip output of git archive without writing it to disk"""
+
+    def __init__(self, git_ref, add_files=[], add_prefix='', replace_files=[]):
+        self.git_ref = git_ref
+        # untracked files go in under add_prefix; the tree itself is
+        #   archived at the top level, where replace_files take the place
+        #   of the tracked files with the same names
+        args = ['git', 'archive', '--format=zip']
+        if add_files:
+            args.append('--prefix={}'.format(add_prefix))
+            args.extend('--add-file={}'.format(path) for path in add_files)
+            args.append('--prefix=')
+        args.extend('--add-file={}'.format(path) for path in replace_files)
+        args.append(git_ref)
+        if replace_files:
+            args.extend(['--', '.'])
+            args.extend(
+                ':(exclude){}'.format(os.path.basename(path))
+                for path in replace_files
+                )
+        self.proc = subprocess.Popen(
+            args,
+            stdout = subprocess.PIPE
+            )
+
+    def read(self, size=-1):
+        if self.proc.stdout.closed:
+            return b''
+        data = self.proc.stdout.read(size)
+        if not data:
+            # fail the read at the end of the output if git failed, so
+            #   that a truncated archive is never completed in s3
+            self.proc.stdout.close()
+            returncode = self.proc.wait()
+            if returncode:
+                raise subprocess.CalledProcessError(
+                    returncode,
+                    'git archive {}'.format(self.git_ref)
+                    )
+        return data
+
+
+@trace.traced
 def create_application_version(
             region,
             app_id,
@@ -30,20 +90,30 @@ def create_application_version(
             bundle_name,
             bundle_description
             ):
-    eb = boto3.client('elasticbeanstalk', region)
-    try_client(
-        lambda: eb.create_application_version(
-            ApplicationName = app_id,
-            VersionLabel = bundle_name,
-            Description = bundle_description,
-            SourceBundle = {
-                'S3Bucket': source_bucket_name,
-                'S3Key': '{}/{}.zip'.format(app_id, bundle_name)
-                }
+    """create the version unless it exists; return whether it was created"""
+    eb = get_client('elasticbeanstalk', region)
+    try:
+        return try_client(
+            lambda: eb.create_application_version(
+                ApplicationName = app_id,
+                VersionLabel = bundle_name,
+                Description = bundle_description,
+                SourceBundle = {
+                    'S3Bucket': source_bucket_name,
+                    'S3Key': '{}/{}.zip'.format(app_id, bundle_name)
+                    }
+                )
             )
-        )
+    except ClientError as ex:
+        # an existing version is reported as an invalid parameter, as are
+        #   real validation errors; a tier that created it first wins
+        if client_error_code(ex) != INVALID_PARAMETER_VALUE or \
+                not application_version_exists(region, app_id, bundle_name):
+            raise
+        return False
 
 
+@trace.traced
 def create_environment(
             region,
             app_id,
@@ -57,7 +127,7 @@ def create_environment(
         tier_dict = worker_tier_dict
     else:
         tier_dict = webhead_tier_dict
-    eb = boto3.client('elasticbeanstalk', region)
+    eb = get_client('elasticbeanstalk', region)
     try_client(
         lambda: eb.create_environment(
             ApplicationName = app_id,
@@ -67,12 +137,168 @@ def create_environment(
             OptionSettings = option_settings,
             Tier = tier_dict,
             Tags = [{'Key': 'bosscat', 'Value': environment_name}]
+            ),
+        # an instance profile just created is unknown to elastic beanstalk
+        #   for a while
+        eventual = [INVALID_PARAMETER_VALUE]
+        )
+
+
+@trace.traced
+def update_environment(
+            region,
+            environment_name,
+            version_label = None,
+            option_settings = None,
+            options_to_remove = None
+            ):
+    eb = get_client('elasticbeanstalk', region)
+    kwargs = {'EnvironmentName': environment_name}
+    if version_label:
+        kwargs['VersionLabel'] = version_label
+    if option_settings:
+        kwargs['OptionSettings'] = option_settings
+    if options_to_remove:
+        kwargs['OptionsToRemove'] = options_to_remove
+    try_client(lambda: eb.update_environment(**kwargs))
+
+
+@trace.traced
+def swap_environment_cnames(
+            region,
+            source_environment_name,
+            destination_environment_name
+            ):
+    eb = get_client('elasticbeanstalk', region)
+    try_client(
+        lambda: eb.swap_environment_cnames(
+            SourceEnvironmentName = source_environment_name,
+            DestinationEnvironmentName = destination_environment_name
+            )
+        )
+
+
+def get_environment(region, environment_name):
+    """describe a live (not terminating or terminated) environment or None"""
+    eb = get_client('elasticbeanstalk', region)
+    response = eb.describe_environments(
+        EnvironmentNames = [environment_name],
+        IncludeDeleted = False
+        )
+    for environment in response['Environments']:
+        if environment['Status'] not in ('Terminating', 'Terminated'):
+            return environment
+    return None
+
+
+def get_configuration_settings(region, app_id, environment_name):
+    """the environment's option values by (namespace, option name)"""
+    eb = get_client('elasticbeanstalk', region)
+    response = eb.describe_configuration_settings(
+        ApplicationName = app_id,
+        EnvironmentName = environment_name
+        )
+    return dict(
+        ((option['Namespace'], option['OptionName']), option.get('Value'))
+        for settings in response['ConfigurationSettings']
+        for option in settings['OptionSettings']
+        )
+
+
+def get_environment_variable_names(region, app_id, environment_name):
+    return set(
+        option_name
+        for namespace, option_name in get_configuration_settings(
+            region,
+            app_id,
+            environment_name
             )
+        if namespace == ENVIRONMENT_NAMESPACE
+        )
+
+
+def get_changed_options(current_settings, option_settings):
+    """the option settings whose values differ from current_settings"""
+    # eb reports every value as a string
+    return [
+        option for option in option_settings
+        if current_settings.get((option['Namespace'], option['OptionName'])) !=
+            str(option['Value'])
+        ]
+
+
+@trace.traced
+def wait_for_environment(
+            region,
+            environment_name,
+            alert,
+            require_healthy = False,
+            poll_seconds = DEFAULT_POLL_SECONDS,
+            timeout = DEFAULT_WAIT_TIMEOUT
+            ):
+    """poll until the environment is Ready (and Green if require_healthy)"""
+    stime = time()
+    while True:
+        environment = get_environment(region, environment_name)
+        if environment is None:
+            raise EnvironmentNotHealthy(
+                '{} does not exist'.format(environment_name)
+                )
+        elapsed = int(time() - stime)
+        alert('{:02d}:{:02d} -- {} status: {}, health: {}'.format(
+            int(elapsed / 60),
+            elapsed % 60,
+            environment_name,
+            environment['Status'],
+            environment.get('Health')
+            ))
+        if environment['Status'] == 'Ready':
+            if not require_healthy or environment.get('Health') == 'Green':
+                return environment
+            if environment.get('Health') == 'Red':
+                raise EnvironmentNotHealthy(
+                    '{} is Ready but Red'.format(environment_name)
+                    )
+        if time() - stime > timeout:
+            raise EnvironmentNotHealthy(
+                '{} timed out with status {}, health {}'.format(
+                    environment_name,
+                    environment['Status'],
+                    environment.get('Health')
+                    )
+                )
+        sleep(poll_seconds)
+
+
+def application_version_exists(region, app_id, version_label):
+    eb = get_client('elasticbeanstalk', region)
+    response = eb.describe_application_versions(
+        ApplicationName = app_id,
+        VersionLabels = [version_label]
         )
+    return bool(response['ApplicationVersions'])
 
 
+def get_version_label(git_ref='HEAD', wheelhouse=None):
+    # application versions are labeled by the tree hash of their bundle,
+    #   plus the wheelhouse hash when wheels are bundled with the tree
+    if not wheelhouse:
+        return get_git_tree(git_ref)
+    return '{}-{}'.format(
+        get_git_tree(git_ref),
+        wheelhouses.get_wheelhouse_hash(wheelhouse, git_ref)[:12]
+        )
+
+
+def get_git_tree(git_ref='HEAD'):
+    return subprocess.check_output(
+        ['git', 'rev-parse', '{}^{{tree}}'.format(git_ref)]
+        ).decode().strip()
+
+
+@trace.traced
 def destroy_environment(environment_name, region):
-    eb = boto3.client('elasticbeanstalk', region)
+    eb = get_client('elasticbeanstalk', region)
     try:
         eb.terminate_environment(EnvironmentName=environment_name)
     except ClientError as ex:
@@ -80,8 +306,18 @@ def destroy_environment(environment_name, region):
             raise(ex)
 
 
+def get_worker_queue_name(config):
+    # the configured queue name carries the .fifo suffix of a fifo queue
+    for queue in config.get('queues', []):
+        if queue.get('nametip') == 'bosscat-mq' and queue.get('name'):
+            return queue['name']
+    return '{}-{}'.format(config['deployment_name'], 'bosscat-mq')
+
+
 def get_eb_option_settings(config, tier):
     eb = config[tier]
+    if tier == 'worker' and eb.get('sqsd_tuning'):
+        eb = tuning.apply_worker_tuning(config['deployment_region'], eb)
     environment_dict = getenv(config, tier)
     environment_dict.update(config['environment'])
     option_dict = {
@@ -109,22 +345,42 @@ def get_eb_option_settings(config, tier):
             "MinSize": eb['minimum_instance_count'],
             "MaxSize": eb['maximum_instance_count']
             },
+        "aws:elasticbeanstalk:command": {
+            "DeploymentPolicy": eb.get(
+                                    'deployment_policy',
+                                    DEFAULT_DEPLOYMENT_POLICY
+                                    )
+            },
         "aws:elasticbeanstalk:application:environment": environment_dict
         }
+    if eb.get('batch_size'):
+        option_dict["aws:elasticbeanstalk:command"].update({
+            "BatchSizeType": eb.get('batch_size_type', 'Percentage'),
+            "BatchSize": eb['batch_size']
+            })
     if tier == 'worker':
-        queue_name = '{}-{}'.format(
-                config['deployment_name'],
-                'bosscat-mq'
-                )
         option_dict["aws:elasticbeanstalk:sqsd"] = {
             "WorkerQueueURL": 'https://sqs.{}.amazonaws.com/{}/{}'.format(
                                             config['deployment_region'],
                                             config['account_id'],
-                                            queue_name
+                                            get_worker_queue_name(config)
                                             ),
             "HttpPath": eb['receive_url'],
             "MimeType": "text/plain",
             }
+        option_dict["aws:elasticbeanstalk:sqsd"].update(
+            tuning.get_sqsd_options(eb)
+            )
+    if eb.get('queue_scaling'):
+        # the queue backlog alarms drive scaling; keep the default trigger
+        #   only as a guard against pegged cpus and never scale in on it
+        option_dict["aws:autoscaling:trigger"] = {
+            "MeasureName": "CPUUtilization",
+            "Statistic": "Average",
+            "Unit": "Percent",
+            "UpperThreshold": 90,
+            "LowerThreshold": 0
+            }
     option_settings = []
     for namespace_item in option_dict.items():
         for option_item in namespace_item[1].items():
@@ -137,30 +393,53 @@ def get_eb_option_settings(config, tier):
     return option_settings
 
 
+@trace.traced
 def upload_local_git_branch(
             region,
             app_id,
             source_bucket_name,
-            tmp_dir,
-            bundle_name
+            git_ref = 'HEAD',
+            wheelhouse = None
             ):
-    filename = os.path.join(tmp_dir, '{}.zip'.format(bundle_name))
-    subprocess.call(['git', 'archive', '-o', filename, 'HEAD'])
-    git_log_proc = subprocess.Popen(['git', 'log', '-n', '1'], stdout=subprocess.PIPE)
-    try:
-        upload_local_file_to_bucket(
-            filename,
-            source_bucket_name,
-            '{}/{}.zip'.format(app_id, bundle_name)
-            )
-    finally:
-        os.unlink(filename)
+    """upload the bundle for git_ref unless it exists; return its version label"""
+    # bundles are named by their git tree hash, so a tree that has been
+    #   uploaded before (by any tier or deployment tag) is reused as is
+    bundle_name = get_version_label(git_ref, wheelhouse)
+    bundle_key = '{}/{}.zip'.format(app_id, bundle_name)
+    if not object_exists(source_bucket_name, bundle_key):
+        wheels = []
+        replace_files = []
+        build_dir = tempfile.mkdtemp()
+        try:
+            if wheelhouse:
+                wheels = wheelhouses.build_wheelhouse(wheelhouse, git_ref)
+                requirements_filename = os.path.join(
+                    build_dir,
+                    wheelhouses.BUNDLE_REQUIREMENTS
+                    )
+                with open(requirements_filename, 'wb') as requirements_file:
+                    requirements_file.write(
+                        wheelhouses.get_bundle_requirements(wheelhouse, git_ref)
+                        )
+                replace_files.append(requirements_filename)
+            with trace.span('git archive', 'subprocess'):
+                archive = GitArchiveStream(
+                    git_ref,
+                    add_files = wheels,
+                    add_prefix = '{}/'.format(wheelhouses.BUNDLE_DIRECTORY),
+                    replace_files = replace_files
+                    )
+                upload_stream(archive, source_bucket_name, bundle_key)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    git_log = subprocess.check_output(['git', 'log', '-n', '1', git_ref])
     create_application_version(
         region,
         app_id,
         source_bucket_name,
         bundle_name,
-        git_log_proc.stdout.read().decode()[:200]
+        git_log.decode()[:200]
         )
+    return bundle_name
 
 
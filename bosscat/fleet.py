@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+import traceback
+
+from bosscat import elasticbeanstalk, trace, upanddown, utils, wheelhouse
+
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+class BundleCache(object):
+    """share one source bundle upload among deployments of the same tree"""
+
+    def __init__(self):
+        self.labels = {}
+        self.locks = {}
+        self.lock = Lock()
+
+    def get_label(self, config, alert):
+        key = (
+            config['deployment_region'],
+            config['app_id'],
+            elasticbeanstalk.get_version_label(
+                config.get('git_ref', 'HEAD'),
+                wheelhouse.get_wheelhouse(config)
+                )
+            )
+        with self.lock:
+            key_lock = self.locks.setdefault(key, Lock())
+        # only the first deployment of a tree checks and uploads the
+        #   bundle; the others wait for it and reuse its version label
+        with key_lock:
+            if key not in self.labels:
+                self.labels[key] = upanddown.up_bundle(config, alert)
+            else:
+                alert('Reusing source bundle {}'.format(self.labels[key]))
+            return self.labels[key]
+
+
+def deployment_name(config):
+    return '{}-{}-{}'.format(
+        config['app_id'],
+        config['deployment_delta'],
+        config['deployment_tag']
+        )
+
+
+def down(
+            configs,
+            alert,
+            max_concurrency = DEFAULT_MAX_CONCURRENCY,
+            trace_file = None
+            ):
+    return _run_fleet(
+        lambda config, alert: upanddown.down(config, alert),
+        'down',
+        configs,
+        alert,
+        max_concurrency,
+        trace_file
+        )
+
+
+def up(
+            configs,
+            alert,
+            max_concurrency = DEFAULT_MAX_CONCURRENCY,
+            trace_file = None
+            ):
+    bundle_cache = BundleCache()
+    return _run_fleet(
+        lambda config, alert: upanddown.up(config, alert, bundle_cache),
+        'up',
+        configs,
+        alert,
+        max_concurrency,
+        trace_file
+        )
+
+
+def format_report(report):
+    lines = []
+    for entry in report:
+        line = '{:<8} {:<48} {:>8.1f}s'.format(
+            entry['status'],
+            entry['deployment_name'],
+            entry['seconds']
+            )
+        if entry['error']:
+            line = '{}  {}'.format(line, entry['error'])
+        lines.append(line)
+    failed = len([entry for entry in report if entry['status'] != 'ok'])
+    lines.append('{} deployments, {} failed'.format(len(report), failed))
+    return '\n'.join(lines)
+
+
+def _run_fleet(
+            action,
+            action_name,
+            configs,
+            alert,
+            max_concurrency,
+            trace_file
+            ):
+    def run_one(config):
+        name = deployment_name(config)
+        alerts = []
+        def deployment_alert(message):
+            alerts.append(message)
+            alert('[{}] {}'.format(name, message))
+        entry = {
+            'deployment_name': name,
+            'action': action_name,
+            'status': 'ok',
+            'error': None,
+            'alerts': alerts
+            }
+        stime = time()
+        try:
+            action(config, deployment_alert)
+        except Exception as ex:
+            entry['status'] = 'failed'
+            entry['error'] = repr(ex)
+            entry['traceback'] = traceback.format_exc()
+            alert('[{}] {} failed: {!r}'.format(name, action_name, ex))
+        entry['seconds'] = time() - stime
+        return entry
+    with trace.recording(trace_file, alert), trace.span(
+                'fleet.{}'.format(action_name)
+                ):
+        # resolve the account id once; configure() reuses the cached value
+        #   for every deployment in the fleet
+        utils.get_account_id()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            report = list(executor.map(trace.bind(run_one), configs))
+    return report
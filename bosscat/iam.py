@@ -1,10 +1,10 @@
+from collections import OrderedDict
 from copy import deepcopy
 import json
 
-import boto3
 from botocore.exceptions import ClientError
 
-from bosscat import utils
+from bosscat import trace, utils
 
 
 ENTITY_ALREADY_EXISTS = 'EntityAlreadyExists'
@@ -12,6 +12,18 @@ MALFORMED_POLICY = 'MalformedPolicy'
 NO_SUCH_ENTITY = 'NoSuchEntity'
 
 
+# iam counts policy sizes without whitespace; inline policies share one
+#   limit per role, managed policies have their own
+INLINE_POLICY_SIZE_LIMIT = 10240
+MANAGED_POLICY_SIZE_LIMIT = 6144
+MAX_MANAGED_POLICIES = 10
+MAX_POLICY_VERSIONS = 5
+
+
+class PolicyTooLarge(Exception):
+    pass
+
+
 BASE_INLINE_POLICY_DOCUMENT = {
     "Version": "2012-10-17",
     "Statement": [
@@ -72,7 +84,7 @@ DEFAULT_ASSUME_ROLE_POLICY_DOCUMENT = {
 
 
 def get_inline_policy_document(config):
-    aws_account_id = utils.get_account_id()
+    aws_account_id = config['account_id']
     ipd = deepcopy(BASE_INLINE_POLICY_DOCUMENT)
     ipd_statement = ipd["Statement"]
     ipd_statement.append({
@@ -92,16 +104,16 @@ def get_inline_policy_document(config):
                 ]
             }
         ipd_statement.append(statement)
+    # queues and topics exist once in each of their regions
     for queue in config.get("queues", []):
         statement = {
             "Sid": "QueueAccess{}".format(queue['name_camel']),
             "Effect": "Allow",
             "Action": "sqs:*",
-            "Resource": utils.get_queue_arn(
-                            queue["region"],
-                            aws_account_id,
-                            queue["name"]
-                            ),
+            "Resource": _one_or_list([
+                utils.get_queue_arn(region, aws_account_id, queue["name"])
+                for region in queue.get("regions", [queue["region"]])
+                ]),
             }
         ipd_statement.append(statement)
         dlq = queue.get("dead_letter_queue")
@@ -110,11 +122,10 @@ def get_inline_policy_document(config):
                 "Sid": "QueueAccess{}".format(dlq['name_camel']),
                 "Effect": "Allow",
                 "Action": "sqs:*",
-                "Resource": utils.get_queue_arn(
-                                queue["region"],
-                                aws_account_id,
-                                dlq["name"]
-                                ),
+                "Resource": _one_or_list([
+                    utils.get_queue_arn(region, aws_account_id, dlq["name"])
+                    for region in queue.get("regions", [queue["region"]])
+                    ]),
                 }
             ipd_statement.append(statement)
     for topic in config.get("topics", []):
@@ -122,18 +133,187 @@ def get_inline_policy_document(config):
             "Sid": "TopicPublishAccess{}".format(topic['name_camel']),
             "Effect": "Allow",
             "Action": "sns:Publish",
-            "Resource": utils.get_topic_arn(
-                            topic["region"],
-                            aws_account_id,
-                            topic["name"]
-                            ),
+            "Resource": _one_or_list([
+                utils.get_topic_arn(region, aws_account_id, topic["name"])
+                for region in topic.get("regions", [topic["region"]])
+                ]),
             }
         ipd_statement.append(statement)
     return ipd
 
 
+def get_policy_size(document):
+    return len(json.dumps(document, separators=(',', ':')))
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, list) else [value]
+
+
+def _one_or_list(values):
+    return values[0] if len(values) == 1 else values
+
+
+def _policy_document(statements):
+    return {"Version": "2012-10-17", "Statement": statements}
+
+
+def merge_statements(statements):
+    """merge statements with the same effect, actions and condition"""
+    groups = OrderedDict()
+    for statement in statements:
+        key = (
+            statement['Effect'],
+            tuple(sorted(_as_list(statement['Action']))),
+            json.dumps(statement.get('Condition'), sort_keys=True)
+            )
+        groups.setdefault(key, []).append(statement)
+    merged = []
+    for index, ((effect, actions, condition), group) in enumerate(groups.items()):
+        resources = []
+        for statement in group:
+            for resource in _as_list(statement['Resource']):
+                if resource not in resources:
+                    resources.append(resource)
+        if len(group) == 1 and group[0].get('Sid'):
+            sid = group[0]['Sid']
+        else:
+            sid = 'Merged{}'.format(index)
+        statement = {
+            'Sid': sid,
+            'Effect': effect,
+            'Action': _one_or_list(list(actions)),
+            'Resource': _one_or_list(resources)
+            }
+        if group[0].get('Condition'):
+            statement['Condition'] = group[0]['Condition']
+        merged.append(statement)
+    return merged
+
+
+def collapse_resources(statements, resource_prefix):
+    """replace resources named resource_prefix... with one wildcard each
+
+    A wildcard also covers resources of other deployments whose names start
+    with resource_prefix, so pass a prefix that no other deployment uses.
+    """
+    collapsed = []
+    for statement in statements:
+        resources = []
+        for resource in _as_list(statement['Resource']):
+            # arn:partition:service:region:account:resource
+            arn_parts = resource.split(':', 5)
+            if len(arn_parts) == 6 and arn_parts[5].startswith(resource_prefix):
+                resource = '{}:{}*'.format(
+                    ':'.join(arn_parts[:5]),
+                    resource_prefix
+                    )
+            if resource not in resources:
+                resources.append(resource)
+        collapsed.append(dict(statement, Resource=_one_or_list(resources)))
+    return collapsed
+
+
+def _split_statement(statement, size_limit):
+    # halve the resources of a statement until each part fits
+    if get_policy_size(_policy_document([statement])) <= size_limit:
+        return [statement]
+    resources = _as_list(statement['Resource'])
+    if len(resources) < 2:
+        return [statement]
+    middle = len(resources) // 2
+    parts = []
+    for index, part in enumerate((resources[:middle], resources[middle:])):
+        parts.extend(_split_statement(
+            dict(
+                statement,
+                Sid = '{}Part{}'.format(statement.get('Sid', ''), index),
+                Resource = _one_or_list(part)
+                ),
+            size_limit
+            ))
+    return parts
+
+
+def _pack_statements(statements, size_limit):
+    documents = []
+    for statement in statements:
+        for part in _split_statement(statement, size_limit):
+            if documents and get_policy_size(
+                        _policy_document(documents[-1] + [part])
+                        ) <= size_limit:
+                documents[-1].append(part)
+            else:
+                documents.append([part])
+    return [_policy_document(document) for document in documents]
+
+
+def format_policy_report(document, size_limit=INLINE_POLICY_SIZE_LIMIT):
+    lines = ['policy size {} of {} characters'.format(
+        get_policy_size(document),
+        size_limit
+        )]
+    for statement in sorted(
+                document['Statement'],
+                key = lambda statement: -get_policy_size(statement)
+                ):
+        lines.append('{:>7} {:<40} {} resources'.format(
+            get_policy_size(statement),
+            statement.get('Sid', ''),
+            len(_as_list(statement['Resource']))
+            ))
+    return '\n'.join(lines)
+
+
+def compile_policy(
+            document,
+            resource_prefix = None,
+            inline_size_limit = INLINE_POLICY_SIZE_LIMIT,
+            managed_size_limit = MANAGED_POLICY_SIZE_LIMIT,
+            max_managed_policies = MAX_MANAGED_POLICIES
+            ):
+    """compact a policy document to fit iam; return a list of documents
+
+    Statements that share actions are merged first.  If the result is too
+    large for an inline policy, resources starting with resource_prefix
+    are collapsed into wildcards, and then the statements are split over
+    managed policies.  Raises PolicyTooLarge, with a size report, when even
+    max_managed_policies policies cannot hold the statements, before any
+    call to iam.
+    """
+    statements = merge_statements(document['Statement'])
+    if get_policy_size(_policy_document(statements)) <= inline_size_limit:
+        return [_policy_document(statements)]
+    if resource_prefix:
+        statements = merge_statements(
+            collapse_resources(statements, resource_prefix)
+            )
+        if get_policy_size(_policy_document(statements)) <= inline_size_limit:
+            return [_policy_document(statements)]
+    documents = _pack_statements(statements, managed_size_limit)
+    too_large = [
+        document for document in documents
+        if get_policy_size(document) > managed_size_limit
+        ]
+    if len(documents) > max_managed_policies or too_large:
+        raise PolicyTooLarge(
+            'the role policy needs {} managed policies of at most {} '
+            'characters, {} allowed\n{}'.format(
+                len(documents),
+                managed_size_limit,
+                max_managed_policies,
+                format_policy_report(
+                    _policy_document(statements),
+                    managed_size_limit * max_managed_policies
+                    )
+                )
+            )
+    return documents
+
+
+@trace.traced
 def ensure_instance_profile(instance_profile_name, role_name):
-    client = boto3.client('iam')
+    client = utils.get_client('iam')
     created = utils.try_client(
         lambda: client.create_instance_profile(
             InstanceProfileName = instance_profile_name
@@ -149,13 +329,21 @@ def ensure_instance_profile(instance_profile_name, role_name):
             )
 
 
+@trace.traced
 def ensure_role(
             role_name,
             policy_name,
             policy_document,
             assume_role_policy_document = DEFAULT_ASSUME_ROLE_POLICY_DOCUMENT
             ):
-    client = boto3.client('iam')
+    """create the role and give it policy_document
+
+    policy_document may be a list of documents from compile_policy; a list
+    of more than one is attached as managed policies named policy_name-N.
+    """
+    client = utils.get_client('iam')
+    documents = policy_document if isinstance(policy_document, list) \
+        else [policy_document]
     utils.try_client(
         lambda: client.create_role(
             RoleName = role_name,
@@ -163,17 +351,120 @@ def ensure_role(
             ),
         ignore = [ENTITY_ALREADY_EXISTS]
         )
-    utils.try_client(
-        lambda: client.put_role_policy(
-            RoleName = role_name,
+    managed_policy_arns = []
+    if len(documents) == 1:
+        utils.try_client(
+            lambda: client.put_role_policy(
+                RoleName = role_name,
+                PolicyName = policy_name,
+                PolicyDocument = json.dumps(documents[0])
+                )
+            )
+    else:
+        for index, document in enumerate(documents):
+            policy_arn = ensure_managed_policy(
+                '{}-{}'.format(policy_name, index + 1),
+                document
+                )
+            utils.try_client(
+                lambda: client.attach_role_policy(
+                    RoleName = role_name,
+                    PolicyArn = policy_arn
+                    )
+                )
+            managed_policy_arns.append(policy_arn)
+        utils.try_client(
+            lambda: client.delete_role_policy(
+                RoleName = role_name,
+                PolicyName = policy_name
+                ),
+            ignore = [NO_SUCH_ENTITY]
+            )
+    # drop the managed policies of an earlier, larger policy
+    for policy in list_attached_role_policies(role_name):
+        if is_policy_part(policy['PolicyName'], policy_name) and \
+                policy['PolicyArn'] not in managed_policy_arns:
+            detach_and_delete_policy(role_name, policy['PolicyArn'])
+
+
+def is_policy_part(name, policy_name):
+    """whether name is one of the policy_name-N policies of ensure_role"""
+    prefix = '{}-'.format(policy_name)
+    return name.startswith(prefix) and name[len(prefix):].isdigit()
+
+
+def get_policy_arn(policy_name):
+    return 'arn:aws:iam::{}:policy/{}'.format(utils.get_account_id(), policy_name)
+
+
+@trace.traced
+def ensure_managed_policy(policy_name, policy_document):
+    """create or update a managed policy; return its arn"""
+    client = utils.get_client('iam')
+    policy_arn = get_policy_arn(policy_name)
+    created = utils.try_client(
+        lambda: client.create_policy(
             PolicyName = policy_name,
             PolicyDocument = json.dumps(policy_document)
-            )
+            ),
+        ignore = [ENTITY_ALREADY_EXISTS]
         )
+    if not created:
+        versions = client.list_policy_versions(PolicyArn=policy_arn)['Versions']
+        # a policy keeps at most five versions; make room for the new one
+        old_versions = sorted(
+            (version for version in versions if not version['IsDefaultVersion']),
+            key = lambda version: version['CreateDate']
+            )
+        if len(versions) >= MAX_POLICY_VERSIONS:
+            client.delete_policy_version(
+                PolicyArn = policy_arn,
+                VersionId = old_versions[0]['VersionId']
+                )
+        utils.try_client(
+            lambda: client.create_policy_version(
+                PolicyArn = policy_arn,
+                PolicyDocument = json.dumps(policy_document),
+                SetAsDefault = True
+                )
+            )
+    return policy_arn
+
+
+def list_attached_role_policies(role_name):
+    client = utils.get_client('iam')
+    policies = []
+    kwargs = {'RoleName': role_name}
+    while True:
+        response = client.list_attached_role_policies(**kwargs)
+        policies.extend(response['AttachedPolicies'])
+        if not response.get('IsTruncated'):
+            return policies
+        kwargs['Marker'] = response['Marker']
 
 
+@trace.traced
+def detach_and_delete_policy(role_name, policy_arn):
+    client = utils.get_client('iam')
+    client.detach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+    _delete_policy(policy_arn)
+
+
+def _delete_policy(policy_arn):
+    client = utils.get_client('iam')
+    versions = client.list_policy_versions(PolicyArn=policy_arn)['Versions']
+    for version in versions:
+        if not version['IsDefaultVersion']:
+            client.delete_policy_version(
+                PolicyArn = policy_arn,
+                VersionId = version['VersionId']
+                )
+    client.delete_policy(PolicyArn=policy_arn)
+
+
+@trace.traced
 def destroy_instance_profile(instance_profile_name):
-    client = boto3.client('iam')
+    client = utils.get_client('iam')
     try:
         ip = client.get_instance_profile(InstanceProfileName=instance_profile_name)
         for role in ip['InstanceProfile']['Roles']:
@@ -187,14 +478,27 @@ def destroy_instance_profile(instance_profile_name):
             raise(ex)
 
 
-def destroy_role(role_name):
-    client = boto3.client('iam')
+@trace.traced
+def destroy_role(role_name, policy_name=None):
+    """delete the role, and the policy_name-N policies ensure_role made
+
+    Other managed policies, attached by an operator or owned by aws, are
+    only detached.
+    """
+    client = utils.get_client('iam')
     try:
         for name in client.list_role_policies(RoleName=role_name)['PolicyNames']:
             client.delete_role_policy(
                 RoleName = role_name,
                 PolicyName = name
                 )
+        for policy in list_attached_role_policies(role_name):
+            client.detach_role_policy(
+                RoleName = role_name,
+                PolicyArn = policy['PolicyArn']
+                )
+            if policy_name and is_policy_part(policy['PolicyName'], policy_name):
+                _delete_policy(policy['PolicyArn'])
         client.delete_role(RoleName=role_name)
     except ClientError as ex:
         if utils.client_error_code(ex) != NO_SUCH_ENTITY:
@@ -0,0 +1,467 @@
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+import json
+from random import Random
+from threading import Event, Lock, Thread
+from time import sleep, time
+
+from bosscat import top, upanddown
+from bosscat.utils import get_client
+
+
+DEFAULT_PAYLOAD_BYTES = 1024
+DEFAULT_TASK_SECONDS = 0.1
+DEFAULT_SENDERS = 8
+DEFAULT_DRAIN_SECONDS = 120
+DEFAULT_REPORT_INTERVAL = 10
+# the pickled message is sent base64 encoded and its status is published
+#   as text; both must stay under the 256 KiB limit of sqs and sns
+MAX_PAYLOAD_BYTES = 180000
+SQS_BATCH_SIZE = 10
+# how often the generator sends what has come due, and reads the status
+#   topic for finished tasks
+TICK_SECONDS = 0.05
+POLL_SECONDS = 1.0
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+
+def synthetic_task(payload, seconds, cpu=False):
+    """the task sent by load_test: sleep for seconds, or spin when cpu
+
+    Wrap it for the sender with bosscat_worker(synthetic_task); the worker
+    tier finds it as bosscat.loadtest.synthetic_task.
+    """
+    if not cpu:
+        sleep(seconds)
+        return
+    deadline = time() + seconds
+    while time() < deadline:
+        pass
+
+
+def constant(rate, seconds):
+    """a profile sending rate tasks per second for seconds
+
+    Profiles are lists of (seconds, start_rate, end_rate) stages, so they
+    are joined with +, e.g. ramp(0, 100, 300) + constant(100, 600).
+    """
+    return [(seconds, rate, rate)]
+
+
+def ramp(start_rate, end_rate, seconds):
+    """a profile changing the rate linearly from start_rate to end_rate"""
+    return [(seconds, start_rate, end_rate)]
+
+
+def steps(rates, seconds):
+    """a profile holding each of rates for seconds"""
+    return [(seconds, rate, rate) for rate in rates]
+
+
+def get_rate(profile, elapsed):
+    """the target rate elapsed seconds into profile; None past its end"""
+    for seconds, start_rate, end_rate in profile:
+        if elapsed < seconds:
+            return start_rate + (end_rate - start_rate) * elapsed / float(seconds)
+        elapsed -= seconds
+    return None
+
+
+def _get_sampler(value, random):
+    # a number, or a list of values to pick from for each task
+    if isinstance(value, (list, tuple)):
+        return lambda: random.choice(value)
+    return lambda: value
+
+
+class LocalReceiver(object):
+    """stand-in for sqsd: threads that receive messages from queue_url and
+    hand them to bosscat.async.receive_message
+
+    Use it with a memory.MemoryProvider set through utils.set_provider and
+    settings pointing at the provider's queue and topic.  A message whose
+    task fails is left for its visibility timeout, as sqsd leaves it.
+    """
+
+    def __init__(self, queue_url, region=None, threads=4, visibility_timeout=30):
+        self.queue_url = queue_url
+        self.region = region
+        self.threads = threads
+        self.visibility_timeout = visibility_timeout
+        self.stopping = Event()
+        self.workers = []
+
+    def start(self):
+        receive_message = import_module('bosscat.async').receive_message
+        self.stopping.clear()
+        for index in range(self.threads):
+            worker = Thread(
+                target = self._run,
+                args = [receive_message],
+                name = 'receiver-{}'.format(index)
+                )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _run(self, receive_message):
+        sqs = get_client('sqs', self.region)
+        while not self.stopping.is_set():
+            messages = sqs.receive_message(
+                QueueUrl = self.queue_url,
+                MaxNumberOfMessages = 1,
+                WaitTimeSeconds = 1,
+                VisibilityTimeout = self.visibility_timeout
+                ).get('Messages', [])
+            for message in messages:
+                try:
+                    receive_message(message['Body'].encode('utf-8'))
+                except Exception:
+                    continue
+                sqs.delete_message(
+                    QueueUrl = self.queue_url,
+                    ReceiptHandle = message['ReceiptHandle']
+                    )
+
+    def stop(self):
+        self.stopping.set()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+class LoadResults(object):
+    """the tasks of one load test, matched to their status events
+
+    Events of the worker that were enqueued before the test started belong
+    to earlier runs and are ignored.
+    """
+
+    def __init__(self, worker_key, started):
+        self.worker_key = worker_key
+        self.started = started
+        self.received = {}
+        self.finished = {}
+        self.duplicates = 0
+
+    def add(self, events):
+        for event in sorted(events, key=lambda event: event['time']):
+            if event['worker_key'] != self.worker_key or \
+                    event['enqueued'] is None or \
+                    event['enqueued'] < self.started:
+                continue
+            msg_id = event['msg_id']
+            if event['status'] == 'Received':
+                # the first delivery; a redelivery is counted when it ends
+                self.received.setdefault(msg_id, event['time'])
+            elif event['status'] in ('Complete', 'Failed'):
+                if msg_id in self.finished:
+                    self.duplicates += 1
+                    continue
+                self.finished[msg_id] = {
+                    'status': event['status'],
+                    'enqueued': event['enqueued'],
+                    'received': self.received.get(msg_id, event['time']),
+                    'finished': event['time']
+                    }
+
+    def get_tasks(self):
+        return list(self.finished.values())
+
+
+def _summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    summary = dict(
+        (name, values[min(len(values) - 1, int(fraction * len(values)))])
+        for name, fraction in PERCENTILES
+        )
+    summary['mean'] = sum(values) / len(values)
+    summary['max'] = values[-1]
+    return summary
+
+
+def make_report(
+            label,
+            settings,
+            worker_key,
+            profile,
+            started,
+            send_times,
+            counts,
+            tasks,
+            interval = DEFAULT_REPORT_INTERVAL
+            ):
+    """the report of a load test as a json serializable dict
+
+    Latency is measured from the enqueue timestamp in each message's
+    envelope: end_to_end until its Complete or Failed status, queue_wait
+    until its Received status and execution in between.  Intervals group
+    tasks by the time they were sent, so that the rate at which latency
+    starts to climb can be read off.
+    """
+    complete = [task for task in tasks if task['status'] == 'Complete']
+    duration = sum(stage[0] for stage in profile)
+    report = dict(
+        counts,
+        label = label,
+        settings = settings or {},
+        worker_key = worker_key,
+        started = started,
+        duration = duration,
+        profile = [list(stage) for stage in profile],
+        complete = len(complete),
+        failed = len(tasks) - len(complete),
+        lost = counts['sent'] - len(tasks),
+        throughput = 0.0,
+        latency = {
+            'end_to_end': _summarize(
+                [task['finished'] - task['enqueued'] for task in tasks]
+                ),
+            'queue_wait': _summarize(
+                [task['received'] - task['enqueued'] for task in tasks]
+                ),
+            'execution': _summarize(
+                [task['finished'] - task['received'] for task in tasks]
+                )
+            },
+        intervals = []
+        )
+    if complete:
+        span = max(task['finished'] for task in complete) - started
+        report['throughput'] = len(complete) / max(span, TICK_SECONDS)
+    for offset in range(0, int(duration) or 1, interval):
+        window_start = started + offset
+        window_end = window_start + interval
+        sent = [
+            send_time for send_time in send_times
+            if window_start <= send_time < window_end
+            ]
+        window_tasks = [
+            task for task in tasks
+            if window_start <= task['enqueued'] < window_end
+            ]
+        finished = [
+            task for task in complete
+            if window_start <= task['finished'] < window_end
+            ]
+        seconds = float(min(interval, max(duration - offset, TICK_SECONDS)))
+        end_to_end = _summarize(
+            [task['finished'] - task['enqueued'] for task in window_tasks]
+            ) or {}
+        report['intervals'].append({
+            'offset': offset,
+            'target_rate': get_rate(profile, offset + seconds / 2),
+            'sent_rate': len(sent) / seconds,
+            'complete_rate': len(finished) / seconds,
+            'p50': end_to_end.get('p50'),
+            'p99': end_to_end.get('p99')
+            })
+    return report
+
+
+def load_test(
+            config,
+            worker,
+            profile,
+            payload_bytes = DEFAULT_PAYLOAD_BYTES,
+            task_seconds = DEFAULT_TASK_SECONDS,
+            cpu = False,
+            batch_size = 1,
+            senders = DEFAULT_SENDERS,
+            max_outstanding = None,
+            drain_seconds = DEFAULT_DRAIN_SECONDS,
+            interval = DEFAULT_REPORT_INTERVAL,
+            event_source = None,
+            receiver = None,
+            label = None,
+            settings = None,
+            seed = None
+            ):
+    """send synthetic tasks to worker following profile; return a report
+
+    worker is a bosscat_worker of synthetic_task, or of any function taking
+    (payload, seconds, cpu).  payload_bytes and task_seconds are numbers or
+    lists of values picked at random for each task.  With batch_size over
+    one, tasks that come due together go out through delay_batch.
+
+    The loop is closed by max_outstanding: while that many tasks are sent
+    and not finished, tasks that come due are skipped and counted as held.
+    Finished tasks are read from the deployment's status topic as in
+    top, or from event_source; after the profile ends the test waits up to
+    drain_seconds for the rest.  Pass a LocalReceiver as receiver to run
+    against a memory.MemoryProvider instead of a deployed worker tier.
+    label and settings describe the configuration under test in the report.
+
+    queue_wait and end_to_end compare the sender's clock with the time
+    status events were published, so they include any clock skew.
+    """
+    random = Random(seed)
+    get_payload_bytes = _get_sampler(payload_bytes, random)
+    get_task_seconds = _get_sampler(task_seconds, random)
+    batch_size = max(1, min(batch_size, SQS_BATCH_SIZE))
+    config = upanddown.configure(config)
+    own_source = False
+    if event_source is None:
+        event_source = top.TopicEventSource(
+            config['deployment_region'],
+            config['account_id'],
+            top.get_status_topic_arn(config)
+            )
+        own_source = True
+    lock = Lock()
+    send_times = []
+    counts = {'sent': 0, 'send_errors': 0, 'held': 0}
+    def send(calls):
+        try:
+            if len(calls) == 1:
+                args, kwargs = calls[0]
+                worker.delay(0, *args, **kwargs)
+            else:
+                worker.delay_batch(calls)
+        except Exception:
+            with lock:
+                counts['send_errors'] += len(calls)
+            return
+        sent = time()
+        with lock:
+            counts['sent'] += len(calls)
+            send_times.extend([sent] * len(calls))
+    def get_call():
+        size = int(get_payload_bytes())
+        if size > MAX_PAYLOAD_BYTES:
+            raise ValueError('payloads are limited to {} bytes'.format(
+                MAX_PAYLOAD_BYTES
+                ))
+        return (('x' * size, get_task_seconds(), cpu), {})
+    if receiver is not None:
+        receiver.start()
+    started = time()
+    results = LoadResults(worker.worker_key, started)
+    try:
+        with ThreadPoolExecutor(max_workers=senders) as executor:
+            submitted = 0
+            due = 0.0
+            last = polled = started
+            while True:
+                now = time()
+                rate = get_rate(profile, now - started)
+                if rate is None:
+                    break
+                if now - polled >= POLL_SECONDS:
+                    results.add(event_source.poll())
+                    polled = now
+                due += rate * (now - last)
+                last = now
+                count = int(due)
+                due -= count
+                if max_outstanding:
+                    with lock:
+                        unsent = counts['send_errors']
+                    outstanding = submitted - unsent - len(results.finished)
+                    allowed = max(0, min(count, max_outstanding - outstanding))
+                    counts['held'] += count - allowed
+                    count = allowed
+                calls = [get_call() for index in range(count)]
+                for index in range(0, len(calls), batch_size):
+                    executor.submit(send, calls[index:index + batch_size])
+                submitted += count
+                sleep(TICK_SECONDS)
+        # every send has returned once the executor is shut down
+        deadline = time() + drain_seconds
+        while len(results.finished) < counts['sent'] and time() < deadline:
+            sleep(POLL_SECONDS)
+            results.add(event_source.poll())
+    finally:
+        if receiver is not None:
+            receiver.stop()
+        if own_source:
+            event_source.close()
+    counts['duplicates'] = results.duplicates
+    return make_report(
+        label,
+        settings,
+        worker.worker_key,
+        profile,
+        started,
+        send_times,
+        counts,
+        results.get_tasks(),
+        interval
+        )
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+def read_report(filename):
+    with open(filename) as report_file:
+        return json.load(report_file)
+
+
+def _seconds(value):
+    return '-' if value is None else '{:.3f}s'.format(value)
+
+
+def format_report(report):
+    """text report of one load test"""
+    lines = ['Load test {} of {}'.format(
+        report['label'] or '',
+        report['worker_key']
+        )]
+    for name, value in sorted(report['settings'].items()):
+        lines.append('  {}: {}'.format(name, value))
+    lines.append(
+        'Sent {sent} in {duration:.0f}s ({send_errors} send errors, {held} '
+        'held), {complete} complete, {failed} failed, {lost} lost, '
+        '{duplicates} duplicates'.format(**report))
+    lines.append('Throughput: {:.2f} tasks/s'.format(report['throughput']))
+    lines.append('{:<12} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'latency', 'p50', 'p90', 'p99', 'mean', 'max'
+        ))
+    for name in ('end_to_end', 'queue_wait', 'execution'):
+        summary = report['latency'][name] or {}
+        lines.append('{:<12} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            name,
+            *[
+                _seconds(summary.get(key))
+                for key in ('p50', 'p90', 'p99', 'mean', 'max')
+                ]
+            ))
+    lines.append('{:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'offset', 'target/s', 'sent/s', 'done/s', 'p50', 'p99'
+        ))
+    for row in report['intervals']:
+        lines.append('{:>6}s {:>9.2f} {:>9.2f} {:>9.2f} {:>9} {:>9}'.format(
+            row['offset'],
+            row['target_rate'] or 0,
+            row['sent_rate'],
+            row['complete_rate'],
+            _seconds(row['p50']),
+            _seconds(row['p99'])
+            ))
+    return '\n'.join(lines)
+
+
+def format_comparison(reports):
+    """one line per report, for comparing configurations"""
+    lines = ['{:<24} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7}'.format(
+        'label', 'sent', 'tasks/s', 'p50', 'p99', 'max', 'failed', 'lost'
+        )]
+    for report in reports:
+        end_to_end = report['latency']['end_to_end'] or {}
+        lines.append(
+            '{:<24} {:>7} {:>9.2f} {:>9} {:>9} {:>9} {:>7} {:>7}'.format(
+                report['label'] or report['worker_key'],
+                report['sent'],
+                report['throughput'],
+                _seconds(end_to_end.get('p50')),
+                _seconds(end_to_end.get('p99')),
+                _seconds(end_to_end.get('max')),
+                report['failed'],
+                report['lost']
+                ))
+    return '\n'.join(lines)
@@ -0,0 +1,1799 @@
+from collections import deque
+from functools import wraps
+from base64 import b64decode
+from hashlib import md5, sha256
+from itertools import count
+import json
+from random import Random
+from threading import Condition, RLock
+from time import sleep, time
+from uuid import uuid4
+
+from botocore.exceptions import ClientError
+
+from bosscat import retry, trace
+
+
+DEFAULT_ACCOUNT_ID = '123456789012'
+DEFAULT_REGION = 'us-east-1'
+
+
+THROTTLE_ERROR_CODES = {
+    's3': 'SlowDown',
+    'sqs': 'RequestThrottled',
+    }
+
+
+def _error(code, operation_name, message='', status_code=400):
+    return ClientError(
+        {
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'HTTPStatusCode': status_code}
+            },
+        operation_name
+        )
+
+
+def operation(operation_name):
+    """decorator for the api methods of memory clients"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with trace.span(
+                        '{}.{}'.format(self.service_name, operation_name),
+                        'aws'
+                        ):
+                token = retry.before_call(self.service_name)
+                try:
+                    self.provider.before_call(self.service_name, operation_name)
+                    with self.provider.lock:
+                        result = method(self, *args, **kwargs)
+                except ClientError as ex:
+                    retry.after_call(token, retry.classify(ex))
+                    raise
+                except BaseException:
+                    retry.after_call(token, retry.EVENTUAL)
+                    raise
+                retry.after_call(token)
+                return result
+        wrapper.operation_name = operation_name
+        return wrapper
+    return decorator
+
+
+class MemoryProvider(object):
+    """in-memory stand-in for the aws apis used by bosscat
+
+    Every duration is multiplied by time_scale, so a slow RDS restore can be
+    replayed in a fraction of a second.  latency (with +/- latency_jitter
+    as a fraction) is added to every call, throttle_rate is the chance of
+    any call being throttled and rate_limits caps calls per second for a
+    service.  IAM entities become visible to dependent calls only after
+    consistency_delay.  Pass seed for reproducible runs.
+    """
+
+    def __init__(
+                self,
+                account_id = DEFAULT_ACCOUNT_ID,
+                latency = 0.0,
+                latency_jitter = 0.5,
+                throttle_rate = 0.0,
+                rate_limits = None,
+                consistency_delay = 0.0,
+                rds_restore_seconds = 600.0,
+                rds_modify_seconds = 30.0,
+                rds_delete_seconds = 300.0,
+                eb_launch_seconds = 300.0,
+                eb_update_seconds = 120.0,
+                eb_terminate_seconds = 180.0,
+                time_scale = 1.0,
+                seed = None
+                ):
+        self.account_id = account_id
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_rate = throttle_rate
+        self.rate_limits = rate_limits or {}
+        self.consistency_delay = consistency_delay
+        self.rds_restore_seconds = rds_restore_seconds
+        self.rds_modify_seconds = rds_modify_seconds
+        self.rds_delete_seconds = rds_delete_seconds
+        self.eb_launch_seconds = eb_launch_seconds
+        self.eb_update_seconds = eb_update_seconds
+        self.eb_terminate_seconds = eb_terminate_seconds
+        self.time_scale = time_scale
+        self.random = Random(seed)
+        self.lock = RLock()
+        self.changed = Condition(self.lock)
+        self.call_counts = {}
+        self.throttle_counts = {}
+        self.rate_windows = {}
+        self.buckets = {}
+        self.queues = {}
+        self.deleted_queues = {}
+        self.topics = {}
+        self.roles = {}
+        self.policies = {}
+        self.instance_profiles = {}
+        self.db_instances = {}
+        self.app_versions = {}
+        self.environments = {}
+        self.auto_scaling_groups = {}
+        self.alarms = {}
+        self.ids = count(1)
+
+    def client(self, service_name, region=None, signature_version=None):
+        return MEMORY_CLIENTS[service_name](self, region or DEFAULT_REGION)
+
+    def now(self):
+        return time()
+
+    def after(self, seconds):
+        return self.now() + seconds * self.time_scale
+
+    def before_call(self, service_name, operation_name):
+        with self.lock:
+            key = (service_name, operation_name)
+            self.call_counts[key] = self.call_counts.get(key, 0) + 1
+            latency = self.latency * (
+                1 + self.latency_jitter * (2 * self.random.random() - 1)
+                )
+            throttled = self.random.random() < self.throttle_rate
+            limit = self.rate_limits.get(service_name)
+            if limit:
+                window = self.rate_windows.setdefault(service_name, deque())
+                now = self.now()
+                while window and window[0] <= now - self.time_scale:
+                    window.popleft()
+                if len(window) >= limit:
+                    throttled = True
+                else:
+                    window.append(now)
+            if throttled:
+                self.throttle_counts[key] = self.throttle_counts.get(key, 0) + 1
+        if latency > 0:
+            sleep(latency * self.time_scale)
+        if throttled:
+            raise _error(
+                THROTTLE_ERROR_CODES.get(service_name, 'Throttling'),
+                operation_name,
+                'Rate exceeded',
+                503 if service_name == 's3' else 400
+                )
+
+    def is_visible(self, entity):
+        return self.now() >= entity['created'] + \
+            self.consistency_delay * self.time_scale
+
+    def next_id(self):
+        return next(self.ids)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': sum(self.call_counts.values()),
+                'throttled': sum(self.throttle_counts.values()),
+                'call_counts': dict(self.call_counts),
+                'throttle_counts': dict(self.throttle_counts)
+                }
+
+
+def _status(transitions, now):
+    """transitions is a list of (time, status); return the current status"""
+    status = None
+    for at, next_status in transitions:
+        if at <= now:
+            status = next_status
+    return status
+
+
+class MemoryClient(object):
+    service_name = None
+
+    def __init__(self, provider, region):
+        self.provider = provider
+        self.region = region
+
+    def arn(self, resource):
+        return 'arn:aws:{}:{}:{}:{}'.format(
+            self.service_name,
+            self.region,
+            self.provider.account_id,
+            resource
+            )
+
+
+class MemorySTSClient(MemoryClient):
+    service_name = 'sts'
+
+    @operation('GetCallerIdentity')
+    def get_caller_identity(self):
+        return {
+            'Account': self.provider.account_id,
+            'Arn': 'arn:aws:iam::{}:user/bosscat'.format(
+                self.provider.account_id
+                ),
+            'UserId': 'BOSSCAT'
+            }
+
+
+class MemoryS3Client(MemoryClient):
+    service_name = 's3'
+
+    def _bucket(self, bucket_name, operation_name):
+        # elastic beanstalk creates its storage bucket on first use
+        if bucket_name.startswith('elasticbeanstalk-') and \
+                bucket_name.endswith('-' + self.provider.account_id):
+            self.provider.buckets.setdefault(bucket_name, {
+                'region': bucket_name.split('-', 1)[1].rsplit('-', 1)[0],
+                'objects': {},
+                'cors': None,
+                'policy': None,
+                'created': self.provider.now()
+                })
+        bucket = self.provider.buckets.get(bucket_name)
+        if bucket is None:
+            raise _error('NoSuchBucket', operation_name, bucket_name, 404)
+        return bucket
+
+    def _encryption_headers(self, bucket_name, headers, operation_name):
+        # objects sent without encryption headers get the bucket's default
+        headers = dict(headers)
+        encryption = self._bucket(bucket_name, operation_name).get('encryption')
+        if encryption and 'ServerSideEncryption' not in headers and \
+                'SSECustomerAlgorithm' not in headers:
+            default = encryption['Rules'][0]['ApplyServerSideEncryptionByDefault']
+            headers['ServerSideEncryption'] = default['SSEAlgorithm']
+        return headers
+
+    def _put(self, bucket_name, key, body, metadata=None, **headers):
+        headers = self._encryption_headers(bucket_name, headers, 'PutObject')
+        obj = dict(headers)
+        obj.update({
+            'Body': body,
+            'ETag': _etag(body, headers),
+            'Metadata': metadata or {},
+            'LastModified': self.provider.now(),
+            'ContentLength': len(body)
+            })
+        self._bucket(bucket_name, 'PutObject')['objects'][key] = obj
+        return obj
+
+    @operation('CreateBucket')
+    def create_bucket(self, Bucket, CreateBucketConfiguration=None):
+        if Bucket in self.provider.buckets:
+            raise _error('BucketAlreadyOwnedByYou', 'CreateBucket', Bucket, 409)
+        region = (CreateBucketConfiguration or {}).get('LocationConstraint')
+        self.provider.buckets[Bucket] = {
+            'region': region,
+            'objects': {},
+            'cors': None,
+            'policy': None,
+            'created': self.provider.now()
+            }
+        return {'Location': '/{}'.format(Bucket)}
+
+    @operation('PutBucketCors')
+    def put_bucket_cors(self, Bucket, CORSConfiguration):
+        self._bucket(Bucket, 'PutBucketCors')['cors'] = CORSConfiguration
+        return {}
+
+    @operation('PutBucketPolicy')
+    def put_bucket_policy(self, Bucket, Policy):
+        self._bucket(Bucket, 'PutBucketPolicy')['policy'] = Policy
+        return {}
+
+    @operation('PutBucketEncryption')
+    def put_bucket_encryption(self, Bucket, ServerSideEncryptionConfiguration):
+        bucket = self._bucket(Bucket, 'PutBucketEncryption')
+        bucket['encryption'] = ServerSideEncryptionConfiguration
+        return {}
+
+    @operation('GetBucketEncryption')
+    def get_bucket_encryption(self, Bucket):
+        encryption = self._bucket(Bucket, 'GetBucketEncryption').get('encryption')
+        if encryption is None:
+            raise _error(
+                'ServerSideEncryptionConfigurationNotFoundError',
+                'GetBucketEncryption',
+                'The server side encryption configuration was not found',
+                404
+                )
+        return {'ServerSideEncryptionConfiguration': encryption}
+
+    @operation('GetBucketLocation')
+    def get_bucket_location(self, Bucket):
+        bucket = self._bucket(Bucket, 'GetBucketLocation')
+        return {'LocationConstraint': bucket['region']}
+
+    @operation('DeleteBucket')
+    def delete_bucket(self, Bucket):
+        if self._bucket(Bucket, 'DeleteBucket')['objects']:
+            raise _error('BucketNotEmpty', 'DeleteBucket', Bucket, 409)
+        del self.provider.buckets[Bucket]
+        return {}
+
+    @operation('ListObjects')
+    def list_objects(self, Bucket, Prefix='', Marker='', MaxKeys=1000):
+        objects = self._bucket(Bucket, 'ListObjects')['objects']
+        keys = sorted(
+            key for key in objects
+            if key.startswith(Prefix) and key > Marker
+            )
+        contents = [
+            {
+                'Key': key,
+                'ETag': objects[key]['ETag'],
+                'Size': objects[key]['ContentLength']
+                }
+            for key in keys[:MaxKeys]
+            ]
+        response = {'IsTruncated': len(keys) > MaxKeys}
+        if contents:
+            response['Contents'] = contents
+        return response
+
+    @operation('DeleteObjects')
+    def delete_objects(self, Bucket, Delete):
+        objects = self._bucket(Bucket, 'DeleteObjects')['objects']
+        for obj in Delete['Objects']:
+            objects.pop(obj['Key'], None)
+        return {}
+
+    def _check_md5(self, body, content_md5, operation_name):
+        if content_md5 and b64decode(content_md5) != md5(body).digest():
+            raise _error('BadDigest', operation_name, 'Content-MD5 mismatch')
+
+    @operation('PutObject')
+    def put_object(
+                self,
+                Bucket,
+                Key,
+                Body = b'',
+                Metadata = None,
+                ContentMD5 = None,
+                IfNoneMatch = None,
+                **headers
+                ):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self._check_md5(Body, ContentMD5, 'PutObject')
+        if IfNoneMatch == '*' and \
+                Key in self._bucket(Bucket, 'PutObject')['objects']:
+            raise _error(
+                'PreconditionFailed',
+                'PutObject',
+                'At least one of the pre-conditions you specified did not hold',
+                412
+                )
+        obj = self._put(Bucket, Key, Body, Metadata, **headers)
+        return _encryption_response(obj, ETag=obj['ETag'])
+
+    @operation('CreateMultipartUpload')
+    def create_multipart_upload(self, Bucket, Key, **headers):
+        bucket = self._bucket(Bucket, 'CreateMultipartUpload')
+        upload_id = str(uuid4())
+        bucket.setdefault('uploads', {})[upload_id] = {
+            'Key': Key,
+            'headers': self._encryption_headers(
+                Bucket,
+                headers,
+                'CreateMultipartUpload'
+                ),
+            'parts': {}
+            }
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def _upload(self, bucket_name, upload_id, operation_name):
+        uploads = self._bucket(bucket_name, operation_name).get('uploads', {})
+        if upload_id not in uploads:
+            raise _error('NoSuchUpload', operation_name, upload_id, 404)
+        return uploads[upload_id]
+
+    @operation('UploadPart')
+    def upload_part(
+                self,
+                Bucket,
+                Key,
+                UploadId,
+                PartNumber,
+                Body,
+                ContentMD5 = None
+                ):
+        self._check_md5(Body, ContentMD5, 'UploadPart')
+        upload = self._upload(Bucket, UploadId, 'UploadPart')
+        etag = _etag(Body, upload['headers'])
+        upload['parts'][PartNumber] = {'Body': Body, 'ETag': etag}
+        return _encryption_response(upload['headers'], ETag=etag)
+
+    @operation('CompleteMultipartUpload')
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self._upload(Bucket, UploadId, 'CompleteMultipartUpload')
+        parts = []
+        for index, part in enumerate(MultipartUpload['Parts']):
+            uploaded = upload['parts'].get(part['PartNumber'])
+            if uploaded is None or uploaded['ETag'] != part['ETag']:
+                raise _error('InvalidPart', 'CompleteMultipartUpload')
+            if index < len(MultipartUpload['Parts']) - 1 and \
+                    len(uploaded['Body']) < 5 * 1024 * 1024:
+                raise _error('EntityTooSmall', 'CompleteMultipartUpload')
+            parts.append(uploaded)
+        headers = dict(upload['headers'])
+        obj = self._put(
+            Bucket,
+            Key,
+            b''.join(part['Body'] for part in parts),
+            headers.pop('Metadata', None),
+            **headers
+            )
+        if _etag_is_md5(obj):
+            obj['ETag'] = '"{}-{}"'.format(
+                md5(b''.join(
+                    bytes.fromhex(part['ETag'].strip('"')) for part in parts
+                    )).hexdigest(),
+                len(parts)
+                )
+        del self._bucket(Bucket, 'CompleteMultipartUpload')['uploads'][UploadId]
+        return _encryption_response(
+            obj,
+            Bucket = Bucket,
+            Key = Key,
+            ETag = obj['ETag']
+            )
+
+    @operation('AbortMultipartUpload')
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._upload(Bucket, UploadId, 'AbortMultipartUpload')
+        del self._bucket(Bucket, 'AbortMultipartUpload')['uploads'][UploadId]
+        return {}
+
+    @operation('HeadObject')
+    def head_object(self, Bucket, Key):
+        obj = self._bucket(Bucket, 'HeadObject')['objects'].get(Key)
+        if obj is None:
+            raise _error('404', 'HeadObject', 'Not Found', 404)
+        response = dict(obj)
+        del response['Body']
+        return response
+
+    @operation('GetObject')
+    def get_object(self, Bucket, Key):
+        obj = self._bucket(Bucket, 'GetObject')['objects'].get(Key)
+        if obj is None:
+            raise _error('NoSuchKey', 'GetObject', Key, 404)
+        response = dict(obj)
+        response['Body'] = _StreamingBody(obj['Body'])
+        return response
+
+    @operation('DeleteObject')
+    def delete_object(self, Bucket, Key):
+        self._bucket(Bucket, 'DeleteObject')['objects'].pop(Key, None)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, 'rb') as local_file:
+            self.put_object(
+                Bucket = Bucket,
+                Key = Key,
+                Body = local_file.read(),
+                **(ExtraArgs or {})
+                )
+
+
+def _etag_is_md5(headers):
+    return not (
+        headers.get('ServerSideEncryption', '').startswith('aws:kms') or
+        headers.get('SSECustomerAlgorithm')
+        )
+
+
+def _etag(body, headers):
+    # as in s3, objects encrypted with kms or a customer key do not get
+    #   the md5 of their body as their etag
+    if _etag_is_md5(headers):
+        return '"{}"'.format(md5(body).hexdigest())
+    return '"{}"'.format(uuid4().hex)
+
+
+def _encryption_response(headers, **response):
+    for name in ('ServerSideEncryption', 'SSECustomerAlgorithm'):
+        if name in headers:
+            response[name] = headers[name]
+    return response
+
+
+class _StreamingBody(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, amt=None):
+        if amt is None:
+            body, self.body = self.body, b''
+        else:
+            body, self.body = self.body[:amt], self.body[amt:]
+        return body
+
+
+class MemorySQSClient(MemoryClient):
+    service_name = 'sqs'
+
+    def _queue_url(self, queue_name):
+        return 'https://sqs.{}.amazonaws.com/{}/{}'.format(
+            self.region,
+            self.provider.account_id,
+            queue_name
+            )
+
+    def _queue(self, queue_url, operation_name):
+        queue = self.provider.queues.get(queue_url)
+        if queue is None:
+            raise _error(
+                'AWS.SimpleQueueService.NonExistentQueue',
+                operation_name,
+                queue_url
+                )
+        return queue
+
+    @operation('CreateQueue')
+    def create_queue(self, QueueName, Attributes=None):
+        queue_url = self._queue_url(QueueName)
+        deleted_at = self.provider.deleted_queues.get(queue_url)
+        if deleted_at and self.provider.now() < deleted_at + \
+                60 * self.provider.time_scale:
+            raise _error(
+                'AWS.SimpleQueueService.QueueDeletedRecently',
+                'CreateQueue',
+                QueueName
+                )
+        fifo = (Attributes or {}).get('FifoQueue') == 'true'
+        if fifo != QueueName.endswith('.fifo'):
+            raise _error(
+                'InvalidParameterValue',
+                'CreateQueue',
+                'Fifo queue names must end with .fifo'
+                )
+        queue = self.provider.queues.get(queue_url)
+        if queue is None:
+            self.provider.queues[queue_url] = {
+                'name': QueueName,
+                'region': self.region,
+                'attributes': dict(Attributes or {}),
+                'messages': [],
+                'created': self.provider.now()
+                }
+        elif Attributes and queue['attributes'] != Attributes:
+            raise _error(
+                'QueueAlreadyExists',
+                'CreateQueue',
+                'A queue already exists with different attributes'
+                )
+        return {'QueueUrl': queue_url}
+
+    @operation('GetQueueUrl')
+    def get_queue_url(self, QueueName):
+        queue_url = self._queue_url(QueueName)
+        self._queue(queue_url, 'GetQueueUrl')
+        return {'QueueUrl': queue_url}
+
+    @operation('DeleteQueue')
+    def delete_queue(self, QueueUrl):
+        self._queue(QueueUrl, 'DeleteQueue')
+        del self.provider.queues[QueueUrl]
+        self.provider.deleted_queues[QueueUrl] = self.provider.now()
+        return {}
+
+    @operation('SendMessage')
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=None, **kwargs):
+        queue = self._queue(QueueUrl, 'SendMessage')
+        if queue['attributes'].get('FifoQueue') == 'true':
+            deduplication_id = self._fifo_send(
+                queue,
+                MessageBody,
+                DelaySeconds,
+                kwargs
+                )
+            if deduplication_id in queue['deduplication']:
+                return queue['deduplication'][deduplication_id]
+        elif 'MessageGroupId' in kwargs:
+            raise _error(
+                'InvalidParameterValue',
+                'SendMessage',
+                'MessageGroupId is only for fifo queues'
+                )
+        DelaySeconds = DelaySeconds or 0
+        message = {
+            'MessageId': str(uuid4()),
+            'Body': MessageBody,
+            'MD5OfBody': md5(MessageBody.encode('utf-8')).hexdigest(),
+            'SentTimestamp': self.provider.now(),
+            'VisibleAt': self.provider.after(DelaySeconds),
+            'ReceiveCount': 0
+            }
+        message.update(kwargs)
+        queue['messages'].append(message)
+        self.provider.changed.notify_all()
+        response = {
+            'MessageId': message['MessageId'],
+            'MD5OfMessageBody': message['MD5OfBody']
+            }
+        if queue['attributes'].get('FifoQueue') == 'true':
+            queue['deduplication'][deduplication_id] = response
+        return response
+
+    def _fifo_send(self, queue, body, delay_seconds, kwargs):
+        # return the deduplication id of a fifo send after checking it
+        if delay_seconds is not None:
+            raise _error(
+                'InvalidParameterValue',
+                'SendMessage',
+                'DelaySeconds is not supported on fifo queues'
+                )
+        if 'MessageGroupId' not in kwargs:
+            raise _error(
+                'MissingParameter',
+                'SendMessage',
+                'MessageGroupId is required for fifo queues'
+                )
+        deduplication_id = kwargs.get('MessageDeduplicationId')
+        if deduplication_id is None:
+            if queue['attributes'].get('ContentBasedDeduplication') != 'true':
+                raise _error(
+                    'InvalidParameterValue',
+                    'SendMessage',
+                    'MessageDeduplicationId is required without content '
+                    'based deduplication'
+                    )
+            deduplication_id = sha256(body.encode('utf-8')).hexdigest()
+        if queue['attributes'].get('DeduplicationScope') == 'messageGroup':
+            deduplication_id = (kwargs['MessageGroupId'], deduplication_id)
+        # deduplication ids are remembered for five minutes
+        queue.setdefault('deduplication', {})
+        queue.setdefault('deduplication_times', {})
+        now = self.provider.now()
+        for key, sent_at in list(queue['deduplication_times'].items()):
+            if now - sent_at > 300 * self.provider.time_scale:
+                del queue['deduplication_times'][key]
+                queue['deduplication'].pop(key, None)
+        queue['deduplication_times'].setdefault(deduplication_id, now)
+        return deduplication_id
+
+    @operation('SendMessageBatch')
+    def send_message_batch(self, QueueUrl, Entries):
+        return self._batch(
+            Entries,
+            lambda entry: self._unwrapped('send_message')(
+                QueueUrl = QueueUrl,
+                **dict(
+                    (name, value) for name, value in entry.items()
+                    if name != 'Id'
+                    )
+                )
+            )
+
+    @operation('DeleteMessageBatch')
+    def delete_message_batch(self, QueueUrl, Entries):
+        return self._batch(
+            Entries,
+            lambda entry: self._unwrapped('delete_message')(
+                QueueUrl = QueueUrl,
+                ReceiptHandle = entry['ReceiptHandle']
+                )
+            )
+
+    @operation('ChangeMessageVisibilityBatch')
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        return self._batch(
+            Entries,
+            lambda entry: self._unwrapped('change_message_visibility')(
+                QueueUrl = QueueUrl,
+                ReceiptHandle = entry['ReceiptHandle'],
+                VisibilityTimeout = entry['VisibilityTimeout']
+                )
+            )
+
+    def _unwrapped(self, method_name):
+        # batch entries run under the batch call's latency and throttling
+        method = getattr(type(self), method_name).__wrapped__
+        return lambda **kwargs: method(self, **kwargs)
+
+    def _batch(self, entries, call):
+        if not entries or len(entries) > 10:
+            raise _error(
+                'AWS.SimpleQueueService.TooManyEntriesInBatchRequest',
+                'Batch',
+                'Batches take 1 to 10 entries'
+                )
+        response = {'Successful': [], 'Failed': []}
+        for entry in entries:
+            try:
+                result = call(entry)
+            except ClientError as ex:
+                response['Failed'].append({
+                    'Id': entry['Id'],
+                    'SenderFault': True,
+                    'Code': ex.response['Error']['Code'],
+                    'Message': ex.response['Error']['Message']
+                    })
+            else:
+                result = dict(result)
+                result['Id'] = entry['Id']
+                response['Successful'].append(result)
+        return response
+
+    @operation('ChangeMessageVisibility')
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        queue = self._queue(QueueUrl, 'ChangeMessageVisibility')
+        for message in queue['messages']:
+            if message.get('ReceiptHandle') == ReceiptHandle:
+                message['VisibleAt'] = self.provider.after(VisibilityTimeout)
+                return {}
+        raise _error(
+            'ReceiptHandleIsInvalid',
+            'ChangeMessageVisibility',
+            ReceiptHandle
+            )
+
+    def receive_message(
+                self,
+                QueueUrl,
+                MaxNumberOfMessages = 1,
+                WaitTimeSeconds = 0,
+                VisibilityTimeout = 30,
+                **kwargs
+                ):
+        # long polls wait outside of the provider lock so that other
+        #   clients can send while a receiver is waiting
+        deadline = self.provider.after(WaitTimeSeconds)
+        while True:
+            response = self._receive_message(
+                QueueUrl,
+                MaxNumberOfMessages,
+                VisibilityTimeout
+                )
+            if response['Messages'] or self.provider.now() >= deadline:
+                return response
+            with self.provider.changed:
+                self.provider.changed.wait(
+                    min(deadline - self.provider.now(), 0.05)
+                    )
+
+    @operation('ReceiveMessage')
+    def _receive_message(self, QueueUrl, MaxNumberOfMessages, VisibilityTimeout):
+        queue = self._queue(QueueUrl, 'ReceiveMessage')
+        now = self.provider.now()
+        fifo = queue['attributes'].get('FifoQueue') == 'true'
+        # a fifo group with a message in flight delivers nothing more until
+        #   that message is deleted or becomes visible again
+        blocked_groups = set()
+        messages = []
+        for message in queue['messages']:
+            if len(messages) >= MaxNumberOfMessages:
+                break
+            group_id = message.get('MessageGroupId')
+            if fifo and group_id in blocked_groups:
+                continue
+            if fifo and message['VisibleAt'] > now:
+                blocked_groups.add(group_id)
+                continue
+            if message['VisibleAt'] <= now:
+                message['VisibleAt'] = self.provider.after(VisibilityTimeout)
+                message['ReceiveCount'] += 1
+                message['ReceiptHandle'] = str(uuid4())
+                messages.append({
+                    'MessageId': message['MessageId'],
+                    'ReceiptHandle': message['ReceiptHandle'],
+                    'Body': message['Body'],
+                    'MD5OfBody': message['MD5OfBody'],
+                    'Attributes': self._message_attributes(message)
+                    })
+        return {'Messages': messages}
+
+    def _message_attributes(self, message):
+        attributes = {
+            'SentTimestamp': str(int(message['SentTimestamp'] * 1000)),
+            'ApproximateReceiveCount': str(message['ReceiveCount'])
+            }
+        for name in ('MessageGroupId', 'MessageDeduplicationId'):
+            if name in message:
+                attributes[name] = message[name]
+        return attributes
+
+    @operation('DeleteMessage')
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        queue = self._queue(QueueUrl, 'DeleteMessage')
+        queue['messages'] = [
+            message for message in queue['messages']
+            if message.get('ReceiptHandle') != ReceiptHandle
+            ]
+        return {}
+
+    @operation('SetQueueAttributes')
+    def set_queue_attributes(self, QueueUrl, Attributes):
+        self._queue(QueueUrl, 'SetQueueAttributes')['attributes'].update(
+            Attributes
+            )
+        return {}
+
+    @operation('GetQueueAttributes')
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        queue = self._queue(QueueUrl, 'GetQueueAttributes')
+        now = self.provider.now()
+        visible = [
+            message for message in queue['messages']
+            if message['VisibleAt'] <= now
+            ]
+        attributes = dict(queue['attributes'])
+        attributes.update({
+            'ApproximateNumberOfMessages': str(len(visible)),
+            'ApproximateNumberOfMessagesNotVisible':
+                str(len(queue['messages']) - len(visible)),
+            'QueueArn': self.arn(queue['name'])
+            })
+        return {'Attributes': attributes}
+
+
+class MemorySNSClient(MemoryClient):
+    service_name = 'sns'
+    page_size = 100
+
+    def _topic(self, topic_arn, operation_name):
+        topic = self.provider.topics.get(topic_arn)
+        if topic is None:
+            raise _error('NotFound', operation_name, topic_arn, 404)
+        return topic
+
+    @operation('CreateTopic')
+    def create_topic(self, Name, Attributes=None):
+        topic_arn = self.arn(Name)
+        if topic_arn not in self.provider.topics:
+            self.provider.topics[topic_arn] = {
+                'subscriptions': {},
+                'published': [],
+                'attributes': dict(Attributes or {})
+                }
+        return {'TopicArn': topic_arn}
+
+    @operation('DeleteTopic')
+    def delete_topic(self, TopicArn):
+        self.provider.topics.pop(TopicArn, None)
+        return {}
+
+    @operation('Subscribe')
+    def subscribe(self, TopicArn, Protocol, Endpoint, **kwargs):
+        topic = self._topic(TopicArn, 'Subscribe')
+        for subscription_arn, subscription in topic['subscriptions'].items():
+            if (subscription['Protocol'], subscription['Endpoint']) == \
+                    (Protocol, Endpoint):
+                return {'SubscriptionArn': subscription_arn}
+        subscription_arn = '{}:{}'.format(TopicArn, uuid4())
+        topic['subscriptions'][subscription_arn] = {
+            'SubscriptionArn': subscription_arn,
+            'TopicArn': TopicArn,
+            'Protocol': Protocol,
+            'Endpoint': Endpoint,
+            'Owner': self.provider.account_id,
+            'Attributes': dict(kwargs.get('Attributes') or {})
+            }
+        return {'SubscriptionArn': subscription_arn}
+
+    @operation('Unsubscribe')
+    def unsubscribe(self, SubscriptionArn):
+        for topic in self.provider.topics.values():
+            topic['subscriptions'].pop(SubscriptionArn, None)
+        return {}
+
+    @operation('ListSubscriptionsByTopic')
+    def list_subscriptions_by_topic(self, TopicArn, NextToken=''):
+        topic = self._topic(TopicArn, 'ListSubscriptionsByTopic')
+        subscriptions = sorted(
+            topic['subscriptions'].values(),
+            key = lambda subscription: subscription['SubscriptionArn']
+            )
+        start = int(NextToken or 0)
+        response = {
+            'Subscriptions': subscriptions[start:start + self.page_size]
+            }
+        if start + self.page_size < len(subscriptions):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+    @operation('Publish')
+    def publish(self, TopicArn, Message, Subject=None, **kwargs):
+        topic = self._topic(TopicArn, 'Publish')
+        message_id = str(uuid4())
+        topic['published'].append({
+            'MessageId': message_id,
+            'Subject': Subject,
+            'Message': Message,
+            'Timestamp': self.provider.now()
+            })
+        # deliver to subscribed queues in this provider
+        for subscription in topic['subscriptions'].values():
+            if subscription['Protocol'] != 'sqs':
+                continue
+            queue_name = subscription['Endpoint'].rsplit(':', 1)[1]
+            if subscription['Attributes'].get('RawMessageDelivery') == 'true':
+                body = Message
+            else:
+                body = json.dumps({
+                    'Type': 'Notification',
+                    'MessageId': message_id,
+                    'TopicArn': TopicArn,
+                    'Subject': Subject,
+                    'Message': Message
+                    })
+            for queue_url, queue in self.provider.queues.items():
+                if queue['name'] == queue_name:
+                    MemorySQSClient.send_message.__wrapped__(
+                        MemorySQSClient(self.provider, queue['region']),
+                        QueueUrl = queue_url,
+                        MessageBody = body
+                        )
+        self.provider.changed.notify_all()
+        return {'MessageId': message_id}
+
+    @operation('PublishBatch')
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        if not PublishBatchRequestEntries or len(PublishBatchRequestEntries) > 10:
+            raise _error(
+                'TooManyEntriesInBatchRequest',
+                'PublishBatch',
+                'Batches take 1 to 10 entries'
+                )
+        publish = MemorySNSClient.publish.__wrapped__
+        return {
+            'Successful': [
+                dict(
+                    publish(
+                        self,
+                        TopicArn = TopicArn,
+                        Message = entry['Message'],
+                        Subject = entry.get('Subject')
+                        ),
+                    Id = entry['Id']
+                    )
+                for entry in PublishBatchRequestEntries
+                ],
+            'Failed': []
+            }
+
+
+INLINE_POLICY_SIZE_LIMIT = 10240
+MANAGED_POLICY_SIZE_LIMIT = 6144
+
+
+def _policy_size(document):
+    return len(json.dumps(json.loads(document), separators=(',', ':')))
+
+
+class MemoryIAMClient(MemoryClient):
+    service_name = 'iam'
+
+    def _entity(self, entities, name, operation_name):
+        entity = entities.get(name)
+        if entity is None or not self.provider.is_visible(entity):
+            raise _error('NoSuchEntity', operation_name, name, 404)
+        return entity
+
+    @operation('CreateRole')
+    def create_role(self, RoleName, AssumeRolePolicyDocument, **kwargs):
+        if RoleName in self.provider.roles:
+            raise _error('EntityAlreadyExists', 'CreateRole', RoleName, 409)
+        self.provider.roles[RoleName] = {
+            'RoleName': RoleName,
+            'AssumeRolePolicyDocument': AssumeRolePolicyDocument,
+            'policies': {},
+            'created': self.provider.now()
+            }
+        return {'Role': {'RoleName': RoleName}}
+
+    @operation('PutRolePolicy')
+    def put_role_policy(self, RoleName, PolicyName, PolicyDocument):
+        role = self._entity(self.provider.roles, RoleName, 'PutRolePolicy')
+        policies = dict(role['policies'])
+        policies[PolicyName] = PolicyDocument
+        # inline policies of a role share one size limit, without whitespace
+        if sum(_policy_size(document) for document in policies.values()) > \
+                INLINE_POLICY_SIZE_LIMIT:
+            raise _error(
+                'LimitExceeded',
+                'PutRolePolicy',
+                'Maximum policy size of 10240 bytes exceeded for role {}'.format(
+                    RoleName
+                    ),
+                409
+                )
+        role['policies'] = policies
+        return {}
+
+    def _policy(self, policy_arn, operation_name):
+        policy = self.provider.policies.get(policy_arn)
+        if policy is None:
+            raise _error('NoSuchEntity', operation_name, policy_arn, 404)
+        return policy
+
+    @operation('CreatePolicy')
+    def create_policy(self, PolicyName, PolicyDocument, **kwargs):
+        policy_arn = 'arn:aws:iam::{}:policy/{}'.format(
+            self.provider.account_id,
+            PolicyName
+            )
+        if policy_arn in self.provider.policies:
+            raise _error('EntityAlreadyExists', 'CreatePolicy', PolicyName, 409)
+        self._check_managed_size(PolicyDocument, 'CreatePolicy')
+        self.provider.policies[policy_arn] = {
+            'PolicyName': PolicyName,
+            'Arn': policy_arn,
+            'versions': [{
+                'VersionId': 'v1',
+                'Document': PolicyDocument,
+                'IsDefaultVersion': True,
+                'CreateDate': self.provider.now()
+                }],
+            'next_version': 2,
+            'attachments': set()
+            }
+        return {'Policy': {'PolicyName': PolicyName, 'Arn': policy_arn}}
+
+    def _check_managed_size(self, document, operation_name):
+        if _policy_size(document) > MANAGED_POLICY_SIZE_LIMIT:
+            raise _error(
+                'LimitExceeded',
+                operation_name,
+                'Cannot exceed quota for PolicySize: 6144',
+                409
+                )
+
+    @operation('CreatePolicyVersion')
+    def create_policy_version(self, PolicyArn, PolicyDocument, SetAsDefault=False):
+        policy = self._policy(PolicyArn, 'CreatePolicyVersion')
+        if len(policy['versions']) >= 5:
+            raise _error(
+                'LimitExceeded',
+                'CreatePolicyVersion',
+                'A managed policy can have up to 5 versions',
+                409
+                )
+        self._check_managed_size(PolicyDocument, 'CreatePolicyVersion')
+        version = {
+            'VersionId': 'v{}'.format(policy['next_version']),
+            'Document': PolicyDocument,
+            'IsDefaultVersion': False,
+            'CreateDate': self.provider.now()
+            }
+        policy['next_version'] += 1
+        if SetAsDefault:
+            for other in policy['versions']:
+                other['IsDefaultVersion'] = False
+            version['IsDefaultVersion'] = True
+        policy['versions'].append(version)
+        return {'PolicyVersion': dict(version)}
+
+    @operation('ListPolicyVersions')
+    def list_policy_versions(self, PolicyArn):
+        policy = self._policy(PolicyArn, 'ListPolicyVersions')
+        return {'Versions': [
+            dict((key, version[key]) for key in (
+                'VersionId', 'IsDefaultVersion', 'CreateDate'
+                ))
+            for version in policy['versions']
+            ]}
+
+    @operation('DeletePolicyVersion')
+    def delete_policy_version(self, PolicyArn, VersionId):
+        policy = self._policy(PolicyArn, 'DeletePolicyVersion')
+        for version in policy['versions']:
+            if version['VersionId'] == VersionId:
+                if version['IsDefaultVersion']:
+                    raise _error(
+                        'DeleteConflict',
+                        'DeletePolicyVersion',
+                        'Cannot delete the default version',
+                        409
+                        )
+                policy['versions'].remove(version)
+                return {}
+        raise _error('NoSuchEntity', 'DeletePolicyVersion', VersionId, 404)
+
+    @operation('DeletePolicy')
+    def delete_policy(self, PolicyArn):
+        policy = self._policy(PolicyArn, 'DeletePolicy')
+        if policy['attachments'] or len(policy['versions']) > 1:
+            raise _error('DeleteConflict', 'DeletePolicy', PolicyArn, 409)
+        del self.provider.policies[PolicyArn]
+        return {}
+
+    @operation('AttachRolePolicy')
+    def attach_role_policy(self, RoleName, PolicyArn):
+        self._entity(self.provider.roles, RoleName, 'AttachRolePolicy')
+        self._policy(PolicyArn, 'AttachRolePolicy')['attachments'].add(RoleName)
+        return {}
+
+    @operation('DetachRolePolicy')
+    def detach_role_policy(self, RoleName, PolicyArn):
+        policy = self._policy(PolicyArn, 'DetachRolePolicy')
+        if RoleName not in policy['attachments']:
+            raise _error('NoSuchEntity', 'DetachRolePolicy', PolicyArn, 404)
+        policy['attachments'].discard(RoleName)
+        return {}
+
+    @operation('ListAttachedRolePolicies')
+    def list_attached_role_policies(self, RoleName, **kwargs):
+        self._entity(self.provider.roles, RoleName, 'ListAttachedRolePolicies')
+        return {
+            'AttachedPolicies': [
+                {'PolicyName': policy['PolicyName'], 'PolicyArn': policy_arn}
+                for policy_arn, policy in sorted(self.provider.policies.items())
+                if RoleName in policy['attachments']
+                ],
+            'IsTruncated': False
+            }
+
+    @operation('ListRolePolicies')
+    def list_role_policies(self, RoleName):
+        role = self._entity(self.provider.roles, RoleName, 'ListRolePolicies')
+        return {'PolicyNames': sorted(role['policies'])}
+
+    @operation('DeleteRolePolicy')
+    def delete_role_policy(self, RoleName, PolicyName):
+        role = self._entity(self.provider.roles, RoleName, 'DeleteRolePolicy')
+        role['policies'].pop(PolicyName, None)
+        return {}
+
+    @operation('DeleteRole')
+    def delete_role(self, RoleName):
+        role = self._entity(self.provider.roles, RoleName, 'DeleteRole')
+        if role['policies'] or any(
+                    RoleName in policy['attachments']
+                    for policy in self.provider.policies.values()
+                    ):
+            raise _error('DeleteConflict', 'DeleteRole', RoleName, 409)
+        del self.provider.roles[RoleName]
+        return {}
+
+    @operation('CreateInstanceProfile')
+    def create_instance_profile(self, InstanceProfileName, **kwargs):
+        if InstanceProfileName in self.provider.instance_profiles:
+            raise _error(
+                'EntityAlreadyExists',
+                'CreateInstanceProfile',
+                InstanceProfileName,
+                409
+                )
+        self.provider.instance_profiles[InstanceProfileName] = {
+            'InstanceProfileName': InstanceProfileName,
+            'Roles': [],
+            'created': self.provider.now()
+            }
+        return {'InstanceProfile': {'InstanceProfileName': InstanceProfileName}}
+
+    @operation('AddRoleToInstanceProfile')
+    def add_role_to_instance_profile(self, InstanceProfileName, RoleName):
+        instance_profile = self._entity(
+            self.provider.instance_profiles,
+            InstanceProfileName,
+            'AddRoleToInstanceProfile'
+            )
+        self._entity(self.provider.roles, RoleName, 'AddRoleToInstanceProfile')
+        if instance_profile['Roles']:
+            raise _error(
+                'LimitExceeded',
+                'AddRoleToInstanceProfile',
+                'Cannot exceed quota for InstanceSessionsPerInstanceProfile: 1',
+                409
+                )
+        instance_profile['Roles'].append({'RoleName': RoleName})
+        return {}
+
+    @operation('GetInstanceProfile')
+    def get_instance_profile(self, InstanceProfileName):
+        instance_profile = self._entity(
+            self.provider.instance_profiles,
+            InstanceProfileName,
+            'GetInstanceProfile'
+            )
+        return {
+            'InstanceProfile': {
+                'InstanceProfileName': InstanceProfileName,
+                'Roles': list(instance_profile['Roles'])
+                }
+            }
+
+    @operation('RemoveRoleFromInstanceProfile')
+    def remove_role_from_instance_profile(self, InstanceProfileName, RoleName):
+        instance_profile = self._entity(
+            self.provider.instance_profiles,
+            InstanceProfileName,
+            'RemoveRoleFromInstanceProfile'
+            )
+        instance_profile['Roles'] = [
+            role for role in instance_profile['Roles']
+            if role['RoleName'] != RoleName
+            ]
+        return {}
+
+    @operation('DeleteInstanceProfile')
+    def delete_instance_profile(self, InstanceProfileName):
+        self._entity(
+            self.provider.instance_profiles,
+            InstanceProfileName,
+            'DeleteInstanceProfile'
+            )
+        del self.provider.instance_profiles[InstanceProfileName]
+        return {}
+
+
+class MemoryRDSClient(MemoryClient):
+    service_name = 'rds'
+
+    def _apply_renames(self):
+        # like rds, a renamed instance keeps its old name while it is
+        #   renaming, and only then moves to the new one
+        now = self.provider.now()
+        for key, instance in list(self.provider.db_instances.items()):
+            rename = instance.get('rename')
+            if rename and now >= rename[0]:
+                del instance['rename']
+                del self.provider.db_instances[key]
+                instance['DBInstanceIdentifier'] = rename[1]
+                self.provider.db_instances[(key[0], rename[1])] = instance
+
+    def _instance(self, db_instance_identifier, operation_name):
+        self._apply_renames()
+        instance = self.provider.db_instances.get(
+            (self.region, db_instance_identifier)
+            )
+        if instance is None or \
+                _status(instance['transitions'], self.provider.now()) is None:
+            raise _error(
+                'DBInstanceNotFound',
+                operation_name,
+                db_instance_identifier,
+                404
+                )
+        return instance
+
+    def _describe(self, instance):
+        return {
+            'DBInstanceIdentifier': instance['DBInstanceIdentifier'],
+            'DBInstanceClass': instance['DBInstanceClass'],
+            'DBInstanceStatus':
+                _status(instance['transitions'], self.provider.now()),
+            'Endpoint': {
+                'Address': '{}.memory.{}.rds.amazonaws.com'.format(
+                    instance['DBInstanceIdentifier'],
+                    self.region
+                    ),
+                'Port': 5432
+                },
+            'VpcSecurityGroups': [
+                {'VpcSecurityGroupId': group_id, 'Status': 'active'}
+                for group_id in instance['VpcSecurityGroupIds']
+                ],
+            'DBInstanceArn': self.arn(
+                'db:{}'.format(instance['DBInstanceIdentifier'])
+                ),
+            'TagList': list(instance['Tags'])
+            }
+
+    def _instance_by_arn(self, resource_name, operation_name):
+        return self._instance(resource_name.rsplit(':', 1)[1], operation_name)
+
+    @operation('AddTagsToResource')
+    def add_tags_to_resource(self, ResourceName, Tags):
+        instance = self._instance_by_arn(ResourceName, 'AddTagsToResource')
+        keys = set(tag['Key'] for tag in Tags)
+        instance['Tags'] = [
+            tag for tag in instance['Tags'] if tag['Key'] not in keys
+            ] + list(Tags)
+        return {}
+
+    @operation('RemoveTagsFromResource')
+    def remove_tags_from_resource(self, ResourceName, TagKeys):
+        instance = self._instance_by_arn(ResourceName, 'RemoveTagsFromResource')
+        instance['Tags'] = [
+            tag for tag in instance['Tags'] if tag['Key'] not in TagKeys
+            ]
+        return {}
+
+    @operation('RestoreDBInstanceFromDBSnapshot')
+    def restore_db_instance_from_db_snapshot(
+                self,
+                DBInstanceIdentifier,
+                DBSnapshotIdentifier,
+                DBInstanceClass,
+                Tags = None,
+                **kwargs
+                ):
+        self._apply_renames()
+        key = (self.region, DBInstanceIdentifier)
+        if key in self.provider.db_instances and _status(
+                    self.provider.db_instances[key]['transitions'],
+                    self.provider.now()
+                    ):
+            raise _error(
+                'DBInstanceAlreadyExists',
+                'RestoreDBInstanceFromDBSnapshot',
+                DBInstanceIdentifier
+                )
+        now = self.provider.now()
+        restore_seconds = self.provider.rds_restore_seconds
+        self.provider.db_instances[key] = {
+            'DBInstanceIdentifier': DBInstanceIdentifier,
+            'DBSnapshotIdentifier': DBSnapshotIdentifier,
+            'DBInstanceClass': DBInstanceClass,
+            'VpcSecurityGroupIds': [],
+            'Tags': list(Tags or []),
+            'transitions': [
+                (now, 'creating'),
+                (self.provider.after(restore_seconds * 0.9), 'backing-up'),
+                (self.provider.after(restore_seconds), 'available')
+                ]
+            }
+        return {'DBInstance': self._describe(self.provider.db_instances[key])}
+
+    @operation('DescribeDBInstances')
+    def describe_db_instances(self, DBInstanceIdentifier=None, **kwargs):
+        if DBInstanceIdentifier:
+            instances = [
+                self._instance(DBInstanceIdentifier, 'DescribeDBInstances')
+                ]
+        else:
+            self._apply_renames()
+            now = self.provider.now()
+            instances = [
+                instance
+                for (region, name), instance in
+                    sorted(self.provider.db_instances.items())
+                if region == self.region and
+                    _status(instance['transitions'], now) is not None
+                ]
+        return {'DBInstances': [
+            self._describe(instance) for instance in instances
+            ]}
+
+    @operation('ModifyDBInstance')
+    def modify_db_instance(
+                self,
+                DBInstanceIdentifier,
+                VpcSecurityGroupIds = None,
+                NewDBInstanceIdentifier = None,
+                ApplyImmediately = False,
+                **kwargs
+                ):
+        instance = self._instance(DBInstanceIdentifier, 'ModifyDBInstance')
+        if _status(instance['transitions'], self.provider.now()) != 'available':
+            raise _error(
+                'InvalidDBInstanceState',
+                'ModifyDBInstance',
+                DBInstanceIdentifier
+                )
+        if VpcSecurityGroupIds is not None:
+            instance['VpcSecurityGroupIds'] = list(VpcSecurityGroupIds)
+        instance['transitions'] = [
+            (self.provider.now(), 'modifying'),
+            (self.provider.after(self.provider.rds_modify_seconds), 'available')
+            ]
+        if NewDBInstanceIdentifier:
+            rename_at = self.provider.after(self.provider.rds_modify_seconds / 2)
+            instance['rename'] = (rename_at, NewDBInstanceIdentifier)
+            instance['transitions'][0:1] = [
+                (self.provider.now(), 'renaming'),
+                (rename_at, 'modifying')
+                ]
+        return {'DBInstance': self._describe(instance)}
+
+    @operation('DeleteDBInstance')
+    def delete_db_instance(self, DBInstanceIdentifier, **kwargs):
+        instance = self._instance(DBInstanceIdentifier, 'DeleteDBInstance')
+        instance['transitions'] = [
+            (self.provider.now(), 'deleting'),
+            (self.provider.after(self.provider.rds_delete_seconds), None)
+            ]
+        return {'DBInstance': self._describe(instance)}
+
+
+def _option_settings(option_settings):
+    # eb keeps and reports every option value as a string
+    return [
+        dict(option, Value=str(option['Value'])) if 'Value' in option else option
+        for option in option_settings or []
+        ]
+
+
+class MemoryElasticBeanstalkClient(MemoryClient):
+    service_name = 'elasticbeanstalk'
+
+    def _describe(self, environment):
+        now = self.provider.now()
+        status = _status(environment['transitions'], now)
+        return {
+            'EnvironmentName': environment['EnvironmentName'],
+            'EnvironmentId': environment['EnvironmentId'],
+            'ApplicationName': environment['ApplicationName'],
+            'VersionLabel': environment['VersionLabel'],
+            'SolutionStackName': environment['SolutionStackName'],
+            'CNAME': environment['CNAME'],
+            'Tier': environment['Tier'],
+            'Status': status,
+            'Health': 'Green' if status == 'Ready' else 'Grey'
+            }
+
+    def _environment(self, environment_name, operation_name):
+        for environment in self.provider.environments.values():
+            if environment['EnvironmentName'] == environment_name and \
+                    environment['region'] == self.region and \
+                    _status(environment['transitions'], self.provider.now()) \
+                        != 'Terminated':
+                return environment
+        raise _error(
+            'InvalidParameterValue',
+            operation_name,
+            'No Environment found for EnvironmentName = \'{}\'.'.format(
+                environment_name
+                )
+            )
+
+    @operation('CreateApplicationVersion')
+    def create_application_version(
+                self,
+                ApplicationName,
+                VersionLabel,
+                SourceBundle,
+                Description = '',
+                **kwargs
+                ):
+        key = (self.region, ApplicationName, VersionLabel)
+        if key in self.provider.app_versions:
+            raise _error(
+                'InvalidParameterValue',
+                'CreateApplicationVersion',
+                'Application Version {} already exists.'.format(VersionLabel)
+                )
+        bucket = self.provider.buckets.get(SourceBundle['S3Bucket'], {})
+        if SourceBundle['S3Key'] not in bucket.get('objects', {}):
+            raise _error(
+                'InvalidParameterCombination',
+                'CreateApplicationVersion',
+                'Unable to download from S3 location'
+                )
+        self.provider.app_versions[key] = {
+            'ApplicationName': ApplicationName,
+            'VersionLabel': VersionLabel,
+            'Description': Description,
+            'SourceBundle': SourceBundle,
+            'Status': 'PROCESSED'
+            }
+        return {'ApplicationVersion': self.provider.app_versions[key]}
+
+    @operation('DescribeApplicationVersions')
+    def describe_application_versions(
+                self,
+                ApplicationName = None,
+                VersionLabels = None
+                ):
+        return {'ApplicationVersions': [
+            app_version
+            for (region, app_id, label), app_version in
+                sorted(self.provider.app_versions.items())
+            if region == self.region and
+                ApplicationName in (None, app_id) and
+                (not VersionLabels or label in VersionLabels)
+            ]}
+
+    @operation('CreateEnvironment')
+    def create_environment(
+                self,
+                ApplicationName,
+                EnvironmentName,
+                VersionLabel,
+                Tier,
+                OptionSettings = None,
+                SolutionStackName = None,
+                **kwargs
+                ):
+        try:
+            self._environment(EnvironmentName, 'CreateEnvironment')
+        except ClientError:
+            pass
+        else:
+            raise _error(
+                'InvalidParameterValue',
+                'CreateEnvironment',
+                'Environment {} already exists.'.format(EnvironmentName)
+                )
+        for option in OptionSettings or []:
+            if option['OptionName'] == 'IamInstanceProfile':
+                instance_profile = self.provider.instance_profiles.get(
+                    option['Value']
+                    )
+                if instance_profile is None or \
+                        not self.provider.is_visible(instance_profile):
+                    raise _error(
+                        'InvalidParameterValue',
+                        'CreateEnvironment',
+                        'The instance profile {} associated with the '
+                        'environment does not exist.'.format(option['Value'])
+                        )
+        environment_id = 'e-{:010d}'.format(self.provider.next_id())
+        self.provider.environments[environment_id] = {
+            'region': self.region,
+            'EnvironmentId': environment_id,
+            'EnvironmentName': EnvironmentName,
+            'ApplicationName': ApplicationName,
+            'VersionLabel': VersionLabel,
+            'SolutionStackName': SolutionStackName,
+            'OptionSettings': _option_settings(OptionSettings),
+            'CNAME': '{}.{}.elasticbeanstalk.com'.format(
+                EnvironmentName,
+                self.region
+                ),
+            'Tier': Tier,
+            'transitions': [
+                (self.provider.now(), 'Launching'),
+                (self.provider.after(self.provider.eb_launch_seconds), 'Ready')
+                ]
+            }
+        return self._describe(self.provider.environments[environment_id])
+
+    @operation('DescribeEnvironments')
+    def describe_environments(
+                self,
+                ApplicationName = None,
+                EnvironmentNames = None,
+                IncludeDeleted = True,
+                **kwargs
+                ):
+        now = self.provider.now()
+        environments = []
+        for environment in self.provider.environments.values():
+            status = _status(environment['transitions'], now)
+            if environment['region'] != self.region or \
+                    ApplicationName not in (None, environment['ApplicationName']) or \
+                    (EnvironmentNames and
+                        environment['EnvironmentName'] not in EnvironmentNames) or \
+                    (status == 'Terminated' and not IncludeDeleted):
+                continue
+            environments.append(self._describe(environment))
+        return {'Environments': environments}
+
+    @operation('UpdateEnvironment')
+    def update_environment(
+                self,
+                EnvironmentName,
+                VersionLabel = None,
+                OptionSettings = None,
+                OptionsToRemove = None,
+                **kwargs
+                ):
+        environment = self._environment(EnvironmentName, 'UpdateEnvironment')
+        status = _status(environment['transitions'], self.provider.now())
+        if status != 'Ready':
+            raise _error(
+                'InvalidParameterValue',
+                'UpdateEnvironment',
+                'Environment named {} is in an invalid state for this '
+                'operation. Must be Ready.'.format(EnvironmentName)
+                )
+        if VersionLabel:
+            environment['VersionLabel'] = VersionLabel
+        removed = set(
+            (option['Namespace'], option['OptionName'])
+            for option in list(OptionSettings or []) + list(OptionsToRemove or [])
+            )
+        environment['OptionSettings'] = [
+            option for option in environment['OptionSettings']
+            if (option['Namespace'], option['OptionName']) not in removed
+            ] + _option_settings(OptionSettings)
+        environment['transitions'] = [
+            (self.provider.now(), 'Updating'),
+            (self.provider.after(self.provider.eb_update_seconds), 'Ready')
+            ]
+        return self._describe(environment)
+
+    @operation('SwapEnvironmentCNAMEs')
+    def swap_environment_cnames(
+                self,
+                SourceEnvironmentName,
+                DestinationEnvironmentName
+                ):
+        source = self._environment(SourceEnvironmentName, 'SwapEnvironmentCNAMEs')
+        destination = self._environment(
+            DestinationEnvironmentName,
+            'SwapEnvironmentCNAMEs'
+            )
+        source['CNAME'], destination['CNAME'] = \
+            destination['CNAME'], source['CNAME']
+        return {}
+
+    @operation('DescribeConfigurationSettings')
+    def describe_configuration_settings(
+                self,
+                ApplicationName,
+                EnvironmentName = None,
+                **kwargs
+                ):
+        environment = self._environment(
+            EnvironmentName,
+            'DescribeConfigurationSettings'
+            )
+        return {'ConfigurationSettings': [{
+            'ApplicationName': ApplicationName,
+            'EnvironmentName': EnvironmentName,
+            'OptionSettings': list(environment['OptionSettings'])
+            }]}
+
+    @operation('DescribeEnvironmentResources')
+    def describe_environment_resources(self, EnvironmentName):
+        environment = self._environment(
+            EnvironmentName,
+            'DescribeEnvironmentResources'
+            )
+        asg_name = 'awseb-{}-stack-AWSEBAutoScalingGroup'.format(
+            environment['EnvironmentId']
+            )
+        self.provider.auto_scaling_groups.setdefault(asg_name, {
+            'policies': {},
+            'metrics': []
+            })
+        return {'EnvironmentResources': {
+            'EnvironmentName': EnvironmentName,
+            'AutoScalingGroups': [{'Name': asg_name}]
+            }}
+
+    @operation('TerminateEnvironment')
+    def terminate_environment(self, EnvironmentName):
+        environment = self._environment(EnvironmentName, 'TerminateEnvironment')
+        environment['transitions'] = [
+            (self.provider.now(), 'Terminating'),
+            (
+                self.provider.after(self.provider.eb_terminate_seconds),
+                'Terminated'
+                )
+            ]
+        return self._describe(environment)
+
+
+class MemoryAutoScalingClient(MemoryClient):
+    service_name = 'autoscaling'
+
+    def _group(self, asg_name, operation_name):
+        group = self.provider.auto_scaling_groups.get(asg_name)
+        if group is None:
+            raise _error('ValidationError', operation_name, asg_name)
+        return group
+
+    @operation('EnableMetricsCollection')
+    def enable_metrics_collection(
+                self,
+                AutoScalingGroupName,
+                Granularity,
+                Metrics = None
+                ):
+        group = self._group(AutoScalingGroupName, 'EnableMetricsCollection')
+        group['metrics'] = sorted(set(group['metrics']) | set(Metrics or []))
+        return {}
+
+    @operation('PutScalingPolicy')
+    def put_scaling_policy(self, AutoScalingGroupName, PolicyName, **kwargs):
+        group = self._group(AutoScalingGroupName, 'PutScalingPolicy')
+        group['policies'][PolicyName] = kwargs
+        return {'PolicyARN': 'arn:aws:autoscaling:{}:{}:scalingPolicy:{}'.format(
+            self.region,
+            self.provider.account_id,
+            PolicyName
+            )}
+
+
+class MemoryCloudWatchClient(MemoryClient):
+    service_name = 'cloudwatch'
+
+    @operation('PutMetricAlarm')
+    def put_metric_alarm(self, AlarmName, **kwargs):
+        alarm = dict(kwargs)
+        alarm['AlarmName'] = AlarmName
+        self.provider.alarms[(self.region, AlarmName)] = alarm
+        return {}
+
+    @operation('DescribeAlarms')
+    def describe_alarms(self, AlarmNames=None, **kwargs):
+        return {'MetricAlarms': [
+            alarm for (region, name), alarm in
+                sorted(self.provider.alarms.items())
+            if region == self.region and
+                (AlarmNames is None or name in AlarmNames)
+            ]}
+
+    @operation('GetMetricStatistics')
+    def get_metric_statistics(
+                self,
+                Namespace,
+                MetricName,
+                Dimensions,
+                StartTime,
+                EndTime,
+                Period,
+                Statistics,
+                **kwargs
+                ):
+        # only the sqs metrics that bosscat reads, sampled from the queues
+        datapoints = []
+        if Namespace == 'AWS/SQS' and \
+                MetricName == 'ApproximateAgeOfOldestMessage':
+            queue_name = dict(
+                (dimension['Name'], dimension['Value'])
+                for dimension in Dimensions
+                )['QueueName']
+            for queue in self.provider.queues.values():
+                if queue['name'] == queue_name and queue['region'] == self.region:
+                    now = self.provider.now()
+                    age = max([
+                        (now - message['SentTimestamp']) / self.provider.time_scale
+                        for message in queue['messages']
+                        ] or [0.0])
+                    datapoint = {'Timestamp': now, 'Unit': 'Seconds'}
+                    for statistic in Statistics:
+                        datapoint[statistic] = age
+                    datapoints.append(datapoint)
+        return {'Label': MetricName, 'Datapoints': datapoints}
+
+    @operation('DeleteAlarms')
+    def delete_alarms(self, AlarmNames):
+        for name in AlarmNames:
+            if (self.region, name) not in self.provider.alarms:
+                raise _error('ResourceNotFound', 'DeleteAlarms', name, 404)
+        for name in AlarmNames:
+            del self.provider.alarms[(self.region, name)]
+        return {}
+
+
+INSTANCE_TYPES = {
+    't3.micro': (2, 1024),
+    't3.small': (2, 2048),
+    't3.medium': (2, 4096),
+    't3.large': (2, 8192),
+    'm5.large': (2, 8192),
+    'm5.xlarge': (4, 16384),
+    'c5.large': (2, 4096),
+    'c5.xlarge': (4, 8192),
+    'c5.2xlarge': (8, 16384),
+    }
+
+
+class MemoryEC2Client(MemoryClient):
+    service_name = 'ec2'
+
+    @operation('DescribeInstanceTypes')
+    def describe_instance_types(self, InstanceTypes):
+        instance_types = []
+        for instance_type in InstanceTypes:
+            if instance_type not in INSTANCE_TYPES:
+                raise _error(
+                    'InvalidInstanceType',
+                    'DescribeInstanceTypes',
+                    instance_type
+                    )
+            vcpus, memory_mb = INSTANCE_TYPES[instance_type]
+            instance_types.append({
+                'InstanceType': instance_type,
+                'VCpuInfo': {'DefaultVCpus': vcpus},
+                'MemoryInfo': {'SizeInMiB': memory_mb}
+                })
+        return {'InstanceTypes': instance_types}
+
+
+MEMORY_CLIENTS = {
+    'autoscaling': MemoryAutoScalingClient,
+    'cloudwatch': MemoryCloudWatchClient,
+    'ec2': MemoryEC2Client,
+    'elasticbeanstalk': MemoryElasticBeanstalkClient,
+    'iam': MemoryIAMClient,
+    'rds': MemoryRDSClient,
+    's3': MemoryS3Client,
+    'sns': MemorySNSClient,
+    'sqs': MemorySQSClient,
+    'sts': MemorySTSClient,
+    }
@@ -0,0 +1,265 @@
+import atexit
+from importlib import import_module
+import mmap
+import multiprocessing
+import os
+import pickle
+import signal
+from tempfile import mkstemp
+from threading import Condition
+import traceback
+
+
+DEFAULT_MAX_TASKS_PER_CHILD = 1000
+# pickles larger than this are handed over in a tmpfs file that the reader
+#   maps, instead of being copied through the pipe in small writes
+SHARED_MEMORY_THRESHOLD = 1 << 20
+SHARED_MEMORY_DIRECTORY = '/dev/shm'
+KILL_GRACE_SECONDS = 2
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class WorkerProcessDied(Exception):
+    pass
+
+
+class RemoteError(Exception):
+    """an exception from a pool process that could not be pickled"""
+    pass
+
+
+def dumps(obj):
+    """pickle obj for the pipe: ('pipe', bytes) or ('file', path)"""
+    payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    if len(payload) < SHARED_MEMORY_THRESHOLD:
+        return ('pipe', payload)
+    directory = SHARED_MEMORY_DIRECTORY
+    if not os.path.isdir(directory):
+        directory = None
+    fd, path = mkstemp(prefix='bosscat-', dir=directory)
+    with os.fdopen(fd, 'wb') as payload_file:
+        payload_file.write(payload)
+    return ('file', path)
+
+
+def loads(message):
+    kind, value = message
+    if kind == 'pipe':
+        return pickle.loads(value)
+    try:
+        with open(value, 'rb') as payload_file:
+            mapped = mmap.mmap(
+                payload_file.fileno(),
+                0,
+                access = mmap.ACCESS_READ
+                )
+            try:
+                return pickle.loads(mapped)
+            finally:
+                mapped.close()
+    finally:
+        discard(message)
+
+
+def discard(message):
+    """remove the file of a message that may never be read"""
+    kind, value = message
+    if kind == 'file':
+        try:
+            os.unlink(value)
+        except OSError:
+            pass
+
+
+def _child_main(connection, target, max_tasks):
+    # the parent handles termination; a child only stops when its pipe
+    #   closes, it is told to, or it has run max_tasks
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    tasks = 0
+    while not max_tasks or tasks < max_tasks:
+        try:
+            task = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if task is None:
+            return
+        tasks += 1
+        try:
+            reply = ('ok', dumps(target(loads(task))))
+        except BaseException as ex:
+            error_traceback = traceback.format_exc()
+            try:
+                pickle.dumps(ex)
+            except Exception:
+                ex = RemoteError(repr(ex))
+            reply = ('error', ex, error_traceback)
+        connection.send(reply)
+
+
+class _Child(object):
+
+    def __init__(self, process, connection):
+        self.process = process
+        self.connection = connection
+        self.tasks = 0
+
+
+class ProcessPool(object):
+    """persistent forked processes that run target(task) for the caller
+
+    Processes are forked from a fork server, a process of its own that
+    imports the modules in preload once and has no threads, so children
+    share the modules and never inherit locks held by the caller's
+    threads.  This holds as well for children forked later from request
+    threads: a task that runs past its timeout has its process killed and
+    replaced, and so does any process that has run max_tasks_per_child
+    tasks, which bounds slow memory leaks.  target and tasks must pickle.
+    """
+
+    def __init__(
+                self,
+                target,
+                processes = None,
+                max_tasks_per_child = DEFAULT_MAX_TASKS_PER_CHILD,
+                preload = ()
+                ):
+        self.target = target
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_tasks_per_child = max_tasks_per_child
+        self.preload = list(preload)
+        self.context = multiprocessing.get_context('forkserver')
+        # the fork server is shared by the whole process and takes the
+        #   preload of the first pool that starts it
+        self.context.set_forkserver_preload(self.preload)
+        self._reset()
+        atexit.register(self.close)
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.condition = Condition()
+        self.idle = []
+        self.live = 0
+
+    def start(self):
+        """start the fork server and fork every process now
+
+        The preloaded modules are imported here too, so that a module that
+        fails to import fails the caller rather than each child.
+        """
+        for module_name in self.preload:
+            import_module(module_name)
+        children = []
+        with self.condition:
+            starting = self.processes - self.live
+            self.live += starting
+        for index in range(starting):
+            children.append(self._start_child())
+        with self.condition:
+            self.idle.extend(children)
+            self.condition.notify_all()
+
+    def _start_child(self):
+        parent_connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            target = _child_main,
+            args = (child_connection, self.target, self.max_tasks_per_child)
+            )
+        process.daemon = True
+        process.start()
+        child_connection.close()
+        return _Child(process, parent_connection)
+
+    def _acquire(self):
+        if self.pid != os.getpid():
+            # a forked copy of the pool; the processes belong to the parent
+            self._reset()
+        with self.condition:
+            while not self.idle and self.live >= self.processes:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.live += 1
+        try:
+            return self._start_child()
+        except BaseException:
+            self._release(None)
+            raise
+
+    def _release(self, child):
+        retired = child is None or (
+            self.max_tasks_per_child and
+            child.tasks >= self.max_tasks_per_child
+            )
+        if retired and child is not None:
+            # the child exits by itself after its last task
+            child.process.join(KILL_GRACE_SECONDS)
+            self._kill(child)
+        with self.condition:
+            if retired:
+                self.live -= 1
+            else:
+                self.idle.append(child)
+            self.condition.notify()
+
+    def _kill(self, child):
+        if child.process.is_alive():
+            child.process.terminate()
+            child.process.join(KILL_GRACE_SECONDS)
+        if child.process.is_alive():
+            os.kill(child.process.pid, signal.SIGKILL)
+            child.process.join()
+        child.connection.close()
+
+    def run(self, task, timeout=None):
+        """run target(task) in a pool process and return its result"""
+        child = self._acquire()
+        message = None
+        try:
+            message = dumps(task)
+            child.connection.send(message)
+            child.tasks += 1
+            if not child.connection.poll(timeout):
+                self._kill(child)
+                child = None
+                raise TaskTimeout('task ran for more than {}s'.format(timeout))
+            try:
+                reply = child.connection.recv()
+            except EOFError:
+                self._kill(child)
+                exitcode = child.process.exitcode
+                child = None
+                raise WorkerProcessDied('exit code {}'.format(exitcode))
+        except BaseException:
+            if child is not None:
+                # the pipe may hold half a message; the process can not be
+                #   trusted with another task
+                self._kill(child)
+                child = None
+            raise
+        finally:
+            if message is not None:
+                discard(message)
+            self._release(child)
+        if reply[0] == 'error':
+            ex = reply[1]
+            ex.remote_traceback = reply[2]
+            raise ex
+        return loads(reply[1])
+
+    def close(self):
+        """stop the idle processes; busy ones are daemons and end with us"""
+        if self.pid != os.getpid():
+            return
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.live -= len(idle)
+        for child in idle:
+            try:
+                child.connection.send(None)
+            except (OSError, ValueError):
+                pass
+            child.process.join(KILL_GRACE_SECONDS)
+            self._kill(child)
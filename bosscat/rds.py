@@ -1,13 +1,36 @@
-import boto3
+from hashlib import sha1
+from itertools import count, islice
+from uuid import uuid4
 
+from botocore.exceptions import ClientError
 
+from bosscat import trace
+from bosscat.utils import client_error_code, get_client
+
+
+DB_INSTANCE_NOT_FOUND = 'DBInstanceNotFound'
+DB_INSTANCE_ALREADY_EXISTS = 'DBInstanceAlreadyExists'
+INVALID_DB_INSTANCE_STATE = 'InvalidDBInstanceState'
+
+
+POOL_TAG = 'bosscat:warm-pool'
+DEPLOYMENT_TAG = 'bosscat:deployment'
+DEFAULT_WAIT_TIMEOUT = 3600
+
+
+class InstanceNotReady(Exception):
+    pass
+
+
+@trace.traced
 def create_instance_from_snapshot(
         region,
         db_instance_identifier,
         db_snapshot_identifier,
-        db_instance_class
+        db_instance_class,
+        tags = None
         ):
-    rds = boto3.client('rds', region)
+    rds = get_client('rds', region)
     response = rds.restore_db_instance_from_db_snapshot(
         DBInstanceIdentifier = db_instance_identifier,
         DBSnapshotIdentifier = db_snapshot_identifier,
@@ -15,36 +38,41 @@ def create_instance_from_snapshot(
         MultiAZ = False,
         PubliclyAccessible = True,
         AutoMinorVersionUpgrade = True,
+        Tags = [{'Key': key, 'Value': value} for key, value in (tags or {}).items()]
         )
 
 
+@trace.traced
 def delete_instance(region, db_instance_identifier):
-    rds = boto3.client('rds', region)
+    rds = get_client('rds', region)
     response = rds.delete_db_instance(
         DBInstanceIdentifier = db_instance_identifier,
         SkipFinalSnapshot = True
         )
 
 
+@trace.traced
 def get_instances(region):
-    rds = boto3.client('rds', region)
+    rds = get_client('rds', region)
     return rds.describe_db_instances()['DBInstances']
 
 
+@trace.traced
 def get_instance_status(region, db_instance_identifier):
-    rds = boto3.client('rds', region)
+    rds = get_client('rds', region)
     response = rds.describe_db_instances(
         DBInstanceIdentifier = db_instance_identifier
         )
     return response['DBInstances'][0]['DBInstanceStatus']
 
 
+@trace.traced
 def modify_vpc_security_groups(
         region,
         db_instance_identifier,
         vpc_security_group_ids
         ):
-    rds = boto3.client('rds', region)
+    rds = get_client('rds', region)
     response = rds.modify_db_instance(
         DBInstanceIdentifier = db_instance_identifier,
         VpcSecurityGroupIds = vpc_security_group_ids,
@@ -52,3 +80,192 @@ def modify_vpc_security_groups(
         )
 
 
+def get_pool_name(app_id, deployment_delta, db_snapshot_identifier, db_instance_class):
+    # instances restored from another snapshot or class never share a pool
+    return '{}-{}-{}-{}'.format(
+        app_id,
+        deployment_delta,
+        db_snapshot_identifier,
+        db_instance_class
+        )
+
+
+def get_pool_prefix(app_id, deployment_delta):
+    return '{}-{}-pool-'.format(app_id, deployment_delta)
+
+
+def get_pool_slot_name(pool_name, pool_prefix, index):
+    # the pools of an app share the prefix, so the slot names of each pool
+    #   start with a digest of its name
+    return '{}{}{:04d}'.format(
+        pool_prefix,
+        sha1(pool_name.encode('utf-8')).hexdigest()[:8],
+        index
+        )
+
+
+def _tags(instance):
+    return dict((tag['Key'], tag['Value']) for tag in instance.get('TagList', []))
+
+
+@trace.traced
+def get_pool_instances(region, pool_name, pool_prefix, instances=None):
+    """the instances of a warm pool, whatever their status
+
+    Claimed instances keep the pool tag until they are retagged, but they
+    no longer have a pool name once the rename is applied, and they are
+    renaming until then, so they are never claimed twice.
+    """
+    if instances is None:
+        instances = get_instances(region)
+    return [
+        instance for instance in instances
+        if _tags(instance).get(POOL_TAG) == pool_name and
+            instance['DBInstanceIdentifier'].startswith(pool_prefix) and
+            instance['DBInstanceStatus'] != 'deleting'
+        ]
+
+
+@trace.traced
+def replenish_pool(
+            region,
+            pool_name,
+            pool_prefix,
+            db_snapshot_identifier,
+            db_instance_class,
+            size,
+            exclude = ()
+            ):
+    """restore instances until the pool has size of them; return their names
+
+    Instances in exclude, and those being renamed, have been claimed and
+    are not counted.  The missing instances are restored into the first
+    free slot names of the pool, so deploys in separate processes that
+    replenish at the same time pick the same names; rds restores each name
+    once, and the deploy that loses the race leaves that slot to the other.
+    """
+    instances = get_instances(region)
+    taken = set(instance['DBInstanceIdentifier'] for instance in instances)
+    ready = [
+        instance
+        for instance in get_pool_instances(
+            region,
+            pool_name,
+            pool_prefix,
+            instances
+            )
+        if instance['DBInstanceIdentifier'] not in exclude and
+            instance['DBInstanceStatus'] != 'renaming'
+        ]
+    missing = max(size - len(ready), 0)
+    free_names = islice(
+        (
+            name
+            for name in (
+                get_pool_slot_name(pool_name, pool_prefix, index)
+                for index in count()
+                )
+            if name not in taken
+            ),
+        missing
+        )
+    created = []
+    for db_instance_identifier in free_names:
+        try:
+            create_instance_from_snapshot(
+                region,
+                db_instance_identifier,
+                db_snapshot_identifier,
+                db_instance_class,
+                tags = {POOL_TAG: pool_name}
+                )
+        except ClientError as ex:
+            if client_error_code(ex) != DB_INSTANCE_ALREADY_EXISTS:
+                raise(ex)
+            continue
+        created.append(db_instance_identifier)
+    return created
+
+
+@trace.traced
+def claim_pool_instance(
+            region,
+            pool_name,
+            pool_prefix,
+            db_instance_identifier,
+            vpc_security_group_ids
+            ):
+    """rename an available pool instance to db_instance_identifier
+
+    The rename is the claim: rds lets only one deploy rename an instance,
+    and the others fail with an instance that is gone or modifying and
+    move on to the next one.  Returns the pool name of the claimed
+    instance, or None when no instance is available.  Retag the instance
+    with retag_instance once the rename has been applied.
+    """
+    rds = get_client('rds', region)
+    candidates = [
+        instance
+        for instance in get_pool_instances(region, pool_name, pool_prefix)
+        if instance['DBInstanceStatus'] == 'available'
+        ]
+    for instance in candidates:
+        try:
+            rds.modify_db_instance(
+                DBInstanceIdentifier = instance['DBInstanceIdentifier'],
+                NewDBInstanceIdentifier = db_instance_identifier,
+                VpcSecurityGroupIds = vpc_security_group_ids,
+                ApplyImmediately = True
+                )
+        except ClientError as ex:
+            if client_error_code(ex) not in (
+                        DB_INSTANCE_NOT_FOUND,
+                        INVALID_DB_INSTANCE_STATE
+                        ):
+                raise(ex)
+            continue
+        return instance['DBInstanceIdentifier']
+    return None
+
+
+@trace.traced
+def return_instance_to_pool(region, pool_name, pool_prefix, db_instance_identifier):
+    """rename a claimed instance back into its pool
+
+    The instance keeps whatever data the deployment wrote to it, so only
+    return instances of deployments that can share data.  The pool tag is
+    set first, as it survives the rename.
+    """
+    rds = get_client('rds', region)
+    retag_instance(
+        region,
+        db_instance_identifier,
+        {POOL_TAG: pool_name},
+        [DEPLOYMENT_TAG]
+        )
+    pool_instance_identifier = pool_prefix + uuid4().hex[:12]
+    rds.modify_db_instance(
+        DBInstanceIdentifier = db_instance_identifier,
+        NewDBInstanceIdentifier = pool_instance_identifier,
+        ApplyImmediately = True
+        )
+    return pool_instance_identifier
+
+
+@trace.traced
+def retag_instance(region, db_instance_identifier, add_tags, remove_tag_keys):
+    # the arn names the instance, so retag only after a rename is applied
+    rds = get_client('rds', region)
+    instance = rds.describe_db_instances(
+        DBInstanceIdentifier = db_instance_identifier
+        )['DBInstances'][0]
+    if remove_tag_keys:
+        rds.remove_tags_from_resource(
+            ResourceName = instance['DBInstanceArn'],
+            TagKeys = remove_tag_keys
+            )
+    if add_tags:
+        rds.add_tags_to_resource(
+            ResourceName = instance['DBInstanceArn'],
+            Tags = [{'Key': key, 'Value': value} for key, value in add_tags.items()]
+            )
@@ -0,0 +1,402 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from time import sleep, time
+
+from bosscat import trace
+from bosscat.sqs import decode_message_body
+from bosscat.utils import get_client, try_client
+
+
+DEFAULT_RECEIVERS = 16
+DEFAULT_WAIT_SECONDS = 2
+# inspected messages stay invisible while the rest of the queue is read,
+#   but only this long, and at most MAX_HELD of them are held before they
+#   are released, well under the 120,000 messages sqs allows in flight; a
+#   message received again is recognized by its id and not counted twice
+DEFAULT_VISIBILITY_TIMEOUT = 120
+MAX_HELD = 50000
+# a receiver stops after this many empty long polls in a row, or once a
+#   whole visibility timeout passes without a message it has not seen
+EMPTY_RECEIVES = 2
+BATCH_SIZE = 10
+# deletes that failed on the server's side are tried again this many times
+DELETE_ATTEMPTS = 3
+
+
+class RateLimiter(object):
+    """block callers so that at most rate units pass per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = Lock()
+        self.next_time = time()
+
+    def wait(self, units=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time()
+            start = max(now, self.next_time)
+            self.next_time = start + units / float(self.rate)
+        if start > now:
+            sleep(start - now)
+
+
+def get_message_filter(
+            worker_keys = None,
+            min_age = None,
+            max_age = None,
+            min_receive_count = None,
+            predicate = None
+            ):
+    """return a function of (message, msg_dict) that picks what to redrive
+
+    Ages are in seconds since the message was first sent.  Dead letter
+    messages carry no error of their own, so errors are matched by
+    min_receive_count, or by a predicate over the message and its decoded
+    msg_dict; the predicate also sees messages that failed to decode, with
+    msg_dict None.
+    """
+    def message_filter(message, msg_dict):
+        if msg_dict is None:
+            return bool(predicate and predicate(message, msg_dict))
+        if worker_keys and msg_dict.get('worker_key') not in worker_keys:
+            return False
+        age = get_message_age(message)
+        if min_age is not None and age < min_age:
+            return False
+        if max_age is not None and age > max_age:
+            return False
+        receive_count = int(
+            message['Attributes'].get('ApproximateReceiveCount', 0)
+            )
+        if min_receive_count is not None and receive_count < min_receive_count:
+            return False
+        if predicate and not predicate(message, msg_dict):
+            return False
+        return True
+    return message_filter
+
+
+def get_message_age(message, now=None):
+    sent = int(message['Attributes']['SentTimestamp']) / 1000.0
+    return (now or time()) - sent
+
+
+def _batches(items, size=BATCH_SIZE):
+    return [items[offset:offset + size] for offset in range(0, len(items), size)]
+
+
+class Redrive(object):
+    """drain a dead letter queue and resend the messages that match
+
+    Each receiver thread long polls the dead letter queue, decodes the
+    envelopes and sends matching messages back to the main queue with
+    send_message_batch before deleting them with delete_message_batch.
+    Messages that do not match, and every message in a dry run, are made
+    visible again whenever MAX_HELD of them are held, and once the queue is
+    drained.  Errors of the receivers are raised by run after the held
+    messages are released.
+    """
+
+    def __init__(
+                self,
+                region,
+                dead_letter_queue_name,
+                queue_name,
+                message_filter = None,
+                dry_run = True,
+                max_per_second = None,
+                receivers = DEFAULT_RECEIVERS,
+                wait_seconds = DEFAULT_WAIT_SECONDS,
+                visibility_timeout = DEFAULT_VISIBILITY_TIMEOUT,
+                secret = None,
+                alert = None
+                ):
+        self.region = region
+        self.client = get_client('sqs', region)
+        self.dead_letter_queue_url = self.client.get_queue_url(
+            QueueName = dead_letter_queue_name
+            )['QueueUrl']
+        self.queue_url = self.client.get_queue_url(
+            QueueName = queue_name
+            )['QueueUrl']
+        self.message_filter = message_filter or get_message_filter()
+        self.dry_run = dry_run
+        self.rate_limiter = RateLimiter(max_per_second)
+        self.receivers = receivers
+        self.wait_seconds = wait_seconds
+        self.visibility_timeout = visibility_timeout
+        self.secret = secret
+        self.alert = alert or (lambda message: None)
+        self.lock = Lock()
+        self.held = []
+        self.seen = set()
+        self.received_again = []
+        self.last_new = time()
+        self.errors = []
+        self.stats = Counter()
+        self.worker_keys = Counter()
+        self.oldest_age = None
+
+    def run(self):
+        threads = [
+            Thread(target=trace.bind(self.receive_loop))
+            for index in range(self.receivers)
+            ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.release(self.held + self.received_again)
+        if self.errors:
+            raise self.errors[0]
+        return self.get_summary()
+
+    def receive_loop(self):
+        try:
+            self._receive_loop()
+        except Exception as ex:
+            self.alert('Receiver failed: {!r}'.format(ex))
+            with self.lock:
+                self.errors.append(ex)
+
+    def _receive_loop(self):
+        empty_receives = 0
+        while empty_receives < EMPTY_RECEIVES and not self.errors and \
+                time() - self.last_new < self.visibility_timeout:
+            response = {}
+            try_client(
+                lambda: response.update(self.client.receive_message(
+                    QueueUrl = self.dead_letter_queue_url,
+                    MaxNumberOfMessages = BATCH_SIZE,
+                    WaitTimeSeconds = self.wait_seconds,
+                    VisibilityTimeout = self.visibility_timeout,
+                    AttributeNames = ['All']
+                    ))
+                )
+            messages = response.get('Messages', [])
+            if not messages:
+                empty_receives += 1
+                continue
+            empty_receives = 0
+            self.handle_batch(messages)
+
+    def handle_batch(self, messages):
+        with self.lock:
+            new = []
+            for message in messages:
+                if message['MessageId'] in self.seen:
+                    # released or timed out earlier; it stays in flight, out
+                    #   of the way of the rest, until the run ends
+                    self.received_again.append(message)
+                else:
+                    self.seen.add(message['MessageId'])
+                    new.append(message)
+            if new:
+                self.last_new = time()
+        messages = new
+        decoded = []
+        for message in messages:
+            try:
+                msg_dict = decode_message_body(message['Body'], self.secret)
+            except Exception:
+                msg_dict = None
+            decoded.append((message, msg_dict))
+        matched = []
+        held = []
+        now = time()
+        with self.lock:
+            for message, msg_dict in decoded:
+                self.stats['received'] += 1
+                if msg_dict is None:
+                    self.stats['undecodable'] += 1
+                worker_key = msg_dict.get('worker_key') if msg_dict else None
+                self.worker_keys[worker_key] += 1
+                age = get_message_age(message, now)
+                self.oldest_age = max(self.oldest_age or 0, age)
+                if self.message_filter(message, msg_dict):
+                    self.stats['matched'] += 1
+                    matched.append(message)
+                else:
+                    held.append(message)
+            if self.dry_run:
+                held.extend(matched)
+                matched = []
+            self.held.extend(held)
+            released = []
+            if len(self.held) >= MAX_HELD:
+                released, self.held = self.held, []
+        if matched:
+            self.resend(matched)
+        self.release(released)
+
+    def resend(self, messages):
+        self.rate_limiter.wait(len(messages))
+        entries = []
+        for index, message in enumerate(messages):
+            entry = {'Id': str(index), 'MessageBody': message['Body']}
+            # fifo messages keep their group; the dead letter message id
+            #   deduplicates a resend that is retried
+            group_id = message['Attributes'].get('MessageGroupId')
+            if group_id:
+                entry['MessageGroupId'] = group_id
+                entry['MessageDeduplicationId'] = message['MessageId']
+            entries.append(entry)
+        response = {}
+        try_client(
+            lambda: response.update(self.client.send_message_batch(
+                QueueUrl = self.queue_url,
+                Entries = entries
+                ))
+            )
+        sent = [messages[int(result['Id'])] for result in response['Successful']]
+        failed = [messages[int(result['Id'])] for result in response['Failed']]
+        for result in response['Failed']:
+            self.alert('Resend failed: {} {}'.format(
+                result['Code'],
+                result.get('Message', '')
+                ))
+        undeleted = self.delete(sent) if sent else []
+        with self.lock:
+            # an undeleted message was resent but stays in the dead letter
+            #   queue, where a later redrive would send it again
+            self.stats['redriven'] += len(sent) - len(undeleted)
+            self.stats['undeleted'] += len(undeleted)
+            self.stats['failed'] += len(failed)
+            self.held.extend(failed)
+
+    def delete(self, messages):
+        """delete messages from the dead letter queue; return those left"""
+        undeleted = []
+        for attempt in range(1, DELETE_ATTEMPTS + 1):
+            response = {}
+            try_client(
+                lambda: response.update(self.client.delete_message_batch(
+                    QueueUrl = self.dead_letter_queue_url,
+                    Entries = [
+                        {'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']}
+                        for index, message in enumerate(messages)
+                        ]
+                    ))
+                )
+            retried = []
+            for result in response.get('Failed', []):
+                message = messages[int(result['Id'])]
+                if result.get('SenderFault') or attempt == DELETE_ATTEMPTS:
+                    self.alert('Delete failed: {} {}'.format(
+                        result['Code'],
+                        result.get('Message', '')
+                        ))
+                    undeleted.append(message)
+                else:
+                    retried.append(message)
+            if not retried:
+                break
+            messages = retried
+        return undeleted
+
+    def release(self, messages):
+        """make held messages visible in the dead letter queue again"""
+        def release_batch(batch):
+            try_client(
+                lambda: self.client.change_message_visibility_batch(
+                    QueueUrl = self.dead_letter_queue_url,
+                    Entries = [
+                        {
+                            'Id': str(index),
+                            'ReceiptHandle': message['ReceiptHandle'],
+                            'VisibilityTimeout': 0
+                            }
+                        for index, message in enumerate(batch)
+                        ]
+                    )
+                )
+        batches = _batches(messages)
+        if not batches:
+            return
+        with ThreadPoolExecutor(
+                    max_workers = min(self.receivers, len(batches))
+                    ) as executor:
+            list(executor.map(trace.bind(release_batch), batches))
+
+    def get_summary(self):
+        with self.lock:
+            return {
+                'dry_run': self.dry_run,
+                'received': self.stats['received'],
+                'matched': self.stats['matched'],
+                'redriven': self.stats['redriven'],
+                'undeleted': self.stats['undeleted'],
+                'failed': self.stats['failed'],
+                'undecodable': self.stats['undecodable'],
+                'worker_keys': dict(self.worker_keys),
+                'oldest_age': self.oldest_age
+                }
+
+
+@trace.traced
+def redrive(
+            region,
+            dead_letter_queue_name,
+            queue_name,
+            worker_keys = None,
+            min_age = None,
+            max_age = None,
+            min_receive_count = None,
+            predicate = None,
+            dry_run = True,
+            max_per_second = None,
+            receivers = DEFAULT_RECEIVERS,
+            secret = None,
+            alert = None
+            ):
+    """resend matching dead letter messages to their queue; return a summary
+
+    Dry runs (the default) only count the messages by worker_key.
+    """
+    return Redrive(
+        region,
+        dead_letter_queue_name,
+        queue_name,
+        message_filter = get_message_filter(
+            worker_keys,
+            min_age,
+            max_age,
+            min_receive_count,
+            predicate
+            ),
+        dry_run = dry_run,
+        max_per_second = max_per_second,
+        receivers = receivers,
+        secret = secret,
+        alert = alert
+        ).run()
+
+
+def format_summary(summary):
+    lines = ['{} {} messages, {} matched, {} redriven, {} failed'.format(
+        'Dry run:' if summary['dry_run'] else 'Redrive:',
+        summary['received'],
+        summary['matched'],
+        summary['redriven'],
+        summary['failed']
+        )]
+    if summary['undeleted']:
+        lines.append(
+            '{} messages were resent but could not be deleted from the '
+            'dead letter queue'.format(summary['undeleted'])
+            )
+    if summary['undecodable']:
+        lines.append('{} messages could not be decoded'.format(
+            summary['undecodable']
+            ))
+    if summary['oldest_age'] is not None:
+        lines.append('oldest message {:.0f}s'.format(summary['oldest_age']))
+    for worker_key, total in sorted(
+                summary['worker_keys'].items(),
+                key = lambda item: -item[1]
+                ):
+        lines.append('{:>8} {}'.format(total, worker_key))
+    return '\n'.join(lines)
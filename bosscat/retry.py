@@ -0,0 +1,335 @@
+from random import random
+from threading import Condition, Lock, local
+from time import sleep, time
+
+from botocore.exceptions import ClientError
+
+from bosscat import trace
+
+
+THROTTLE = 'throttle'
+EVENTUAL = 'eventual'
+FATAL = 'fatal'
+
+
+THROTTLE_CODES = frozenset([
+    'BandwidthLimitExceeded',
+    'EC2ThrottledException',
+    'PriorRequestNotComplete',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+    'ThrottledException',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    ])
+# errors that go away once an earlier change has propagated: an iam
+#   entity not yet visible to iam, a queue name still held after its queue
+#   was deleted, an instance still modifying; anything else that is not a
+#   throttle fails at once.  Validation errors that only mean a new role
+#   has not reached another service are retried by the callers that
+#   expect them, through call's eventual
+EVENTUAL_CODES = frozenset([
+    'AWS.SimpleQueueService.QueueDeletedRecently',
+    'ConcurrentModification',
+    'DeleteConflict',
+    'InvalidDBInstanceState',
+    'NoSuchEntity',
+    'OperationAborted',
+    'QueueDeletedRecently',
+    'RequestTimeout',
+    'RequestTimeoutException',
+    ])
+
+
+# backoff never sleeps longer than this for one retry
+MAX_DELAY_SECONDS = {THROTTLE: 20.0, EVENTUAL: 10.0}
+# as in the standard retry mode of the aws sdks: a throttle retry spends
+#   RETRY_COST from its service's budget and a success refunds one, so a
+#   service that keeps throttling stops being retried by every thread
+DEFAULT_BUDGET = 500
+RETRY_COST = 5
+SUCCESS_REFUND = 1
+# calls in flight to one service; halved on a throttle, then raised by
+#   one for every limit successful calls
+DEFAULT_MAX_CONCURRENCY = 64
+
+
+error_code = lambda ex: ex.response['Error']['Code']
+
+
+def classify(ex):
+    """return THROTTLE, EVENTUAL or FATAL for a ClientError"""
+    code = error_code(ex)
+    status_code = ex.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    if code in THROTTLE_CODES or status_code >= 500:
+        return THROTTLE
+    if code in EVENTUAL_CODES:
+        return EVENTUAL
+    return FATAL
+
+
+def get_delay(attempt, base_delay, error_class):
+    """exponential backoff with full jitter, so that threads that failed
+    together do not retry together"""
+    return random() * min(
+        MAX_DELAY_SECONDS[error_class],
+        base_delay * 2 ** (attempt - 1)
+        )
+
+
+class ServiceLimiter(object):
+    """concurrency limit, retry budget and counters for one aws service,
+    shared by every thread of the process"""
+
+    def __init__(self, service_name, max_concurrency, budget):
+        self.service_name = service_name
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.min_limit = self.limit
+        self.max_budget = budget
+        self.budget = budget
+        self.active = 0
+        self.decreased = 0
+        self.condition = Condition()
+        self.counts = {
+            'calls': 0,
+            'throttled': 0,
+            THROTTLE: 0,
+            EVENTUAL: 0,
+            'failed': 0,
+            'exhausted': 0,
+            'retry_seconds': 0.0
+            }
+
+    def acquire(self):
+        """wait for a free slot; return the start time for release"""
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+        return time()
+
+    def release(self, started, error_class=None):
+        with self.condition:
+            self.active -= 1
+            self.counts['calls'] += 1
+            if error_class == THROTTLE:
+                self.counts['throttled'] += 1
+                # calls sent before the last decrease saw the old limit;
+                #   their throttles must not halve it again
+                if started > self.decreased:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.min_limit = min(self.min_limit, self.limit)
+                    self.decreased = time()
+            elif error_class is None:
+                self.limit = min(
+                    self.max_concurrency,
+                    self.limit + 1.0 / self.limit
+                    )
+                self.budget = min(self.max_budget, self.budget + SUCCESS_REFUND)
+            self.condition.notify_all()
+
+    def spend(self, cost):
+        with self.condition:
+            if self.budget < cost:
+                self.counts['exhausted'] += 1
+                return False
+            self.budget -= cost
+            return True
+
+    def count(self, name, seconds=0.0):
+        with self.condition:
+            self.counts[name] += 1
+            self.counts['retry_seconds'] += seconds
+
+    def get_stats(self):
+        with self.condition:
+            return dict(
+                self.counts,
+                limit = int(self.limit),
+                min_limit = int(self.min_limit),
+                budget = self.budget
+                )
+
+
+_limiters = {}
+_limiters_lock = Lock()
+_options = {
+    'max_concurrency': DEFAULT_MAX_CONCURRENCY,
+    'budget': DEFAULT_BUDGET
+    }
+_local = local()
+
+
+def get_limiter(service_name):
+    with _limiters_lock:
+        if service_name not in _limiters:
+            _limiters[service_name] = ServiceLimiter(
+                service_name,
+                _options['max_concurrency'],
+                _options['budget']
+                )
+        return _limiters[service_name]
+
+
+def configure(max_concurrency=None, budget=None):
+    """change the limits of every service, resetting limiters and counters"""
+    with _limiters_lock:
+        if max_concurrency is not None:
+            _options['max_concurrency'] = max_concurrency
+        if budget is not None:
+            _options['budget'] = budget
+        _limiters.clear()
+
+
+def reset():
+    configure()
+
+
+def get_stats():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return dict(
+        (limiter.service_name, limiter.get_stats())
+        for limiter in limiters
+        )
+
+
+def get_stats_since(before):
+    """the counts of get_stats added since the snapshot before
+
+    The limiters are shared by every thread of the process, so concurrent
+    runs (a fleet) see each other's calls in their counts.
+    """
+    stats = {}
+    for service_name, counts in get_stats().items():
+        earlier = before.get(service_name, {})
+        stats[service_name] = dict(
+            (name, value if name in ('limit', 'min_limit', 'budget')
+                else value - earlier.get(name, 0))
+            for name, value in counts.items()
+            )
+    return stats
+
+
+def format_stats(stats=None):
+    """one line per service that was throttled or retried"""
+    stats = get_stats() if stats is None else stats
+    lines = []
+    for service_name, counts in sorted(stats.items()):
+        retries = counts[THROTTLE] + counts[EVENTUAL]
+        if not (retries or counts['throttled'] or counts['failed']):
+            continue
+        lines.append(
+            '{}: {} calls, {} throttled, {} retries ({} throttle, {} eventual) '
+            'in {:.2f}s, {} failed, {} out of budget, concurrency {} (min {})'
+            .format(
+                service_name,
+                counts['calls'],
+                counts['throttled'],
+                retries,
+                counts[THROTTLE],
+                counts[EVENTUAL],
+                counts['retry_seconds'],
+                counts['failed'],
+                counts['exhausted'],
+                counts['limit'],
+                counts['min_limit']
+                ))
+    return '\n'.join(lines)
+
+
+def before_call(service_name):
+    """take a slot for a call to service_name; return a token for after_call"""
+    # remembered so that a failed call can be charged to its service
+    _local.service_name = service_name
+    limiter = get_limiter(service_name)
+    return limiter, limiter.acquire()
+
+
+def after_call(token, error_class=None):
+    limiter, started = token
+    limiter.release(started, error_class)
+
+
+def register_client(client):
+    """limit the concurrent calls of a boto3 client by service"""
+    client.meta.events.register('before-call', _before_call)
+    client.meta.events.register('after-call', _after_call)
+    client.meta.events.register('after-call-error', _after_call_error)
+
+
+def _before_call(model, context, **kwargs):
+    context['bosscat_retry'] = before_call(model.service_model.service_name)
+
+
+def _after_call(http_response, parsed, context, **kwargs):
+    token = context.pop('bosscat_retry', None)
+    if token is None:
+        return
+    error_class = None
+    if http_response.status_code >= 300:
+        error_class = EVENTUAL
+        if http_response.status_code >= 500 or \
+                parsed.get('Error', {}).get('Code') in THROTTLE_CODES:
+            error_class = THROTTLE
+    after_call(token, error_class)
+
+
+def _after_call_error(exception, context, **kwargs):
+    token = context.pop('bosscat_retry', None)
+    if token is not None:
+        after_call(token, EVENTUAL)
+
+
+def call(
+            lambda_func,
+            max_attempts = 10,
+            base_delay = 1.0,
+            ignore = (),
+            service_name = None,
+            eventual = ()
+            ):
+    """call lambda_func until it raises no ClientError; False if ignored
+
+    Throttles and eventual consistency errors, and the codes in eventual,
+    are retried with backoff up to max_attempts; throttle retries also
+    spend the service's budget.  Fatal errors, and throttles once the
+    budget is spent, are raised at once.
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            lambda_func()
+            return True
+        except ClientError as ex:
+            code = error_code(ex)
+            if code in ignore:
+                return False
+            error_class = EVENTUAL if code in eventual else classify(ex)
+            limiter = get_limiter(
+                service_name or getattr(_local, 'service_name', None) or 'unknown'
+                )
+            # a service out of budget is failing for every thread; its
+            #   errors are raised as they are instead of being retried
+            if error_class == FATAL or attempt == max_attempts or (
+                        error_class == THROTTLE and
+                        not limiter.spend(RETRY_COST)
+                        ):
+                limiter.count('failed')
+                raise
+            delay = get_delay(attempt, base_delay, error_class)
+            with trace.span(
+                        'retry',
+                        'retry',
+                        operation = ex.operation_name,
+                        error = code,
+                        error_class = error_class,
+                        attempt = attempt
+                        ):
+                sleep(delay)
+            limiter.count(error_class, delay)
+    return False
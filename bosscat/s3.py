@@ -1,11 +1,59 @@
-import boto3
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+from hashlib import md5, sha256
+import mimetypes
+import os
+import shutil
+from tempfile import SpooledTemporaryFile
+from threading import BoundedSemaphore
+
 from botocore.exceptions import ClientError
 
-from bosscat.utils import client_error_code, get_bucket_arn, try_client
+from bosscat import trace
+from bosscat.utils import (
+    client_error_code,
+    get_bucket_arn,
+    get_client,
+    try_client
+    )
 
+NOT_FOUND = '404'
 NO_SUCH_BUCKET = 'NoSuchBucket'
 BUCKET_ALREADY_EXISTS = 'BucketAlreadyExists'
 BUCKET_ALREADY_OWNED_BY_YOU = 'BucketAlreadyOwnedByYou'
+NO_ENCRYPTION_CONFIGURATION = 'ServerSideEncryptionConfigurationNotFoundError'
+MALFORMED_POLICY = 'MalformedPolicy'
+
+
+# s3 requires every part but the last to be at least 5 MiB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_UPLOAD_THREADS = 4
+DEFAULT_SYNC_THREADS = 16
+# delete_objects takes at most 1000 keys per request
+MAX_DELETE_KEYS = 1000
+# sync_directory stores the sha256 of each body it uploads under this key,
+#   for objects whose etag is not an md5
+SHA256_METADATA_KEY = 'bosscat-sha256'
+
+
+DEFAULT_CACHE_CONTROL = 'public, max-age=300'
+COMPRESSED_CONTENT_TYPES = [
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+    ]
+
+
+class ChecksumMismatch(Exception):
+    pass
 
 
 DEFAULT_CORS_DICT = {
@@ -21,6 +69,7 @@ DEFAULT_CORS_DICT = {
     }
 
 
+@trace.traced
 def ensure_bucket(bucket_name, region, bucket_policy=None, cors_dict=None):
     client = get_s3_client()
     if region == 'us-east-1':
@@ -45,10 +94,13 @@ def ensure_bucket(bucket_name, region, bucket_policy=None, cors_dict=None):
             lambda: client.put_bucket_policy(
                 Bucket=bucket_name,
                 Policy=bucket_policy
-                )
+                ),
+            # a role just created is an invalid principal until s3 sees it
+            eventual = [MALFORMED_POLICY]
             )
 
 
+@trace.traced
 def destroy_bucket(bucket_name):
     client = get_s3_client()
     try:
@@ -73,6 +125,7 @@ def destroy_bucket(bucket_name):
             raise(ex)
 
 
+@trace.traced
 def get_bucket_region(bucket_name):
     client = get_s3_client()
     try:
@@ -86,12 +139,22 @@ def get_bucket_region(bucket_name):
 
 
 def get_s3_client():
-    return boto3.client(
-        's3',
-        config = boto3.session.Config(signature_version='s3v4')
-        )
+    return get_client('s3', signature_version='s3v4')
 
 
+@trace.traced
+def object_exists(bucket_name, key):
+    client = get_s3_client()
+    try:
+        client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError as ex:
+        if client_error_code(ex) != NOT_FOUND:
+            raise(ex)
+        return False
+    return True
+
+
+@trace.traced
 def upload_local_file_to_bucket(local_filename, bucket_name, key):
     client = get_s3_client()
     try_client(
@@ -99,3 +162,359 @@ def upload_local_file_to_bucket(local_filename, bucket_name, key):
         )
 
 
+def _read_part(stream, part_size):
+    # pipes may return short reads, so keep reading until the part is full
+    chunks = []
+    remaining = part_size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _etag_is_md5(response):
+    # objects encrypted with kms or a customer key get etags that are not
+    #   md5s; their bodies were still checked by s3 against ContentMD5
+    return not (
+        response.get('ServerSideEncryption', '').startswith('aws:kms') or
+        response.get('SSECustomerAlgorithm')
+        )
+
+
+def _check_etag(response, digest, description):
+    if not _etag_is_md5(response):
+        return
+    etag = response['ETag'].strip('"')
+    if etag != digest:
+        raise ChecksumMismatch('{}: expected {}, s3 has {}'.format(
+            description,
+            digest,
+            etag
+            ))
+
+
+def _try_response(lambda_func):
+    response = {}
+    try_client(lambda: response.update(lambda_func()))
+    return response
+
+
+@trace.traced
+def upload_stream(
+            stream,
+            bucket_name,
+            key,
+            part_size = DEFAULT_PART_SIZE,
+            max_threads = DEFAULT_UPLOAD_THREADS,
+            extra_args = None
+            ):
+    """upload a file-like stream with a parallel multipart upload
+
+    At most max_threads parts are held in memory at once.  Each part is
+    retried on its own and sent with its md5 for s3 to verify; unless the
+    object is encrypted with kms or a customer key, the etags of the parts
+    and of the completed object are also checked against those md5s.
+    extra_args are object headers such as ContentType and CacheControl.
+    """
+    client = get_s3_client()
+    extra_args = extra_args or {}
+    body = _read_part(stream, part_size)
+    if len(body) < part_size:
+        # the whole stream fits in one part; a plain put is enough
+        digest = md5(body)
+        response = _try_response(
+            lambda: client.put_object(
+                Bucket = bucket_name,
+                Key = key,
+                Body = body,
+                ContentMD5 = b64encode(digest.digest()).decode(),
+                **extra_args
+                )
+            )
+        _check_etag(response, digest.hexdigest(), key)
+        return
+    upload_id = _try_response(
+        lambda: client.create_multipart_upload(
+            Bucket = bucket_name,
+            Key = key,
+            **extra_args
+            )
+        )['UploadId']
+    slots = BoundedSemaphore(max_threads)
+    def upload_part(part_number, body):
+        try:
+            digest = md5(body)
+            response = _try_response(
+                lambda: client.upload_part(
+                    Bucket = bucket_name,
+                    Key = key,
+                    UploadId = upload_id,
+                    PartNumber = part_number,
+                    Body = body,
+                    ContentMD5 = b64encode(digest.digest()).decode()
+                    )
+                )
+            _check_etag(
+                response,
+                digest.hexdigest(),
+                '{} part {}'.format(key, part_number)
+                )
+            return {'PartNumber': part_number, 'ETag': response['ETag']}, \
+                digest.digest()
+        finally:
+            slots.release()
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=max_threads) as executor:
+            part_number = 1
+            # the first part, already read, takes the first slot
+            slots.acquire()
+            while body:
+                futures.append(executor.submit(
+                    trace.bind(upload_part),
+                    part_number,
+                    body
+                    ))
+                if any(future.done() and future.exception()
+                        for future in futures):
+                    break
+                # wait for a free slot before reading the next part so
+                #   that memory stays bounded by max_threads parts
+                body = None
+                slots.acquire()
+                body = _read_part(stream, part_size)
+                part_number += 1
+        parts = [future.result() for future in futures]
+    except BaseException:
+        try_client(
+            lambda: client.abort_multipart_upload(
+                Bucket = bucket_name,
+                Key = key,
+                UploadId = upload_id
+                )
+            )
+        raise
+    response = _try_response(
+        lambda: client.complete_multipart_upload(
+            Bucket = bucket_name,
+            Key = key,
+            UploadId = upload_id,
+            MultipartUpload = {'Parts': [part for part, digest in parts]}
+            )
+        )
+    try:
+        _check_etag(
+            response,
+            '{}-{}'.format(
+                md5(b''.join(digest for part, digest in parts)).hexdigest(),
+                len(parts)
+                ),
+            key
+            )
+    except ChecksumMismatch:
+        client.delete_object(Bucket=bucket_name, Key=key)
+        raise
+
+
+def get_etag(body, part_size=DEFAULT_PART_SIZE):
+    """the etag s3 gives body when it is uploaded by upload_stream"""
+    if len(body) < part_size:
+        return md5(body).hexdigest()
+    digests = [
+        md5(body[offset:offset + part_size]).digest()
+        for offset in range(0, len(body), part_size)
+        ]
+    return '{}-{}'.format(md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+@trace.traced
+def list_etags(bucket_name, prefix=''):
+    """map every key under prefix to its etag"""
+    client = get_s3_client()
+    etags = {}
+    marker = ''
+    while True:
+        response = _try_response(
+            lambda: client.list_objects(
+                Bucket = bucket_name,
+                Prefix = prefix,
+                Marker = marker
+                )
+            )
+        for obj in response.get('Contents', []):
+            etags[obj['Key']] = obj['ETag'].strip('"')
+        if not response.get('IsTruncated') or not response.get('Contents'):
+            return etags
+        marker = response['Contents'][-1]['Key']
+
+
+def is_kms_encrypted(bucket_name):
+    """whether the bucket encrypts new objects with kms by default"""
+    client = get_s3_client()
+    try:
+        response = client.get_bucket_encryption(Bucket=bucket_name)
+    except ClientError as ex:
+        if client_error_code(ex) != NO_ENCRYPTION_CONFIGURATION:
+            raise(ex)
+        return False
+    return any(
+        rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm']
+            .startswith('aws:kms')
+        for rule in response['ServerSideEncryptionConfiguration']['Rules']
+        if 'ApplyServerSideEncryptionByDefault' in rule
+        )
+
+
+def get_stored_sha256(bucket_name, key):
+    """the sha256 that sync_directory stored with the object, or None"""
+    client = get_s3_client()
+    try:
+        response = client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError as ex:
+        if client_error_code(ex) != NOT_FOUND:
+            raise(ex)
+        return None
+    return response.get('Metadata', {}).get(SHA256_METADATA_KEY)
+
+
+def get_upload_args(filename, compress=True, cache_control=DEFAULT_CACHE_CONTROL):
+    content_type = mimetypes.guess_type(filename)[0] or \
+        'application/octet-stream'
+    extra_args = {'ContentType': content_type}
+    if cache_control:
+        extra_args['CacheControl'] = cache_control
+    if compress and content_type in COMPRESSED_CONTENT_TYPES:
+        extra_args['ContentEncoding'] = 'gzip'
+    return extra_args
+
+
+def _spool_local_file(filename, extra_args, part_size=DEFAULT_PART_SIZE):
+    """copy a file, compressed if extra_args say so, to a temporary file
+    that stays in memory up to part_size; return it, the etag its upload
+    will have and its sha256"""
+    spool = SpooledTemporaryFile(max_size=part_size)
+    with open(filename, 'rb') as local_file:
+        if extra_args.get('ContentEncoding') == 'gzip':
+            # a fixed mtime keeps the compressed bytes, and so the etag,
+            #   the same for unchanged files
+            with gzip.GzipFile(
+                        filename = '',
+                        mode = 'wb',
+                        fileobj = spool,
+                        mtime = 0
+                        ) as gzip_file:
+                shutil.copyfileobj(local_file, gzip_file, part_size)
+        else:
+            shutil.copyfileobj(local_file, spool, part_size)
+    size = spool.tell()
+    spool.seek(0)
+    digest = sha256()
+    part_digests = []
+    for part in iter(lambda: spool.read(part_size), b''):
+        digest.update(part)
+        part_digests.append(md5(part).digest())
+    spool.seek(0)
+    if size < part_size:
+        # sent with a single put, whose etag is the md5 of the body
+        etag = part_digests[0].hex() if part_digests else md5().hexdigest()
+    else:
+        etag = '{}-{}'.format(
+            md5(b''.join(part_digests)).hexdigest(),
+            len(part_digests)
+            )
+    return spool, etag, digest.hexdigest()
+
+
+@trace.traced
+def delete_keys(bucket_name, keys):
+    client = get_s3_client()
+    for offset in range(0, len(keys), MAX_DELETE_KEYS):
+        delete_list = [
+            {'Key': key}
+            for key in keys[offset:offset + MAX_DELETE_KEYS]
+            ]
+        try_client(
+            lambda: client.delete_objects(
+                Bucket = bucket_name,
+                Delete = {
+                    'Objects': delete_list,
+                    'Quiet': True
+                    }
+                )
+            )
+
+
+@trace.traced
+def sync_directory(
+            local_directory,
+            bucket_name,
+            prefix = '',
+            delete = False,
+            compress = True,
+            cache_control = DEFAULT_CACHE_CONTROL,
+            max_threads = DEFAULT_SYNC_THREADS
+            ):
+    """upload the files under local_directory whose content s3 lacks
+
+    Local files are compared, after compression, by the etag they would
+    have once uploaded.  In a bucket that encrypts with kms by default,
+    where etags are not md5s, a differing etag is checked against the
+    sha256 stored in the object's metadata.  So only changed files are
+    sent.  Header changes on their own, such as a new cache_control, are
+    not detected.  With delete, keys under prefix that have no local file
+    are removed.  Returns the uploaded and deleted keys.
+
+    Files are uploaded max_threads at a time, each by one thread, so at
+    most about two parts per thread are held in memory; larger files are
+    spooled to disk.
+    """
+    remote_etags = list_etags(bucket_name, prefix)
+    etags_are_md5 = not is_kms_encrypted(bucket_name)
+    local_files = {}
+    for dirpath, dirnames, filenames in os.walk(local_directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relative_path = os.path.relpath(path, local_directory)
+            key = prefix + relative_path.replace(os.sep, '/')
+            local_files[key] = path
+    def sync_file(key):
+        extra_args = get_upload_args(local_files[key], compress, cache_control)
+        spool, etag, digest = _spool_local_file(local_files[key], extra_args)
+        with spool:
+            if key in remote_etags and (
+                        remote_etags[key] == etag or (
+                            not etags_are_md5 and
+                            get_stored_sha256(bucket_name, key) == digest
+                            )
+                        ):
+                return None
+            extra_args['Metadata'] = {SHA256_METADATA_KEY: digest}
+            # the files are the parallelism; parts of one file are not
+            #   sent by threads of their own
+            upload_stream(
+                spool,
+                bucket_name,
+                key,
+                max_threads = 1,
+                extra_args = extra_args
+                )
+        return key
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        uploaded = [
+            key
+            for key in executor.map(trace.bind(sync_file), sorted(local_files))
+            if key
+            ]
+    deleted = []
+    if delete:
+        deleted = sorted(set(remote_etags) - set(local_files))
+        delete_keys(bucket_name, deleted)
+    return {
+        'uploaded': uploaded,
+        'unchanged': len(local_files) - len(uploaded),
+        'deleted': deleted
+        }
+
@@ -32,12 +32,30 @@ def _get_secrets(secrets_bucket_name, app_id, delta, tag):
     return secrets
 
 
+def reload_secrets():
+    """fetch the deployment secrets again, set them here and return them"""
+    secrets = _get_secrets(
+        os.environ['BOSSCAT_SECRETS_BUCKET'],
+        APP_ID,
+        DEPLOYMENT_DELTA,
+        DEPLOYMENT_TAG
+        )
+    globals().update(secrets)
+    return secrets
+
+
 # import bosscat environment
 APP_ID = os.environ['BOSSCAT_APP_ID']
 DEPLOYMENT_DELTA = os.environ['BOSSCAT_DEPLOYMENT_DELTA']
 DEPLOYMENT_TAG = os.environ['BOSSCAT_DEPLOYMENT_TAG']
 DEPLOYMENT_REGION = os.environ['BOSSCAT_DEPLOYMENT_REGION']
 DEPLOYMENT_TIER = os.environ.get('BOSSCAT_DEPLOYMENT_TIER')
+# every region of the deployment, this one first
+DEPLOYMENT_REGIONS = [DEPLOYMENT_REGION] + [
+    region
+    for region in os.environ.get('BOSSCAT_DEPLOYMENT_REGIONS', '').split(',')
+    if region and region != DEPLOYMENT_REGION
+    ]
 # get aws account id
 AWS_ACCOUNT_ID = utils.get_account_id()
 # import config environment
@@ -52,14 +70,7 @@ DEPLOYMENT_NAME = '{}-{}-{}'.format(
     DEPLOYMENT_TAG
     )
 # Get deployment secrets
-globals().update(
-    _get_secrets(
-        os.environ['BOSSCAT_SECRETS_BUCKET'],
-        APP_ID,
-        DEPLOYMENT_DELTA,
-        DEPLOYMENT_TAG
-        )
-    )
+reload_secrets()
 # async settings
 if 'ASYNC_TOPIC_NAME' in globals():
     ASYNC_TOPIC_ARN = 'arn:aws:sns:{}:{}:{}'.format(
@@ -78,6 +89,15 @@ if 'ASYNC_MQ_NAME' in globals():
                                         AWS_ACCOUNT_ID,
                                         ASYNC_MQ_NAME
                                         )
+    # the local queue first, then those of the other regions for failover
+    ASYNC_MQ_URLS = [
+        'https://sqs.{}.amazonaws.com/{}/{}'.format(
+                                        region,
+                                        AWS_ACCOUNT_ID,
+                                        ASYNC_MQ_NAME
+                                        )
+        for region in DEPLOYMENT_REGIONS
+        ]
 if 'ASYNC_DQL_NAME' in globals():
     ASYNC_DLQ_ARN = 'arn:aws:sqs:{}:{}:{}'.format(
                                         DEPLOYMENT_REGION,
@@ -87,5 +107,11 @@ if 'ASYNC_DQL_NAME' in globals():
 # Async defaults
 ASYNC_RECEIVER = (DEPLOYMENT_TIER == 'worker')
 ASYNC_RUN_LOCAL = False
+# send to another region's queue when the local one fails
+ASYNC_FAILOVER = str(globals().get('ASYNC_FAILOVER', '')).lower() in (
+    '1',
+    'true',
+    'yes'
+    )
 
 
@@ -1,46 +1,124 @@
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+
 from botocore.exceptions import ClientError
 
+from bosscat import trace
 from bosscat.utils import (
     client_error_code,
     get_account_id,
+    get_client,
     get_topic_arn,
     try_client
     )
 
 
 NOT_FOUND = 'NotFound'
+# unconfirmed subscriptions have no arn and cannot be unsubscribed
+PENDING_CONFIRMATION = 'PendingConfirmation'
+
 
+DEFAULT_SUBSCRIPTION_THREADS = 8
 
+
+@trace.traced
 def ensure_topic(topic_name, region):
-    client = boto3.client('sns', region)
+    client = get_client('sns', region)
     response = client.create_topic(Name=topic_name)
     return response['TopicArn']
 
 
-def destroy_topic_and_subscriptions(topic_name, region, account_id):
-    client = boto3.client('sns', region)
+@trace.traced
+def list_subscriptions(topic_arn, region):
+    client = get_client('sns', region)
+    subscriptions = []
+    kwargs = {'TopicArn': topic_arn}
+    while True:
+        # called directly so that a missing topic raises NotFound at once
+        response = client.list_subscriptions_by_topic(**kwargs)
+        subscriptions.extend(response['Subscriptions'])
+        if not response.get('NextToken'):
+            return subscriptions
+        kwargs['NextToken'] = response['NextToken']
+
+
+def _unsubscribe_all(client, subscription_arns, max_threads):
+    def unsubscribe(subscription_arn):
+        try_client(lambda: client.unsubscribe(SubscriptionArn=subscription_arn))
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        list(executor.map(trace.bind(unsubscribe), subscription_arns))
+
+
+@trace.traced
+def reconcile_subscriptions(
+            topic_arn,
+            region,
+            subscriptions,
+            unsubscribe = (),
+            max_threads = DEFAULT_SUBSCRIPTION_THREADS
+            ):
+    """subscribe to subscriptions and unsubscribe those of unsubscribe
+
+    Both are dicts with protocol and endpoint.  Subscriptions that bosscat
+    was not told about, such as an operator's or the temporary queue of
+    top, are left alone.  Returns the (protocol, endpoint) pairs added and
+    removed.  Pending confirmations count as subscribed, so they are
+    neither re-sent nor removed.
+    """
+    client = get_client('sns', region)
+    wanted = set(
+        (subscription['protocol'], subscription['endpoint'])
+        for subscription in subscriptions
+        )
+    unwanted = set(
+        (subscription['protocol'], subscription['endpoint'])
+        for subscription in unsubscribe
+        ) - wanted
+    existing = {}
+    for subscription in list_subscriptions(topic_arn, region):
+        key = (subscription['Protocol'], subscription['Endpoint'])
+        existing[key] = subscription['SubscriptionArn']
+    added = sorted(wanted - set(existing))
+    removed = sorted(
+        key for key in unwanted & set(existing)
+        if existing[key] != PENDING_CONFIRMATION
+        )
+    def subscribe(key):
+        try_client(
+            lambda: client.subscribe(
+                TopicArn = topic_arn,
+                Protocol = key[0],
+                Endpoint = key[1]
+                )
+            )
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        list(executor.map(trace.bind(subscribe), added))
+    _unsubscribe_all(client, [existing[key] for key in removed], max_threads)
+    return {'added': added, 'removed': removed}
+
+
+@trace.traced
+def destroy_topic_and_subscriptions(
+            topic_name,
+            region,
+            account_id,
+            max_threads = DEFAULT_SUBSCRIPTION_THREADS
+            ):
+    client = get_client('sns', region)
     topic_arn = get_topic_arn(
         region,
         account_id,
         topic_name
         )
     try:
-        next_token = ''
-        while True:
-            response = client.list_subscriptions_by_topic(
-                                TopicArn = topic_arn,
-                                NextToken = next_token
-                                )
-            for subscription in response['Subscriptions']:
-                client.unsubscribe(
-                    SubscriptionArn=subscription['SubscriptionArn']
-                    )
-            if not next_token:
-                break
+        # list every page before unsubscribing so that removals do not
+        #   shift the pages still to be read
+        subscription_arns = [
+            subscription['SubscriptionArn']
+            for subscription in list_subscriptions(topic_arn, region)
+            if subscription['SubscriptionArn'] != PENDING_CONFIRMATION
+            ]
+        _unsubscribe_all(client, subscription_arns, max_threads)
     except ClientError as ex:
         if client_error_code(ex) != NOT_FOUND:
             raise(ex)
     client.delete_topic(TopicArn=topic_arn)
-
-
@@ -1,18 +1,79 @@
+from base64 import b64decode
+from hashlib import sha1
 import json
+import pickle
 
-import boto3
 from botocore.exceptions import ClientError
 
-from bosscat.utils import client_error_code, get_queue_arn, try_client
+from bosscat import trace
+from bosscat.utils import (
+    client_error_code,
+    get_client,
+    get_queue_arn,
+    try_client
+    )
 
 
 NON_EXISTENT_QUEUE = 'AWS.SimpleQueueService.NonExistentQueue'
 QUEUE_DELETED_RECENTLY = 'AWS.SimpleQueueService.QueueDeletedRecently'
 
 
-def ensure_queue(queue_name, region, queue_policy=None, redrive_policy=None):
-    client = boto3.client('sqs', region)
-    attributes = {}
+FIFO_SUFFIX = '.fifo'
+
+
+class SignatureMismatch(Exception):
+    pass
+
+
+def decode_message_body(message_body, secret=None):
+    """open the envelope of a bosscat worker message; return its msg_dict
+
+    With secret (BOSSCAT_SECRET), the signature is checked before the
+    message is unpickled.  Without it the message is trusted, so only
+    decode messages from queues that only bosscat writes to.
+    """
+    msg_envelope = pickle.loads(b64decode(message_body))
+    msg_pickle = msg_envelope['msg_pickle']
+    if secret is not None:
+        signature = sha1(msg_pickle + secret.encode('utf-8')).hexdigest()
+        if signature != msg_envelope['msg_signature']:
+            raise SignatureMismatch()
+    return pickle.loads(msg_pickle)
+
+
+def is_fifo(queue_name):
+    return queue_name.endswith(FIFO_SUFFIX)
+
+
+def get_fifo_attributes(fifo):
+    """create_queue attributes for a queue's fifo setting
+
+    fifo is True or a dict of content_based_deduplication (default True)
+    and high_throughput (default True).  High throughput scopes
+    deduplication and the throughput quota to each message group.
+    """
+    if not fifo:
+        return {}
+    fifo = fifo if isinstance(fifo, dict) else {}
+    attributes = {'FifoQueue': 'true'}
+    if fifo.get('content_based_deduplication', True):
+        attributes['ContentBasedDeduplication'] = 'true'
+    if fifo.get('high_throughput', True):
+        attributes['DeduplicationScope'] = 'messageGroup'
+        attributes['FifoThroughputLimit'] = 'perMessageGroupId'
+    return attributes
+
+
+@trace.traced
+def ensure_queue(
+            queue_name,
+            region,
+            queue_policy = None,
+            redrive_policy = None,
+            fifo = None
+            ):
+    client = get_client('sqs', region)
+    attributes = get_fifo_attributes(fifo)
     if queue_policy:
         attributes['Policy'] = json.dumps(queue_policy)
     if redrive_policy:
@@ -25,8 +86,9 @@ def ensure_queue(queue_name, region, queue_policy=None, redrive_policy=None):
         )
 
 
+@trace.traced
 def destroy_queue(queue_name, region):
-    client = boto3.client('sqs', region)
+    client = get_client('sqs', region)
     try:
         client.delete_queue(
             QueueUrl = client.get_queue_url(QueueName=queue_name)['QueueUrl']
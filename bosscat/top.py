@@ -0,0 +1,381 @@
+from ast import literal_eval
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import re
+import sys
+from threading import Lock
+from time import sleep, strftime, time
+from uuid import uuid4
+
+from bosscat import sqs, trace, upanddown
+from bosscat.utils import get_client, get_queue_arn, try_client
+
+
+DEFAULT_INTERVAL = 5
+DEFAULT_WINDOWS = (60, 300)
+# Received events are matched to their Complete or Failed event for this
+#   long before they are dropped as lost
+MAX_TASK_SECONDS = 3600
+CLEAR_SCREEN = '\033[H\033[2J'
+
+
+def get_queue_regions(config):
+    """(region, name) of every configured queue in each of its regions,
+    each dead letter queue after its queue"""
+    queues = []
+    for queue in config['queues']:
+        for region in queue['regions']:
+            queues.append((region, queue['name']))
+            if queue.get('dead_letter_queue'):
+                queues.append((region, queue['dead_letter_queue']['name']))
+    return queues
+
+
+def sample_queue(region, queue_name):
+    client = get_client('sqs', region)
+    cloudwatch = get_client('cloudwatch', region)
+    queue_url = client.get_queue_url(QueueName=queue_name)['QueueUrl']
+    attributes = client.get_queue_attributes(
+        QueueUrl = queue_url,
+        AttributeNames = [
+            'ApproximateNumberOfMessages',
+            'ApproximateNumberOfMessagesNotVisible'
+            ]
+        )['Attributes']
+    # sqs itself does not report message age; cloudwatch has it by minute
+    now = datetime.utcnow()
+    datapoints = cloudwatch.get_metric_statistics(
+        Namespace = 'AWS/SQS',
+        MetricName = 'ApproximateAgeOfOldestMessage',
+        Dimensions = [{'Name': 'QueueName', 'Value': queue_name}],
+        StartTime = now - timedelta(minutes=5),
+        EndTime = now,
+        Period = 60,
+        Statistics = ['Maximum']
+        )['Datapoints']
+    oldest_age = None
+    if datapoints:
+        oldest_age = max(
+            datapoints,
+            key = lambda datapoint: datapoint['Timestamp']
+            )['Maximum']
+    return {
+        'region': region,
+        'queue_name': queue_name,
+        'visible': int(attributes['ApproximateNumberOfMessages']),
+        'in_flight': int(attributes['ApproximateNumberOfMessagesNotVisible']),
+        'oldest_age': oldest_age
+        }
+
+
+def sample_queues(queues, executor):
+    """sample every (region, name) queue concurrently; failed samples carry
+    their error"""
+    def sample(queue):
+        region, queue_name = queue
+        try:
+            return sample_queue(region, queue_name)
+        except Exception as ex:
+            return {
+                'region': region,
+                'queue_name': queue_name,
+                'error': repr(ex)
+                }
+    return list(executor.map(trace.bind(sample), queues))
+
+
+def parse_status_message(message, sent_time=None):
+    """turn a status message from _sns_publish into an event dict
+
+    _sns_publish sends str(msg_dict), which literal_eval reads back unless
+    the task arguments have reprs that are not literals; the fields that
+    top uses are then picked out of the text.
+    """
+    try:
+        msg_dict = literal_eval(message)
+    except (SyntaxError, ValueError):
+        msg_dict = dict(
+            (name, match.group(1))
+            for name, match in (
+                (name, re.search(r"'{}': '([^']*)'".format(name), message))
+                for name in ('msg_id', 'worker_key', 'status', 'cron', 'error')
+                )
+            if match
+            )
+        enqueued = re.search(r"'enqueued': ([0-9.e+-]+)", message)
+        if enqueued:
+            msg_dict['trace'] = {'enqueued': float(enqueued.group(1))}
+    return {
+        'time': sent_time or time(),
+        'enqueued': (msg_dict.get('trace') or {}).get('enqueued'),
+        'status': msg_dict.get('status'),
+        'worker_key': msg_dict.get('worker_key') or msg_dict.get('cron'),
+        'msg_id': msg_dict.get('msg_id') or msg_dict.get('uuid'),
+        'error': msg_dict.get('error')
+        }
+
+
+class LocalEventSource(object):
+    """stand-in for the status topic; publish msg_dicts as _sns_publish would"""
+
+    def __init__(self):
+        self.events = deque()
+        self.lock = Lock()
+
+    def publish(self, msg_dict, sent_time=None):
+        with self.lock:
+            self.events.append(parse_status_message(str(msg_dict), sent_time))
+
+    def poll(self):
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+    def close(self):
+        pass
+
+
+class TopicEventSource(object):
+    """read the status topic through a temporary subscribed queue"""
+
+    def __init__(self, region, account_id, topic_arn):
+        self.region = region
+        self.topic_arn = topic_arn
+        self.client = get_client('sqs', region)
+        self.queue_name = 'bosscat-top-{}'.format(uuid4().hex[:12])
+        queue_arn = get_queue_arn(region, account_id, self.queue_name)
+        self.queue_url = self.client.create_queue(
+            QueueName = self.queue_name
+            )['QueueUrl']
+        self.client.set_queue_attributes(
+            QueueUrl = self.queue_url,
+            Attributes = {'Policy': json.dumps({
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Effect': 'Allow',
+                    'Principal': {'Service': 'sns.amazonaws.com'},
+                    'Action': 'sqs:SendMessage',
+                    'Resource': queue_arn,
+                    'Condition': {'ArnEquals': {'aws:SourceArn': topic_arn}}
+                    }]
+                })}
+            )
+        sns = get_client('sns', region)
+        self.subscription_arn = sns.subscribe(
+            TopicArn = topic_arn,
+            Protocol = 'sqs',
+            Endpoint = queue_arn,
+            Attributes = {'RawMessageDelivery': 'true'},
+            ReturnSubscriptionArn = True
+            )['SubscriptionArn']
+
+    def poll(self):
+        events = []
+        while True:
+            response = {}
+            try_client(
+                lambda: response.update(self.client.receive_message(
+                    QueueUrl = self.queue_url,
+                    MaxNumberOfMessages = 10,
+                    WaitTimeSeconds = 0,
+                    AttributeNames = ['SentTimestamp']
+                    ))
+                )
+            messages = response.get('Messages', [])
+            if not messages:
+                return events
+            for message in messages:
+                events.append(parse_status_message(
+                    message['Body'],
+                    int(message['Attributes']['SentTimestamp']) / 1000.0
+                    ))
+            try_client(
+                lambda: self.client.delete_message_batch(
+                    QueueUrl = self.queue_url,
+                    Entries = [
+                        {'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']}
+                        for index, message in enumerate(messages)
+                        ]
+                    )
+                )
+
+    def close(self):
+        get_client('sns', self.region).unsubscribe(
+            SubscriptionArn = self.subscription_arn
+            )
+        sqs.destroy_queue(self.queue_name, self.region)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class TaskStats(object):
+    """per worker_key rates, latency and failures over rolling windows
+
+    Latency runs from a task's Received event to its Complete or Failed
+    event, so it is the time spent in the worker, not in the queue.
+    """
+
+    def __init__(self, windows=DEFAULT_WINDOWS):
+        self.windows = sorted(windows)
+        self.events = deque()
+        self.received = {}
+
+    def add(self, events):
+        for event in sorted(events, key=lambda event: event['time']):
+            latency = None
+            if event['status'] == 'Received':
+                self.received[event['msg_id']] = event['time']
+            elif event['status'] in ('Complete', 'Failed'):
+                received_time = self.received.pop(event['msg_id'], None)
+                if received_time is not None:
+                    latency = event['time'] - received_time
+            self.events.append(dict(event, latency=latency))
+
+    def prune(self, now):
+        while self.events and self.events[0]['time'] < now - self.windows[-1]:
+            self.events.popleft()
+        for msg_id, received_time in list(self.received.items()):
+            if received_time < now - MAX_TASK_SECONDS:
+                del self.received[msg_id]
+
+    def summarize(self, now=None):
+        """return {worker_key: {window: row}} for the events in each window"""
+        now = now or time()
+        self.prune(now)
+        summary = {}
+        for window in self.windows:
+            for event in self.events:
+                if event['time'] < now - window or not event['worker_key']:
+                    continue
+                row = summary.setdefault(event['worker_key'], {}).setdefault(
+                    window,
+                    {'sent': 0, 'received': 0, 'complete': 0, 'failed': 0,
+                        'latencies': []}
+                    )
+                status = (event['status'] or '').lower()
+                if status in row:
+                    row[status] += 1
+                if event['latency'] is not None:
+                    row['latencies'].append(event['latency'])
+        for rows in summary.values():
+            for window, row in rows.items():
+                row['sent_rate'] = row['sent'] / float(window)
+                row['complete_rate'] = row['complete'] / float(window)
+                row['p50'] = _percentile(row['latencies'], 0.5)
+                row['p95'] = _percentile(row['latencies'], 0.95)
+                del row['latencies']
+        return summary
+
+
+def _seconds(value):
+    return '-' if value is None else '{:.1f}s'.format(value)
+
+
+def format_top(deployment_name, queue_samples, task_summary):
+    lines = ['bosscat top  {}  {}'.format(deployment_name, strftime('%H:%M:%S'))]
+    lines.append('')
+    lines.append('{:<14} {:<48} {:>9} {:>9} {:>9}'.format(
+        'region', 'queue', 'visible', 'in flight', 'oldest'
+        ))
+    for sample in queue_samples:
+        if sample.get('error'):
+            lines.append('{:<14} {:<48} {}'.format(
+                sample['region'],
+                sample['queue_name'],
+                sample['error']
+                ))
+            continue
+        lines.append('{:<14} {:<48} {:>9} {:>9} {:>9}'.format(
+            sample['region'],
+            sample['queue_name'],
+            sample['visible'],
+            sample['in_flight'],
+            _seconds(sample['oldest_age'])
+            ))
+    if task_summary:
+        lines.append('')
+        lines.append('{:<40} {:>6} {:>8} {:>8} {:>7} {:>8} {:>8}'.format(
+            'worker_key', 'window', 'sent/s', 'done/s', 'failed', 'p50', 'p95'
+            ))
+        for worker_key in sorted(task_summary):
+            for window, row in sorted(task_summary[worker_key].items()):
+                lines.append(
+                    '{:<40} {:>5}s {:>8.2f} {:>8.2f} {:>7} {:>8} {:>8}'.format(
+                        worker_key,
+                        window,
+                        row['sent_rate'],
+                        row['complete_rate'],
+                        row['failed'],
+                        _seconds(row['p50']),
+                        _seconds(row['p95'])
+                        ))
+    return '\n'.join(lines)
+
+
+def get_status_topic_arn(config):
+    for topic in config['topics']:
+        if topic.get('setting_name') == 'ASYNC_TOPIC_NAME':
+            return 'arn:aws:sns:{}:{}:{}'.format(
+                topic['region'],
+                config['account_id'],
+                topic['name']
+                )
+    return None
+
+
+def top(
+            config,
+            out = sys.stdout,
+            interval = DEFAULT_INTERVAL,
+            windows = DEFAULT_WINDOWS,
+            iterations = None,
+            event_source = None,
+            clear = True
+            ):
+    """redraw queue depths and task throughput every interval seconds
+
+    Without an event_source, status events are read from the deployment's
+    ASYNC_TOPIC_NAME topic through a temporary queue that is removed on
+    exit.  Pass a LocalEventSource to run without aws.
+    """
+    config = upanddown.configure(config)
+    region = config['deployment_region']
+    queues = get_queue_regions(config)
+    own_source = False
+    if event_source is None:
+        topic_arn = get_status_topic_arn(config)
+        if topic_arn:
+            event_source = TopicEventSource(region, config['account_id'], topic_arn)
+            own_source = True
+    stats = TaskStats(windows)
+    iteration = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(len(queues), 1)) as executor:
+            while iterations is None or iteration < iterations:
+                started = time()
+                queue_samples = sample_queues(queues, executor)
+                if event_source is not None:
+                    stats.add(event_source.poll())
+                screen = format_top(
+                    config['deployment_name'],
+                    queue_samples,
+                    stats.summarize()
+                    )
+                out.write((CLEAR_SCREEN if clear else '') + screen + '\n')
+                out.flush()
+                iteration += 1
+                if iterations is None or iteration < iterations:
+                    sleep(max(0, interval - (time() - started)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if own_source:
+            event_source.close()
@@ -0,0 +1,432 @@
+from binascii import hexlify
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import socket
+from threading import Lock, current_thread, local
+from time import time
+
+
+# the recorder of the process, for threads that are not bound to a run
+_recorder = None
+_local = local()
+
+
+def new_id():
+    """a random 64 bit id, unique across the processes of a trace"""
+    return hexlify(os.urandom(8)).decode()
+
+
+class Span(object):
+
+    def __init__(self, name, category, parent_id, args, trace_id=None):
+        self.span_id = new_id()
+        self.trace_id = trace_id or new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread_id = current_thread().ident
+        self.thread_name = current_thread().name
+        self.start = time()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time()) - self.start
+
+
+class Recorder(object):
+    """the spans of one run, or the exporter they are passed to
+
+    Spans are recorded by the parent recorder too, so that a fleet trace
+    holds the spans of every deployment and each deployment's trace its own.
+    """
+
+    def __init__(self, exporter=None, parent=None):
+        self.exporter = exporter
+        self.parent = parent
+        self.spans = []
+        self.lock = Lock()
+
+    def record(self, span):
+        if self.exporter is not None:
+            self.exporter.export(span)
+        else:
+            with self.lock:
+                self.spans.append(span)
+        if self.parent is not None:
+            self.parent.record(span)
+
+    def get_spans(self):
+        with self.lock:
+            return list(self.spans)
+
+
+def current_recorder():
+    """the recorder of this thread's run, else that of the process, or None"""
+    recorder = getattr(_local, 'recorder', None)
+    return recorder if recorder is not None else _recorder
+
+
+@contextmanager
+def use(recorder):
+    """record the spans of this thread with recorder"""
+    previous = getattr(_local, 'recorder', None)
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span_id():
+    stack = _stack()
+    if stack:
+        return stack[-1].span_id
+    return getattr(_local, 'parent_id', None)
+
+
+def current_trace_id():
+    stack = _stack()
+    if stack:
+        return stack[-1].trace_id
+    return getattr(_local, 'trace_id', None)
+
+
+def get_context():
+    """the trace and span to continue in another process, or None"""
+    trace_id = current_trace_id()
+    if trace_id is None:
+        return None
+    return {'trace_id': trace_id, 'span_id': current_span_id()}
+
+
+@contextmanager
+def attach(context):
+    """continue the trace of context (from get_context) in this thread"""
+    previous = (
+        getattr(_local, 'parent_id', None),
+        getattr(_local, 'trace_id', None)
+        )
+    if context:
+        _local.parent_id = context['span_id']
+        _local.trace_id = context['trace_id']
+    try:
+        yield
+    finally:
+        _local.parent_id, _local.trace_id = previous
+
+
+def enable(exporter=None):
+    """start recording the spans of the process, discarding any previous ones
+
+    With an exporter, finished spans are passed to exporter.export instead
+    of being kept, as long running processes need.
+    """
+    global _recorder
+    _recorder = Recorder(exporter)
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def is_enabled():
+    return current_recorder() is not None
+
+
+def get_spans():
+    recorder = current_recorder()
+    return recorder.get_spans() if recorder is not None else []
+
+
+def start_span(name, category='step', **args):
+    recorder = current_recorder()
+    if recorder is None:
+        return None
+    span = Span(name, category, current_span_id(), args, current_trace_id())
+    span.recorder = recorder
+    _stack().append(span)
+    return span
+
+
+def finish_span(span, **args):
+    if span is None:
+        return
+    span.end = time()
+    span.args.update(args)
+    stack = _stack()
+    if span in stack:
+        stack.remove(span)
+    # the span goes to the recorder it started in, even if the thread
+    #   has moved on to another
+    span.recorder.record(span)
+
+
+def record_span(name, category, start, end, **args):
+    """record a span that has already ended, as a child of the current one"""
+    recorder = current_recorder()
+    if recorder is None:
+        return None
+    span = Span(name, category, current_span_id(), args, current_trace_id())
+    span.start = start
+    span.end = end
+    recorder.record(span)
+    return span
+
+
+@contextmanager
+def span(name, category='step', **args):
+    """record the enclosed block as a span"""
+    active_span = start_span(name, category, **args)
+    try:
+        yield active_span
+    except Exception as ex:
+        finish_span(active_span, error=repr(ex))
+        raise
+    else:
+        finish_span(active_span)
+
+
+def traced(function):
+    """decorator recording each call of function as a span"""
+    name = '{}.{}'.format(function.__module__.split('.')[-1], function.__name__)
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if current_recorder() is None:
+            return function(*args, **kwargs)
+        with span(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def bind(function):
+    """carry the current span and recorder into a function run on another thread"""
+    context = get_context()
+    recorder = getattr(_local, 'recorder', None)
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with attach(context), use(recorder):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def register_client(client):
+    """record every api call made by a boto3 client as a span"""
+    client.meta.events.register('before-call', _before_call)
+    client.meta.events.register('after-call', _after_call)
+    client.meta.events.register('after-call-error', _after_call_error)
+
+
+def _before_call(model, context, **kwargs):
+    context['bosscat_span'] = start_span(
+        '{}.{}'.format(model.service_model.service_name, model.name),
+        'aws'
+        )
+
+
+def _after_call(http_response, parsed, context, **kwargs):
+    active_span = context.pop('bosscat_span', None)
+    if http_response.status_code >= 300:
+        finish_span(
+            active_span,
+            status_code = http_response.status_code,
+            error = parsed.get('Error', {}).get('Code')
+            )
+    else:
+        finish_span(active_span, status_code=http_response.status_code)
+
+
+def _after_call_error(exception, context, **kwargs):
+    finish_span(context.pop('bosscat_span', None), error=repr(exception))
+
+
+@contextmanager
+def recording(trace_filename, alert):
+    """record spans for the block and report them when trace_filename is set
+
+    The recorder is bound to this thread and to the threads started with
+    bind, so concurrent runs each record and report only their own spans.
+    """
+    if not trace_filename:
+        yield
+        return
+    recorder = Recorder(parent=current_recorder())
+    try:
+        with use(recorder):
+            yield
+    finally:
+        spans = recorder.get_spans()
+        write_chrome_trace(trace_filename, spans)
+        alert('Wrote trace {}'.format(trace_filename))
+        alert(summary(spans))
+
+
+def write_chrome_trace(filename, spans=None):
+    """write spans in the chrome trace event format (also read by perfetto)"""
+    spans = get_spans() if spans is None else spans
+    pid = os.getpid()
+    events = []
+    thread_names = {}
+    for span in spans:
+        thread_names[span.thread_id] = span.thread_name
+        args = dict(span.args)
+        args['span_id'] = span.span_id
+        args['parent_id'] = span.parent_id
+        events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': int(span.start * 1000000),
+            'dur': int(span.duration * 1000000),
+            'pid': pid,
+            'tid': span.thread_id,
+            'args': {key: str(value) for key, value in args.items()}
+            })
+    for thread_id, thread_name in thread_names.items():
+        events.append({
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': thread_id,
+            'args': {'name': thread_name}
+            })
+    with open(filename, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+def critical_path(spans=None):
+    """return (depth, span) pairs on the longest chain of dependent spans"""
+    spans = get_spans() if spans is None else spans
+    span_ids = set(span.span_id for span in spans)
+    children = {}
+    roots = []
+    for span in spans:
+        if span.parent_id in span_ids:
+            children.setdefault(span.parent_id, []).append(span)
+        else:
+            roots.append(span)
+    def walk(span, depth):
+        # walk back from the end of the span, each time taking the child
+        #   that finished last before the previously chosen child started
+        path = []
+        cursor = span.end
+        for child in sorted(
+                    children.get(span.span_id, []),
+                    key = lambda child: child.end,
+                    reverse = True
+                    ):
+            if child.end <= cursor:
+                path = walk(child, depth + 1) + path
+                cursor = child.start
+        return [(depth, span)] + path
+    if not roots:
+        return []
+    return walk(max(roots, key=lambda span: span.duration), 0)
+
+
+def summary(spans=None):
+    """text report of the critical path, retry time and slowest aws calls"""
+    spans = get_spans() if spans is None else spans
+    lines = ['Critical path:']
+    for depth, span in critical_path(spans):
+        lines.append('  {:>9.2f}s  {}{}'.format(
+            span.duration,
+            '  ' * depth,
+            span.name
+            ))
+    retries = [span for span in spans if span.category == 'retry']
+    lines.append('Retry time: {:.2f}s in {} retries'.format(
+        sum(span.duration for span in retries),
+        len(retries)
+        ))
+    retry_totals = {}
+    for span in retries:
+        operation = span.args.get('operation', span.name)
+        retry_totals[operation] = retry_totals.get(operation, 0) + span.duration
+    for operation, seconds in sorted(
+                retry_totals.items(),
+                key = lambda item: item[1],
+                reverse = True
+                ):
+        lines.append('  {:>9.2f}s  {}'.format(seconds, operation))
+    aws_totals = {}
+    for span in spans:
+        if span.category == 'aws':
+            calls, seconds = aws_totals.get(span.name, (0, 0))
+            aws_totals[span.name] = (calls + 1, seconds + span.duration)
+    lines.append('AWS calls:')
+    for name, (calls, seconds) in sorted(
+                aws_totals.items(),
+                key = lambda item: item[1][1],
+                reverse = True
+                )[:15]:
+        lines.append('  {:>9.2f}s  {:>4}x  {}'.format(seconds, calls, name))
+    return '\n'.join(lines)
+
+
+def span_to_dict(span):
+    return {
+        'trace_id': span.trace_id,
+        'span_id': span.span_id,
+        'parent_id': span.parent_id,
+        'name': span.name,
+        'category': span.category,
+        'start': span.start,
+        'duration': span.duration,
+        'pid': os.getpid(),
+        'thread': span.thread_name,
+        'args': dict((key, str(value)) for key, value in span.args.items())
+        }
+
+
+class FileExporter(object):
+    """append spans to a file, one json object per line"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+
+    def export(self, span):
+        line = json.dumps(span_to_dict(span)) + '\n'
+        # opened for each span so that forked processes can share the file
+        with self.lock:
+            with open(self.filename, 'a') as span_file:
+                span_file.write(line)
+
+
+class UDPExporter(object):
+    """send each span as a json datagram, dropping it if that fails"""
+
+    def __init__(self, host, port):
+        self.address = (host, int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def export(self, span):
+        try:
+            self.socket.sendto(
+                json.dumps(span_to_dict(span)).encode('utf-8'),
+                self.address
+                )
+        except OSError:
+            pass
+
+
+def get_exporter(spec):
+    """an exporter for 'file:<path>' or 'udp:<host>:<port>'"""
+    kind, _, target = spec.partition(':')
+    if kind == 'file':
+        return FileExporter(target)
+    if kind == 'udp':
+        host, _, port = target.rpartition(':')
+        return UDPExporter(host, port)
+    raise ValueError('unknown span exporter {!r}'.format(spec))
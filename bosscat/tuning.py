@@ -0,0 +1,131 @@
+import logging
+from math import ceil, floor
+
+from bosscat.utils import get_client
+
+
+logger = logging.getLogger(__name__)
+
+
+# sqsd accepts 1-100 http connections and visibility timeouts up to 12 hours
+MAX_HTTP_CONNECTIONS = 100
+MAX_VISIBILITY_TIMEOUT = 43200
+MAX_INACTIVITY_TIMEOUT = 36000
+MAX_THREADS = 16
+# memory kept free for the os, sqsd and the web server
+RESERVED_MEMORY_MB = 512
+
+
+SQSD_OPTION_NAMES = {
+    'http_connections': 'HttpConnections',
+    'connect_timeout': 'ConnectTimeout',
+    'inactivity_timeout': 'InactivityTimeout',
+    'visibility_timeout': 'VisibilityTimeout',
+    'error_visibility_timeout': 'ErrorVisibilityTimeout',
+    'retention_period': 'RetentionPeriod',
+    'max_retries': 'MaxRetries',
+    }
+
+
+def get_instance_resources(region, instance_type):
+    """return (vcpus, memory in MiB) of an ec2 instance type"""
+    ec2 = get_client('ec2', region)
+    response = ec2.describe_instance_types(InstanceTypes=[instance_type])
+    info = response['InstanceTypes'][0]
+    return info['VCpuInfo']['DefaultVCpus'], info['MemoryInfo']['SizeInMiB']
+
+
+def recommend_worker_settings(
+            task_seconds,
+            vcpus,
+            memory_mb,
+            process_memory_mb = 256,
+            cpu_fraction = 0.5,
+            timeout_factor = 2.0
+            ):
+    """recommend consistent wsgi and sqsd settings for a worker instance
+
+    task_seconds maps measured percentiles to task durations, e.g.
+    {'p50': 0.8, 'p95': 4, 'p99': 12}; 'max' is used when present.
+    cpu_fraction is the share of a task spent on the cpu rather than
+    waiting on io, which decides how many threads per process pay off.
+    """
+    longest = task_seconds.get('max') or max(task_seconds.values())
+    typical = task_seconds.get('p50') or min(task_seconds.values())
+    # one process per core for the cpu bound share of the work, limited
+    #   by how many processes fit in memory
+    usable_memory_mb = max(memory_mb - RESERVED_MEMORY_MB, process_memory_mb)
+    num_processes = max(1, min(
+        vcpus,
+        int(floor(usable_memory_mb / float(process_memory_mb)))
+        ))
+    # threads only overlap the io share of a task because of the gil
+    num_threads = max(1, min(
+        MAX_THREADS,
+        int(ceil(1.0 / max(cpu_fraction, 1.0 / MAX_THREADS)))
+        ))
+    # more connections than wsgi threads only queue requests in apache
+    #   where they age towards the inactivity timeout
+    http_connections = min(MAX_HTTP_CONNECTIONS, num_processes * num_threads)
+    num_threads = max(1, int(floor(http_connections / float(num_processes))))
+    inactivity_timeout = min(
+        MAX_INACTIVITY_TIMEOUT,
+        max(30, int(ceil(longest * timeout_factor)))
+        )
+    # a message must stay invisible for longer than sqsd may wait on it,
+    #   or a second instance picks it up while the first is still working
+    visibility_timeout = min(
+        MAX_VISIBILITY_TIMEOUT,
+        inactivity_timeout + max(30, int(ceil(inactivity_timeout * 0.1)))
+        )
+    return {
+        'num_processes': num_processes,
+        'num_threads': num_threads,
+        'http_connections': http_connections,
+        'inactivity_timeout': inactivity_timeout,
+        'visibility_timeout': visibility_timeout,
+        'estimated_tasks_per_second': http_connections / float(typical)
+            if typical else None
+        }
+
+
+def apply_worker_tuning(region, eb):
+    """return the tier settings with the sqsd_tuning recommendations applied
+
+    A setting given in the tier wins over its recommendation.
+    """
+    tuning = dict(eb['sqsd_tuning'])
+    if not tuning.get('vcpus') or not tuning.get('memory_mb'):
+        tuning['vcpus'], tuning['memory_mb'] = get_instance_resources(
+            region,
+            eb['instance_type']
+            )
+    recommendation = recommend_worker_settings(
+        tuning['task_seconds'],
+        tuning['vcpus'],
+        tuning['memory_mb'],
+        process_memory_mb = tuning.get('process_memory_mb', 256),
+        cpu_fraction = tuning.get('cpu_fraction', 0.5),
+        timeout_factor = tuning.get('timeout_factor', 2.0)
+        )
+    del recommendation['estimated_tasks_per_second']
+    tuned = dict(eb)
+    for name, value in sorted(recommendation.items()):
+        if eb.get(name) is None:
+            tuned[name] = value
+        elif eb[name] != value:
+            logger.warning(
+                'worker %s is %s; sqsd_tuning recommends %s',
+                name,
+                eb[name],
+                value
+                )
+    return tuned
+
+
+def get_sqsd_options(eb):
+    return dict(
+        (option_name, eb[name])
+        for name, option_name in SQSD_OPTION_NAMES.items()
+        if eb.get(name) is not None
+        )
@@ -1,26 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from datetime import datetime
 from threading import Thread
 from time import time, sleep
 
-import boto3
+from botocore.exceptions import ClientError
 
-from bosscat import elasticbeanstalk, iam, rds, s3, sns, sqs, utils
+from bosscat import (
+    autoscaling,
+    elasticbeanstalk,
+    iam,
+    rds,
+    retry,
+    s3,
+    sns,
+    sqs,
+    trace,
+    utils,
+    wheelhouse
+    )
+
+
+EB_TIER_TITLES = {
+    'web': 'webhead',
+    'worker': 'worker',
+    }
 
 
 def configure(config):
-    def config_obj(obj):
+    def config_obj(obj, regions=None):
         if obj.get('dead_letter_queue'):
-            config_obj(obj.get('dead_letter_queue'))
+            # the dead letter queue of a fifo queue must be fifo too
+            if obj.get('fifo'):
+                obj['dead_letter_queue'].setdefault('fifo', obj['fifo'])
+            config_obj(obj.get('dead_letter_queue'), regions)
         if not obj.get('name'):
             obj['name'] = '{}-{}'.format(config['deployment_name'], obj['nametip'])
+            if obj.get('fifo'):
+                obj['name'] += sqs.FIFO_SUFFIX
         if not obj.get('region'):
             obj['region'] = config['deployment_region']
-        obj['name_camel'] = ''.join(
-            [namepart.capitalize() for namepart in obj['name'].split('-')]
-            )
+        obj['regions'] = regions or [obj['region']]
+        # policy sids allow only letters and digits, not the .fifo dot
+        obj['name_camel'] = ''.join([
+            namepart.capitalize()
+            for namepart in obj['name'].replace('.', '-').split('-')
+            ])
         config['environment'][obj['setting_name']] = obj['name']
     config = deepcopy(config)
+    # the first region is the primary one, which also holds the buckets
+    #   and the rds instance
+    regions = config.get('deployment_regions') or [config['deployment_region']]
+    config['deployment_region'] = config.get('deployment_region') or regions[0]
+    config['deployment_regions'] = [config['deployment_region']] + [
+        region for region in regions if region != config['deployment_region']
+        ]
     config['deployment_name'] = '{}-{}-{}'.format(
         config['app_id'],
         config['deployment_delta'],
@@ -54,41 +87,92 @@ def configure(config):
     if config.get('rds'):
         config['environment']['BOSSCAT_RDS_INSTANCE_IDENTIFIER'] = \
             config['deployment_name']
-    for obj in config['buckets'] + config['queues'] + config['topics']:
+        config['environment']['BOSSCAT_RDS_REGION'] = config['deployment_region']
+    for obj in config['buckets']:
         config_obj(obj)
+    # queues and topics without a region of their own are created in every
+    #   deployment region, so that each region's tiers use their own
+    for obj in config['queues'] + config['topics']:
+        config_obj(
+            obj,
+            None if obj.get('region') else config['deployment_regions']
+            )
     setting_names = config['environment'].keys()
     config['environment']['BOSSCAT_ENVIRONMENT_NAMES'] = ','.join(setting_names)
     return config
 
 
-def down(config, alert):
-    config = configure(config)
-    if config['deployment_region'] == 'local':
-        alert('Running local; nothing to do.')
+def run_parallel(calls):
+    """run (function, args) calls in threads; raise the first error once all end"""
+    if not calls:
         return
-    threads = [
-        Thread(
-            target = down_buckets,
-            args = [config.get('buckets', []), alert]
-            ),
-        Thread(
-            target = down_queues,
-            args = [config.get('queues', []), alert]
-            ),
-        Thread(
-            target = down_topics,
-            args = [config.get('topics', []), config['account_id'], alert]
-            ),
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [
+            executor.submit(trace.bind(function), *args)
+            for function, args in calls
+            ]
+    for future in futures:
+        future.result()
+
+
+def get_region_config(config, region):
+    """the part of a configured config that is provisioned in region"""
+    region_config = deepcopy(config)
+    region_config['deployment_region'] = region
+    for key in ('queues', 'topics'):
+        objs = []
+        for obj in region_config[key]:
+            if region in obj['regions']:
+                obj['region'] = region
+                if obj.get('dead_letter_queue'):
+                    obj['dead_letter_queue']['region'] = region
+                objs.append(obj)
+        region_config[key] = objs
+    if region != config['deployment_region']:
+        region_config['buckets'] = []
+    return region_config
+
+
+def get_region_configs(config):
+    return [
+        get_region_config(config, region)
+        for region in config['deployment_regions']
         ]
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
-    down_iam(config, alert)
-    down_eb(config, alert)
-    down_rds(config, alert)
 
 
+def down(config, alert):
+    config = configure(config)
+    with trace.recording(config.get('trace_file'), alert), trace.span(
+                'upanddown.down',
+                deployment = config['deployment_name']
+                ):
+        if config['deployment_region'] == 'local':
+            alert('Running local; nothing to do.')
+            return
+        # the limiters are shared with concurrent runs, so they are not reset;
+        #   the report covers the calls made from here on
+        retry_stats = retry.get_stats()
+        region_configs = get_region_configs(config)
+        calls = [(down_buckets, [config.get('buckets', []), alert])]
+        for region_config in region_configs:
+            calls.extend([
+                (down_queues, [region_config['queues'], alert]),
+                (
+                    down_topics,
+                    [region_config['topics'], config['account_id'], alert]
+                    ),
+                ])
+        run_parallel(calls)
+        down_iam(config, alert)
+        run_parallel([
+            (down_eb, [region_config, alert])
+            for region_config in region_configs
+            ])
+        down_rds(config, alert)
+        alert_retries(alert, retry_stats)
+
+
+@trace.traced
 def down_buckets(buckets, alert):
     client = s3.get_s3_client()
     for bucket in buckets:
@@ -99,40 +183,62 @@ def down_buckets(buckets, alert):
             alert('Bucket {} is destroyed'.format(bucket['name']))
 
 
+@trace.traced
 def down_eb(config, alert):
-    if config.get('web'):
-        elasticbeanstalk.destroy_environment(
-            config['eb_webhead_name'],
-            config['deployment_region']
-            )
-        alert(
-            'Elastic Beanstalk webhead environment {} is terminating'.format(
-                config['eb_webhead_name']
+    for tier in ('web', 'worker'):
+        if not config.get(tier):
+            continue
+        for environment_name in get_eb_environment_names(config, tier):
+            if elasticbeanstalk.get_environment(
+                        config['deployment_region'],
+                        environment_name
+                        ) is None:
+                continue
+            elasticbeanstalk.destroy_environment(
+                environment_name,
+                config['deployment_region']
                 )
-            )
-    if config.get('worker'):
-        elasticbeanstalk.destroy_environment(
-            config['eb_worker_name'],
-            config['deployment_region']
-            )
-        alert(
-            'Elastic Beanstalk worker environment {} is terminating'.format(
-                config['eb_worker_name']
-                )
-            )
+            if tier == 'worker':
+                autoscaling.destroy_queue_scaling(
+                    config['deployment_region'],
+                    environment_name
+                    )
+            alert('Elastic Beanstalk {} environment {} is terminating'.format(
+                EB_TIER_TITLES[tier],
+                environment_name
+                ))
 
 
+@trace.traced
 def down_iam(config, alert):
     iam.destroy_instance_profile(config['instance_profile_name'])
     alert('Instance Profile {} is destroyed'.format(
                         config['instance_profile_name']
                         ))
-    iam.destroy_role(config['role_name'])
+    iam.destroy_role(
+        config['role_name'],
+        '{}-EC2InstanceProfilePolicy'.format(config['deployment_name'])
+        )
     alert('Role {} is destroyed'.format(config['role_name']))
 
 
+@trace.traced
 def down_rds(config, alert):
-    if config['rds']:
+    if not config['rds']:
+        return
+    if (config['rds'].get('warm_pool') or {}).get('return_on_down'):
+        pool_name, pool_prefix = get_rds_pool(config)
+        pool_instance_identifier = rds.return_instance_to_pool(
+            config['deployment_region'],
+            pool_name,
+            pool_prefix,
+            config['deployment_name']
+            )
+        alert('RDS instance {} is returned to the warm pool as {}'.format(
+            config['deployment_name'],
+            pool_instance_identifier
+            ))
+    else:
         rds.delete_instance(
             config['deployment_region'],
             config['deployment_name']
@@ -140,6 +246,7 @@ def down_rds(config, alert):
         alert('RDS instance {} is destroyed'.format(config['deployment_name']))
 
 
+@trace.traced
 def down_queues(queues, alert):
     def down_queue(queue, alert):
         if queue.get('permanent'):
@@ -153,6 +260,7 @@ def down_queues(queues, alert):
         down_queue(queue, alert)
 
 
+@trace.traced
 def down_topics(topics, account_id, alert):
     for topic in topics:
         if topic.get('permanent'):
@@ -166,34 +274,56 @@ def down_topics(topics, account_id, alert):
             alert('Topic {} is destroyed'.format(topic['name']))
 
 
-def up(config, alert):
+def up(config, alert, bundle_cache=None):
     config = configure(config)
-    if config['deployment_region'] == 'local':
-        alert('Running local; nothing to do.')
-        return
-    up_rds(config, alert)
-    threads = [
-        Thread(
-            target = up_buckets,
-            args = [config.get('buckets', []), alert]
-            ),
-        Thread(
-            target = up_queues,
-            args = [config.get('queues', []), config['account_id'], alert]
-            ),
-        Thread(
-            target = up_topics,
-            args = [config.get('topics', []), config['account_id'], alert]
-            ),
-        ]
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
-    up_iam(config, alert)
-    up_eb(config, alert)
-
-
+    with trace.recording(config.get('trace_file'), alert), trace.span(
+                'upanddown.up',
+                deployment = config['deployment_name']
+                ):
+        if config['deployment_region'] == 'local':
+            alert('Running local; nothing to do.')
+            return
+        # the limiters are shared with concurrent runs, so they are not reset;
+        #   the report covers the calls made from here on
+        retry_stats = retry.get_stats()
+        region_configs = get_region_configs(config)
+        pool_thread = up_rds(config, alert)
+        try:
+            calls = [(up_buckets, [config.get('buckets', []), alert])]
+            for region_config in region_configs:
+                calls.extend([
+                    (
+                        up_queues,
+                        [region_config['queues'], config['account_id'], alert]
+                        ),
+                    (
+                        up_topics,
+                        [region_config['topics'], config['account_id'], alert]
+                        ),
+                    ])
+            run_parallel(calls)
+            up_iam(config, alert)
+            # each region uploads its own bundle; eb applications are regional
+            run_parallel([
+                (up_eb, [region_config, alert, bundle_cache])
+                for region_config in region_configs
+                ])
+        finally:
+            # the warm pool is refilled while the rest comes up, but up does
+            #   not return before it is done
+            if pool_thread is not None:
+                pool_thread.join()
+        alert_retries(alert, retry_stats)
+
+
+def alert_retries(alert, before):
+    """report the services that throttled or needed retries since before"""
+    report = retry.format_stats(retry.get_stats_since(before))
+    if report:
+        alert('Retries:\n' + report)
+
+
+@trace.traced
 def up_buckets(buckets, alert):
     for bucket in buckets:
         s3.ensure_bucket(
@@ -202,62 +332,301 @@ def up_buckets(buckets, alert):
             cors_dict = s3.DEFAULT_CORS_DICT if bucket.get('cors') else None
             )
         alert('Bucket {} ready to go'.format(bucket['name']))
+        if bucket.get('sync'):
+            sync = bucket['sync']
+            result = s3.sync_directory(
+                sync['directory'],
+                bucket['name'],
+                prefix = sync.get('prefix', ''),
+                delete = sync.get('delete', False),
+                compress = sync.get('compress', True),
+                cache_control = sync.get(
+                    'cache_control',
+                    s3.DEFAULT_CACHE_CONTROL
+                    )
+                )
+            alert('Bucket {} synced: {} uploaded, {} unchanged, {} deleted'.format(
+                bucket['name'],
+                len(result['uploaded']),
+                result['unchanged'],
+                len(result['deleted'])
+                ))
 
 
-def up_eb(config, alert):
-    if config.get('web') or config.get('worker'):
-        eb_app_version_label = '{}-{}'.format(
-            config['deployment_name'],
-            datetime.now().strftime('%y%m%d%H%M%S')
-            )
-        elasticbeanstalk.upload_local_git_branch(
+@trace.traced
+def up_bundle(config, alert):
+    eb_app_version_label = elasticbeanstalk.upload_local_git_branch(
+        config['deployment_region'],
+        config['app_id'],
+        'elasticbeanstalk-{}-{}'.format(
             config['deployment_region'],
-            config['app_id'],
-            'elasticbeanstalk-{}-{}'.format(
-                config['deployment_region'],
-                config['account_id']
-                ),
-            '.',
-            eb_app_version_label
+            config['account_id']
+            ),
+        config.get('git_ref', 'HEAD'),
+        wheelhouse.get_wheelhouse(config)
+        )
+    alert('Source bundle {} ready to go'.format(eb_app_version_label))
+    return eb_app_version_label
+
+
+@trace.traced
+def up_eb(config, alert, bundle_cache=None):
+    tiers = [tier for tier in ('web', 'worker') if config.get(tier)]
+    if not tiers:
+        return
+    version_label = elasticbeanstalk.get_version_label(
+        config.get('git_ref', 'HEAD'),
+        wheelhouse.get_wheelhouse(config)
+        )
+    live_environments = dict(
+        (tier, get_live_eb_environment(config, tier)) for tier in tiers
+        )
+    # a bundle is only needed when some environment is new or runs
+    #   another version; otherwise only the configuration is updated
+    if any(
+            environment is None or
+                environment['VersionLabel'] != version_label
+            for name, environment in live_environments.values()
+            ):
+        if bundle_cache is not None:
+            version_label = bundle_cache.get_label(config, alert)
+        else:
+            version_label = up_bundle(config, alert)
+    run_parallel([
+        (
+            up_eb_environment,
+            [config, alert, tier, live_environments[tier], version_label]
             )
-        alert('Uploaded source bundle {}'.format(eb_app_version_label))
-    if config.get('web'):
+        for tier in tiers
+        ])
+
+
+@trace.traced
+def up_eb_environment(config, alert, tier, live_environment, version_label):
+    region = config['deployment_region']
+    eb = config[tier]
+    title = EB_TIER_TITLES[tier]
+    poll_seconds = eb.get('poll_seconds', elasticbeanstalk.DEFAULT_POLL_SECONDS)
+    option_settings = elasticbeanstalk.get_eb_option_settings(config, tier)
+    environment_name, environment = live_environment
+    if environment is None:
         elasticbeanstalk.create_environment(
-            config['deployment_region'],
+            region,
             config['app_id'],
-            config['eb_webhead_name'],
-            eb_app_version_label,
+            environment_name,
+            version_label,
             config['solution_stack_name'],
-            elasticbeanstalk.get_eb_option_settings(config, 'web'),
-            False
+            option_settings,
+            tier == 'worker'
             )
-        alert(
-            'Elastic Beanstalk webhead environment {} is launching'.format(
-                config['eb_webhead_name']
+        alert('Elastic Beanstalk {} environment {} is launching'.format(
+            title,
+            environment_name
+            ))
+        if autoscaling.get_queue_scaling(eb):
+            # the auto scaling group only exists once the environment is up
+            elasticbeanstalk.wait_for_environment(
+                region,
+                environment_name,
+                alert,
+                poll_seconds = poll_seconds
                 )
+            up_queue_scaling(config, alert, tier, environment_name)
+        return
+    if environment['Status'] != 'Ready':
+        environment = elasticbeanstalk.wait_for_environment(
+            region,
+            environment_name,
+            alert,
+            poll_seconds = poll_seconds
             )
-    if config.get('worker'):
+    if environment['VersionLabel'] == version_label:
+        current_settings = elasticbeanstalk.get_configuration_settings(
+            region,
+            config['app_id'],
+            environment_name
+            )
+        changed = elasticbeanstalk.get_changed_options(
+            current_settings,
+            option_settings
+            )
+        removed = get_removed_eb_options(
+            config,
+            environment_name,
+            option_settings,
+            current_settings
+            )
+        if changed or removed:
+            elasticbeanstalk.update_environment(
+                region,
+                environment_name,
+                option_settings = changed,
+                options_to_remove = removed
+                )
+            alert('Elastic Beanstalk {} environment {} is updating its '
+                  'configuration'.format(title, environment_name))
+        else:
+            alert('Elastic Beanstalk {} environment {} is up to date'.format(
+                title,
+                environment_name
+                ))
+    elif tier == 'web' and eb.get('blue_green'):
+        standby_name = get_eb_environment_names(config, tier)[
+            1 if environment_name == config['eb_webhead_name'] else 0
+            ]
         elasticbeanstalk.create_environment(
-            config['deployment_region'],
+            region,
             config['app_id'],
-            config['eb_worker_name'],
-            eb_app_version_label,
+            standby_name,
+            version_label,
             config['solution_stack_name'],
-            elasticbeanstalk.get_eb_option_settings(config, 'worker'),
-            True
+            option_settings,
+            False
+            )
+        alert('Elastic Beanstalk {} environment {} is launching next to '
+              '{}'.format(title, standby_name, environment_name))
+        try:
+            elasticbeanstalk.wait_for_environment(
+                region,
+                standby_name,
+                alert,
+                require_healthy = True,
+                poll_seconds = poll_seconds
+                )
+        except elasticbeanstalk.EnvironmentNotHealthy:
+            elasticbeanstalk.destroy_environment(standby_name, region)
+            alert('Elastic Beanstalk {} environment {} is not healthy; '
+                  'keeping {}'.format(title, standby_name, environment_name))
+            raise
+        elasticbeanstalk.swap_environment_cnames(
+            region,
+            environment_name,
+            standby_name
+            )
+        alert('Swapped CNAMEs of {} and {}'.format(environment_name, standby_name))
+        drain_seconds = eb.get(
+            'drain_seconds',
+            elasticbeanstalk.DEFAULT_DRAIN_SECONDS
             )
-        alert(
-            'Elastic Beanstalk worker environment {} is launching'.format(
-                config['eb_worker_name']
+        alert('Keeping {} for {}s while its clients drain'.format(
+            environment_name,
+            drain_seconds
+            ))
+        sleep(drain_seconds)
+        elasticbeanstalk.destroy_environment(environment_name, region)
+        alert('Elastic Beanstalk {} environment {} is terminating'.format(
+            title,
+            environment_name
+            ))
+    else:
+        elasticbeanstalk.update_environment(
+            region,
+            environment_name,
+            version_label = version_label,
+            option_settings = option_settings,
+            options_to_remove = get_removed_eb_options(
+                config,
+                environment_name,
+                option_settings
                 )
             )
+        alert('Elastic Beanstalk {} environment {} is deploying {}'.format(
+            title,
+            environment_name,
+            version_label
+            ))
+    up_queue_scaling(config, alert, tier, environment_name)
+
+
+@trace.traced
+def up_queue_scaling(config, alert, tier, environment_name):
+    if tier != 'worker':
+        return
+    scaling = autoscaling.get_queue_scaling(config[tier])
+    if not scaling:
+        autoscaling.destroy_queue_scaling(
+            config['deployment_region'],
+            environment_name
+            )
+        return
+    asg_name = autoscaling.ensure_queue_scaling(
+        config['deployment_region'],
+        environment_name,
+        elasticbeanstalk.get_worker_queue_name(config),
+        scaling
+        )
+    alert('Queue backlog scaling for {} ready to go'.format(asg_name))
+
+
+def get_eb_environment_names(config, tier):
+    """the environment names a tier may use; web alternates for blue/green"""
+    if tier == 'web':
+        return [
+            config['eb_webhead_name'],
+            '{}-bg'.format(config['eb_webhead_name'])
+            ]
+    return [config['eb_worker_name']]
+
+
+def get_live_eb_environment(config, tier):
+    """return (environment name, description or None) for the live environment"""
+    names = get_eb_environment_names(config, tier)
+    for name in names:
+        environment = elasticbeanstalk.get_environment(
+            config['deployment_region'],
+            name
+            )
+        if environment is not None:
+            return name, environment
+    return names[0], None
+
+
+def get_removed_eb_options(
+            config,
+            environment_name,
+            option_settings,
+            current_settings = None
+            ):
+    # environment variables dropped from the config must be removed
+    #   explicitly, since update_environment only adds and changes options
+    if current_settings is None:
+        current_settings = elasticbeanstalk.get_configuration_settings(
+            config['deployment_region'],
+            config['app_id'],
+            environment_name
+            )
+    current_names = set(
+        option_name for namespace, option_name in current_settings
+        if namespace == elasticbeanstalk.ENVIRONMENT_NAMESPACE
+        )
+    names = set(
+        option['OptionName'] for option in option_settings
+        if option['Namespace'] == elasticbeanstalk.ENVIRONMENT_NAMESPACE
+        )
+    return [
+        {'Namespace': elasticbeanstalk.ENVIRONMENT_NAMESPACE, 'OptionName': name}
+        for name in sorted(current_names - names)
+        ]
 
 
+@trace.traced
 def up_iam(config, alert):
+    # compile first so that an oversized policy fails before any iam call;
+    #   wildcards are opt in, as '<deployment_name>-*' also matches the
+    #   resources of deployments whose names extend this one's
+    policy_documents = iam.compile_policy(
+        iam.get_inline_policy_document(config),
+        resource_prefix = '{}-'.format(config['deployment_name'])
+            if config.get('iam_wildcards') else None
+        )
+    if len(policy_documents) > 1:
+        alert('Role policy split into {} managed policies'.format(
+            len(policy_documents)
+            ))
     iam.ensure_role(
         config['role_name'],
         '{}-EC2InstanceProfilePolicy'.format(config['deployment_name']),
-        iam.get_inline_policy_document(config)
+        policy_documents
         )
     alert('Role {} ready to go'.format(config['role_name']))
     iam.ensure_instance_profile(
@@ -267,42 +636,131 @@ def up_iam(config, alert):
     alert('Instance Profile {} ready to go'.format(config['instance_profile_name']))
 
 
+@trace.traced
 def up_rds(config, alert):
+    """bring up the rds instance; return the thread refilling the warm pool"""
     if not config['rds']:
-        return
-    alert('Creating RDS instance {}'.format(config['deployment_name']))
-    rds.create_instance_from_snapshot(
-        config['deployment_region'],
-        config['deployment_name'],
-        config['rds']['snapshot_name'],
-        config['rds']['db_instance_type']
-        )
-    stime = int(time())
-    while True:
-        status = rds.get_instance_status(
-            config['deployment_region'],
+        return None
+    region = config['deployment_region']
+    claimed = None
+    pool_thread = None
+    exists = get_rds_instance_status(config) is not None
+    if exists:
+        alert('RDS instance {} exists'.format(config['deployment_name']))
+    elif config['rds'].get('warm_pool'):
+        pool_name, pool_prefix = get_rds_pool(config)
+        claimed = rds.claim_pool_instance(
+            region,
+            pool_name,
+            pool_prefix,
+            config['deployment_name'],
+            config['rds']['security_groups']
+            )
+        # the claimed instance keeps its pool name until the rename is
+        #   applied, so the refill is told not to count it
+        pool_thread = Thread(
+            target = trace.bind(up_rds_pool),
+            args = [config, alert, [claimed] if claimed else []]
+            )
+        pool_thread.start()
+    if claimed:
+        alert('Claimed warm RDS instance {} as {}'.format(
+            claimed,
             config['deployment_name']
+            ))
+    elif not exists:
+        alert('Creating RDS instance {}'.format(config['deployment_name']))
+        rds.create_instance_from_snapshot(
+            region,
+            config['deployment_name'],
+            config['rds']['snapshot_name'],
+            config['rds']['db_instance_type']
             )
+    stime = int(time())
+    wait_timeout = config['rds'].get('wait_timeout', rds.DEFAULT_WAIT_TIMEOUT)
+    while True:
+        # a claimed instance is not found by its new name until the
+        #   rename has been applied
+        status = get_rds_instance_status(config) or 'renaming'
         elapsed = int(time()) - stime
         min, sec = int(elapsed / 60), elapsed % 60
         alert('{:02d}:{:02d} -- status: {}'.format(min, sec, status))
         if status == 'available':
             break
-        sleep(20)
-    rds.modify_vpc_security_groups(
+        if elapsed > wait_timeout:
+            raise rds.InstanceNotReady(
+                'RDS instance {} still {} after {}s'.format(
+                    config['deployment_name'],
+                    status,
+                    wait_timeout
+                    ))
+        sleep(config['rds'].get('poll_seconds', 20))
+    if claimed:
+        rds.retag_instance(
+            region,
+            config['deployment_name'],
+            {rds.DEPLOYMENT_TAG: config['deployment_name']},
+            [rds.POOL_TAG]
+            )
+    else:
+        rds.modify_vpc_security_groups(
+            region,
+            config['deployment_name'],
+            config['rds']['security_groups']
+            )
+    alert('RDS instance {} ready to go'.format(config['deployment_name']))
+    return pool_thread
+
+
+def get_rds_instance_status(config):
+    try:
+        return rds.get_instance_status(
+            config['deployment_region'],
+            config['deployment_name']
+            )
+    except ClientError as ex:
+        if utils.client_error_code(ex) != rds.DB_INSTANCE_NOT_FOUND:
+            raise(ex)
+    return None
+
+
+def get_rds_pool(config):
+    """the (pool name, instance name prefix) of the config's warm pool"""
+    return (
+        rds.get_pool_name(
+            config['app_id'],
+            config['deployment_delta'],
+            config['rds']['snapshot_name'],
+            config['rds']['db_instance_type']
+            ),
+        rds.get_pool_prefix(config['app_id'], config['deployment_delta'])
+        )
+
+
+@trace.traced
+def up_rds_pool(config, alert, claimed=()):
+    pool_name, pool_prefix = get_rds_pool(config)
+    created = rds.replenish_pool(
         config['deployment_region'],
-        config['deployment_name'],
-        config['rds']['security_groups']
+        pool_name,
+        pool_prefix,
+        config['rds']['snapshot_name'],
+        config['rds']['db_instance_type'],
+        config['rds']['warm_pool'].get('size', 1),
+        exclude = claimed
         )
-    alert('RDS instance {} ready to go'.format(config['deployment_name']))
+    for db_instance_identifier in created:
+        alert('Warm RDS instance {} is restoring'.format(db_instance_identifier))
 
 
+@trace.traced
 def up_queues(queues, account_id, alert):
     for queue in queues:
         if queue['dead_letter_queue']:
             sqs.ensure_queue(
                 queue['dead_letter_queue']['name'],
                 queue['region'],
+                fifo = queue['dead_letter_queue'].get('fifo')
                 )
             alert('Queue {} ready to go'.format(
                 queue['dead_letter_queue']['name']
@@ -321,25 +779,26 @@ def up_queues(queues, account_id, alert):
         sqs.ensure_queue(
             queue['name'],
             queue['region'],
-            redrive_policy = redrive_policy
+            redrive_policy = redrive_policy,
+            fifo = queue.get('fifo')
             )
         alert('Queue {} ready to go'.format(queue['name']))
 
 
+@trace.traced
 def up_topics(topics, account_id, alert):
     for topic in topics:
         topic_arn = sns.ensure_topic(topic['name'], topic['region'])
         alert('Topic {} ready to go'.format(topic['name']))
-        client = boto3.client('sns', topic['region'])
-        for subscription in topic.get('subscriptions', []):
-            client.subscribe(
-                TopicArn = topic_arn,
-                Protocol = subscription['protocol'],
-                Endpoint = subscription['endpoint']
-                )
-            alert('Subscription {}: {} ready to go'.format(
-                    subscription['protocol'],
-                    subscription['endpoint']
-                ))
+        result = sns.reconcile_subscriptions(
+            topic_arn,
+            topic['region'],
+            topic.get('subscriptions', []),
+            topic.get('unsubscribe', [])
+            )
+        for protocol, endpoint in result['added']:
+            alert('Subscription {}: {} ready to go'.format(protocol, endpoint))
+        for protocol, endpoint in result['removed']:
+            alert('Subscription {}: {} is removed'.format(protocol, endpoint))
 
 
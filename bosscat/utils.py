@@ -1,28 +1,95 @@
-from time import sleep
+from functools import lru_cache
+from threading import Lock
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.client import Config
 
-
-client_error_code = lambda ex: ex.response['Error']['Code']
+from bosscat import retry, trace
 
 
-def try_client(lambda_func, max_attempts=10, sleep_time=1.0, ignore=[]):
-    for attempt in range(1, max_attempts + 1):
-        try:
-            lambda_func()
-            return True
-        except ClientError as ex:
-            if client_error_code(ex) in ignore:
-                break
-            if (attempt == max_attempts):
-                raise(ex)
-            sleep(sleep_time)
-    return False
+client_error_code = lambda ex: ex.response['Error']['Code']
 
 
+_clients = {}
+_clients_lock = Lock()
+
+
+class Boto3Provider(object):
+    """create clients for the real aws apis"""
+
+    def __init__(self):
+        self.session = None
+
+    def client(self, service_name, region=None, signature_version=None):
+        # boto3 sessions are not thread safe; get_client only calls this
+        #   under its lock, and the clients themselves can be shared
+        if self.session is None:
+            self.session = boto3.session.Session()
+        kwargs = {}
+        if signature_version:
+            kwargs['config'] = Config(signature_version=signature_version)
+        client = self.session.client(
+            service_name,
+            region_name = region,
+            **kwargs
+            )
+        trace.register_client(client)
+        retry.register_client(client)
+        return client
+
+
+_provider = Boto3Provider()
+
+
+def try_client(
+            lambda_func,
+            max_attempts = 10,
+            sleep_time = 1.0,
+            ignore = [],
+            eventual = []
+            ):
+    """call lambda_func, retrying aws errors by class; see retry.call
+
+    sleep_time is the first backoff, which doubles with each attempt.
+    """
+    return retry.call(
+        lambda_func,
+        max_attempts,
+        sleep_time,
+        ignore,
+        eventual = eventual
+        )
+
+
+def get_client(service_name, region=None, signature_version=None):
+    """obtain a client from the current provider, shared across threads"""
+    key = (service_name, region, signature_version)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = _provider.client(
+                service_name,
+                region,
+                signature_version
+                )
+        return _clients[key]
+
+
+def get_provider():
+    return _provider
+
+
+def set_provider(provider):
+    """route every aws client through provider (e.g. memory.MemoryProvider)"""
+    global _provider
+    with _clients_lock:
+        _provider = provider
+        _clients.clear()
+    get_account_id.cache_clear()
+
+
+@lru_cache()
 def get_account_id():
-    return boto3.client('sts').get_caller_identity()['Account']
+    return get_client('sts').get_caller_identity()['Account']
 
 
 def get_bucket_arn(bucket_name):
@@ -44,6 +111,9 @@ def getenv(config, deployment_tier):
         'BOSSCAT_DEPLOYMENT_DELTA': config['deployment_delta'],
         'BOSSCAT_DEPLOYMENT_TAG': config['deployment_tag'],
         'BOSSCAT_DEPLOYMENT_REGION': config['deployment_region'],
+        'BOSSCAT_DEPLOYMENT_REGIONS': ','.join(
+            config.get('deployment_regions', [config['deployment_region']])
+            ),
         'BOSSCAT_DEPLOYMENT_TIER': deployment_tier,
         'BOSSCAT_SECRETS_BUCKET': config['secrets_bucket'],
         })
@@ -0,0 +1,123 @@
+from hashlib import sha256
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from bosscat import trace
+
+
+DEFAULT_WHEELHOUSE = {
+    'requirements': 'requirements.txt',
+    'platform': 'manylinux2014_x86_64',
+    'implementation': 'cp',
+    'cache_dir': os.path.join('~', '.cache', 'bosscat', 'wheelhouse'),
+    }
+
+
+# the wheels go in this directory of the bundle, next to the requirements
+#   file that eb installs; pip finds them relative to that file
+BUNDLE_DIRECTORY = 'wheelhouse'
+BUNDLE_REQUIREMENTS = 'requirements.txt'
+
+
+class UnknownPythonVersion(Exception):
+    pass
+
+
+def get_python_version(solution_stack_name):
+    """the python version of an eb solution stack, e.g. '3.8', or None"""
+    match = re.search(r'\bPython (\d+\.\d+)', solution_stack_name or '')
+    return match.group(1) if match else None
+
+
+def get_wheelhouse(config):
+    """the config's wheelhouse settings merged over the defaults, or None
+
+    Wheels are built for the python of the solution stack unless the
+    wheelhouse names a python_version of its own.
+    """
+    if not config.get('wheelhouse'):
+        return None
+    wheelhouse = dict(DEFAULT_WHEELHOUSE)
+    if isinstance(config['wheelhouse'], dict):
+        wheelhouse.update(config['wheelhouse'])
+    if not wheelhouse.get('python_version'):
+        wheelhouse['python_version'] = get_python_version(
+            config.get('solution_stack_name')
+            )
+    if not wheelhouse['python_version']:
+        raise UnknownPythonVersion(
+            'set wheelhouse.python_version for solution stack {!r}'.format(
+                config.get('solution_stack_name')
+                ))
+    return wheelhouse
+
+
+def get_requirements(wheelhouse, git_ref='HEAD'):
+    # read the requirements of the commit being bundled, not the work tree
+    return subprocess.check_output(
+        ['git', 'show', '{}:{}'.format(git_ref, wheelhouse['requirements'])]
+        )
+
+
+def get_bundle_requirements(wheelhouse, git_ref='HEAD'):
+    """the requirements file of the bundle, installing from the wheelhouse only"""
+    # the options go in the file rather than the environment so that they
+    #   only apply to the install, not to pip calls of the running app
+    return '--no-index\n--find-links {}\n'.format(BUNDLE_DIRECTORY).encode(
+        'utf-8'
+        ) + get_requirements(wheelhouse, git_ref)
+
+
+def get_wheelhouse_hash(wheelhouse, git_ref='HEAD'):
+    digest = sha256(get_bundle_requirements(wheelhouse, git_ref))
+    for name in ('platform', 'python_version', 'implementation'):
+        digest.update('\0{}'.format(wheelhouse[name]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+@trace.traced
+def build_wheelhouse(wheelhouse, git_ref='HEAD'):
+    """download wheels for the target platform; return their paths
+
+    Wheels are cached by the hash of the requirements file and the target
+    platform, so unchanged requirements are only downloaded once.  Every
+    requirement needs a wheel for the target platform; pip fails on
+    requirements that are only published as source distributions.
+    """
+    cache_dir = os.path.expanduser(wheelhouse['cache_dir'])
+    wheel_dir = os.path.join(cache_dir, get_wheelhouse_hash(wheelhouse, git_ref))
+    if not os.path.isdir(wheel_dir):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        build_dir = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            requirements_filename = os.path.join(build_dir, 'requirements.txt')
+            with open(requirements_filename, 'wb') as requirements_file:
+                requirements_file.write(get_requirements(wheelhouse, git_ref))
+            with trace.span('pip download', 'subprocess'):
+                subprocess.check_call([
+                    sys.executable, '-m', 'pip', 'download',
+                    '--only-binary=:all:',
+                    '--platform', wheelhouse['platform'],
+                    '--python-version', wheelhouse['python_version'],
+                    '--implementation', wheelhouse['implementation'],
+                    '--dest', os.path.join(build_dir, 'wheels'),
+                    '--requirement', requirements_filename
+                    ])
+            # rename into place so that a failed or concurrent build never
+            #   leaves a partial wheelhouse in the cache
+            try:
+                os.rename(os.path.join(build_dir, 'wheels'), wheel_dir)
+            except OSError:
+                if not os.path.isdir(wheel_dir):
+                    raise
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    return sorted(
+        os.path.join(wheel_dir, filename)
+        for filename in os.listdir(wheel_dir)
+        )